@@ -1,13 +1,22 @@
 import streamlit as st
-import requests
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-import json
-import PyPDF2
 from datetime import datetime
-import re
+import os
+import tempfile
+import time
+from financial_analyzer.cache import DiskCache, DEFAULT_CACHE_DIR
+from financial_analyzer.dedup import describe_duplicate
+from financial_analyzer.page_index import estimate_tokens
+from financial_analyzer.openrouter_client import OpenRouterClient
+from financial_analyzer.results_store import ResultsStore
+from financial_analyzer.jobs import AnalysisJob, JobRunner
+from financial_analyzer.ocr import ocr_unavailable_reason
+from financial_analyzer.pdf_text import spill_to_temp
+from financial_analyzer.telemetry import (
+    document_telemetry, telemetry_json, prometheus_text, escalation_stats
+)
+from financial_analyzer.pipeline import (
+    Analyzer, MODEL_OPTIONS, AVAILABLE_METRICS, DEFAULT_METRICS, DEFAULT_CASCADE_MODEL, collect_results
+)
 
 # Configurazione pagina
 st.set_page_config(
@@ -49,202 +58,417 @@ if openrouter_api_key:
     else:
         st.sidebar.success("✅ Chiave API configurata")
 
-# Selezione modello (aggiornata con i modelli richiesti)
-model_options = [
-    "anthropic/claude-sonnet-4",
-    "anthropic/claude-opus-4", 
-    "google/gemini-2.5-flash-preview-05-20",
-    "google/gemini-2.5-pro-preview",
-    "openai/gpt-4.1"
-]
-
+# Selezione modello
 selected_model = st.sidebar.selectbox(
     "Seleziona Modello AI",
-    model_options,
+    MODEL_OPTIONS,
     index=0,
     help="Scegli il modello AI per l'analisi dei documenti"
 )
 
+# Cascata: modello veloce per primo, modello selezionato solo se i controlli falliscono
+use_cascade = st.sidebar.checkbox(
+    "🪜 Cascata di modelli",
+    value=False,
+    help="Ogni documento viene elaborato prima con un modello veloce ed economico; le risposte che non superano i controlli contabili (EBITDA ≥ EBIT, PFN coerente con debiti verso banche e liquidità, ordini di grandezza, JSON completo) vengono ripetute con il modello selezionato sopra"
+)
+cascade_model = None
+if use_cascade:
+    cascade_model = st.sidebar.selectbox(
+        "Modello veloce",
+        MODEL_OPTIONS,
+        index=MODEL_OPTIONS.index(DEFAULT_CASCADE_MODEL),
+        help="Modello usato per il primo passaggio"
+    )
+    if cascade_model == selected_model:
+        st.sidebar.warning("⚠️ Il modello veloce coincide con quello selezionato: la cascata non ha effetto")
+
+# Numero massimo di richieste simultanee verso l'AI
+max_concurrent_requests = st.sidebar.slider(
+    "Richieste simultanee massime",
+    min_value=1,
+    max_value=16,
+    value=4,
+    help="Numero massimo di richieste API in corso contemporaneamente, per tutti i documenti (anche con l'estrazione a blocchi) e di documenti elaborati in parallelo"
+)
+
+# Numero di processi per l'estrazione del testo dai PDF lunghi
+pdf_extraction_workers = st.sidebar.slider(
+    "Processi per estrazione PDF",
+    min_value=1,
+    max_value=max(os.cpu_count() or 1, 2),
+    value=min(os.cpu_count() or 1, 4),
+    help="Le pagine dei PDF lunghi vengono estratte in parallelo su più core. Con 1 l'estrazione è seriale"
+)
+
+# Cache persistente delle risposte AI (condivisa tra sessioni)
+@st.cache_resource
+def get_response_cache():
+    return DiskCache(os.path.join(DEFAULT_CACHE_DIR, "responses.sqlite3"))
+
+# Cache persistente del testo estratto dai PDF (per hash SHA-256 del file)
+@st.cache_resource
+def get_text_cache():
+    return DiskCache(os.path.join(DEFAULT_CACHE_DIR, "pdf_text.sqlite3"), max_bytes=500 * 1024 * 1024)
+
+# Archivio persistente dei risultati per documento e metrica
+@st.cache_resource
+def get_results_store():
+    return ResultsStore(os.path.join(DEFAULT_CACHE_DIR, "results.sqlite3"))
+
+response_cache = get_response_cache()
+text_cache = get_text_cache()
+results_store = get_results_store()
+
+use_response_cache = st.sidebar.checkbox(
+    "🗄️ Usa cache risposte AI",
+    value=True,
+    help="Riutilizza le risposte già ottenute per lo stesso prompt e modello. Se disattivata, le richieste vengono sempre inviate e la cache viene aggiornata"
+)
+
+if st.sidebar.button("🧹 Svuota cache"):
+    response_cache.clear()
+    text_cache.clear()
+    st.sidebar.success("✅ Cache svuotata")
+
+use_results_store = st.sidebar.checkbox(
+    "💾 Riusa risultati salvati",
+    value=True,
+    help="I documenti già analizzati non vengono rielaborati: all'AI vengono richieste solo le metriche non ancora estratte"
+)
+
+if st.sidebar.button("🗑️ Cancella risultati salvati"):
+    results_store.clear()
+    st.sidebar.success("✅ Risultati salvati cancellati")
+
+# Limite di frequenza delle richieste verso OpenRouter
+requests_per_minute = st.sidebar.slider(
+    "Richieste al minuto (max)",
+    min_value=10,
+    max_value=600,
+    value=120,
+    step=10,
+    help="Limite condiviso da tutti i documenti in elaborazione. In caso di errore 429 le richieste vengono ritentate rispettando Retry-After"
+)
+
+# Client HTTP condiviso (connessioni keep-alive riutilizzate tra richieste e sessioni)
+@st.cache_resource
+def get_openrouter_client():
+    return OpenRouterClient()
+
+openrouter_client = get_openrouter_client()
+openrouter_client.rate_limiter.set_rate(requests_per_minute)
+
+# Estrazione locale (senza AI) per i bilanci in schema CEE
+use_local_extraction = st.sidebar.checkbox(
+    "⚡ Estrazione locale (schema CEE)",
+    value=True,
+    help="Legge le voci standard del bilancio civilistico italiano (A-B, ammortamenti, debiti verso banche, disponibilità liquide...) senza chiamate API. L'AI viene usata solo per le metriche non trovate"
+)
+
+# Documenti lunghi: tutte le pagine rilevanti in più blocchi elaborati in parallelo
+chunked_extraction = st.sidebar.checkbox(
+    "🧩 Estrazione a blocchi (documenti lunghi)",
+    value=False,
+    help="Se le pagine rilevanti superano il limite di un singolo prompt vengono divise in blocchi (al massimo 8) inviati in parallelo; i risultati vengono poi uniti preferendo i valori riportati esplicitamente a quelli calcolati. Più richieste API per documento"
+)
+
+# Una sola chiamata per documento invece di identificazione + estrazione
+combined_extraction = st.sidebar.checkbox(
+    "🔗 Chiamata unica (azienda + metriche)",
+    value=False,
+    help="Azienda, anno fiscale, valuta e metriche vengono richiesti con un solo prompt, dimezzando richieste e latenza. Con i modelli che lo supportano (OpenAI, Gemini) la risposta è vincolata a uno schema JSON"
+)
+
+# Streaming delle risposte: le metriche compaiono appena il modello le scrive
+stream_responses = st.sidebar.checkbox(
+    "📡 Risposte in streaming",
+    value=False,
+    help="Le metriche vengono mostrate appena completate nella risposta dell'AI. Il timeout si applica solo all'inattività, quindi le risposte lunghe ma regolari non vengono interrotte. Un errore a metà risposta non viene ritentato"
+)
+
+# File grandi o lotti numerosi: memoria limitata durante l'elaborazione
+low_memory = st.sidebar.checkbox(
+    "🧠 Memoria ridotta (file grandi)",
+    value=False,
+    help="I PDF caricati vengono copiati in file temporanei e letti da disco (mmap); il testo viene elaborato una pagina alla volta e conservato compresso, senza mai unirlo in un'unica stringa. Il testo estratto non compare nel pannello di debug"
+)
+
+# OCR solo per le pagine senza testo (documenti scansionati o misti)
+use_ocr = st.sidebar.checkbox(
+    "🔎 OCR pagine scansionate",
+    value=False,
+    help="Le pagine senza testo estraibile che contengono immagini vengono lette con tesseract, in parallelo sui processi di estrazione. Le pagine con testo non vengono toccate e il testo riconosciuto resta in cache"
+)
+if use_ocr and ocr_unavailable_reason():
+    st.sidebar.warning(f"⚠️ OCR non disponibile: {ocr_unavailable_reason()}")
+
+# Più esercizi da un solo documento: colonne comparative e tabelle pluriennali
+multi_year = st.sidebar.checkbox(
+    "📅 Anche gli esercizi precedenti",
+    value=False,
+    help="Oltre all'anno del documento vengono estratti gli esercizi precedenti riportati nei prospetti (colonna dell'anno precedente, tabelle pluriennali), nella stessa chiamata. Per lo stesso anno prevalgono i valori del documento più recente"
+)
+
+# Cache dei prompt del provider: istruzioni e testo del documento in un prefisso comune
+prompt_caching = st.sidebar.checkbox(
+    "♻️ Cache dei prompt del provider",
+    value=False,
+    help="Quando azienda e metriche vengono chieste all'AI con due chiamate (senza estrazione a blocchi né chiamata unica), le chiamate di un documento iniziano con lo stesso prefisso (istruzioni e pagine selezionate), che il provider rilegge dalla propria cache a costo e latenza ridotti. Per Claude e Gemini il prefisso viene marcato esplicitamente. L'identificazione invia però più pagine e con Claude la prima scrittura in cache costa un po' di più"
+)
+
+# Pulizia del testo inviato all'AI
+text_cleanup = st.sidebar.checkbox(
+    "🧹 Pulizia del testo (intestazioni, piè di pagina, spazi)",
+    value=True,
+    help="Prima di comporre i prompt vengono tolte le righe ripetute ai margini delle pagine (nome della società, titolo, numeri di pagina; restano solo nella prima pagina inviata), i puntini di riempimento e gli spazi superflui, e i numeri vengono scritti in modo uniforme. L'estrazione locale usa il testo originale"
+)
+
+# Controllo duplicati prima di qualsiasi chiamata API
+deduplicate = st.sidebar.checkbox(
+    "🧬 Salta documenti duplicati",
+    value=False,
+    help="Prima dell'analisi vengono confrontati i file (hash), il testo (impronte MinHash delle pagine) e azienda e anno riconosciuti localmente, se il testo del documento più breve è in buona parte contenuto nell'altro (es. bilancio abbreviato e relazione completa). Di ogni gruppo viene analizzato solo il documento più completo: gli altri non vengono analizzati e sono elencati con il motivo"
+)
+
 # Selezione metriche finanziarie
 st.sidebar.header("📈 Metriche da Estrarre")
-available_metrics = [
-    "Ricavi/Vendite",
-    "EBITDA", 
-    "EBIT",
-    "Utile Netto",
-    "Totale Attività",
-    "Totale Passività", 
-    "Patrimonio Netto",
-    "Flusso di Cassa Operativo",
-    "Free Cash Flow",
-    "Rapporto Debito/Patrimonio",
-    "PFN (Posizione Finanziaria Netta)"
-]
-
 selected_metrics = st.sidebar.multiselect(
     "Scegli le metriche da estrarre:",
-    available_metrics,
-    default=["EBITDA", "EBIT", "PFN (Posizione Finanziaria Netta)"],
+    AVAILABLE_METRICS,
+    default=DEFAULT_METRICS,
     help="Seleziona le metriche finanziarie che vuoi estrarre dai documenti"
 )
 
-# Funzione per estrarre testo da PDF
-def extract_pdf_text(pdf_file):
-    try:
-        reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        st.error(f"Errore nell'estrazione del testo dal PDF: {str(e)}")
-        return None
-
-# Funzione per chiamare API OpenRouter (implementazione sicura)
-def call_openrouter_api(prompt, model=None):
-    # Validazione chiave API
-    if not openrouter_api_key or len(openrouter_api_key.strip()) < 10:
-        st.error("❌ Inserisci una chiave API OpenRouter valida nella barra laterale.")
-        return None
-    
-    # Usa il modello selezionato
-    if not model:
-        model = selected_model
-    
-    url = "https://openrouter.ai/api/v1/chat/completions"
+# Pipeline di analisi configurata dalla barra laterale (nessuna chiamata st.* nei thread di lavoro)
+analyzer = Analyzer(
+    openrouter_api_key,
+    model=selected_model,
+    client=openrouter_client,
+    response_cache=response_cache,
+    text_cache=text_cache,
+    results_store=results_store if use_results_store else None,
+    use_response_cache=use_response_cache,
+    use_local_extraction=use_local_extraction,
+    max_concurrent_requests=max_concurrent_requests,
+    pdf_extraction_workers=pdf_extraction_workers,
+    chunked_extraction=chunked_extraction,
+    combined_extraction=combined_extraction,
+    cascade_model=cascade_model,
+    stream_responses=stream_responses,
+    low_memory=low_memory,
+    ocr=use_ocr,
+    deduplicate=deduplicate,
+    multi_year=multi_year,
+    prompt_caching=prompt_caching,
+    text_cleanup=text_cleanup
+)
+
+# Funzione per mostrare le informazioni di debug di un documento elaborato
+def show_document_debug(doc, metrics):
+    pdf_source = doc['source']
+    pdf_text = doc['pdf_text']
     
-    headers = {
-        "Authorization": f"Bearer {openrouter_api_key.strip()}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://analizzatore-pdf-finanziari.streamlit.app",
-        "X-Title": "Analizzatore PDF Finanziari"
-    }
+    # Debug: Informazioni documento
+    with st.expander(f"🔍 Debug: {pdf_source['name']}", expanded=False):
+        st.write(f"**Nome file**: {pdf_source['name']}")
+        st.write(f"**Sorgente**: File caricato")
+        if doc['doc_hash']:
+            st.write(f"**SHA-256**: `{doc['doc_hash']}`")
+        if doc['duplicate']:
+            st.write(f"**Saltato**: {describe_duplicate(doc['duplicate'])}")
+        if doc['prior_years']:
+            st.write(f"**Esercizi precedenti**: {', '.join(sorted(doc['prior_years'], reverse=True))}")
+        if doc['json_repairs']:
+            st.write(f"**JSON corretto localmente**: {', '.join(doc['json_repairs'])}")
+        if doc['text_cleanup']:
+            cleanup = doc['text_cleanup']
+            st.write(f"**Pulizia del testo**: {cleanup['document_chars_removed']} caratteri rimossi su "
+                     f"{cleanup['document_chars']} nell'intero documento, {cleanup['repeated_lines']} righe ripetute ai margini")
+            if cleanup['prompts']:
+                # Il budget dei prompt resta pieno: lo spazio liberato accoglie altre pagine
+                st.write(f"**Pulizia nei prompt**: {cleanup['prompt_chars_saved']} caratteri tolti dalle pagine inviate "
+                         f"in {cleanup['prompts']} prompt (~{cleanup['prompt_tokens_saved']} token), "
+                         f"spazio riusato per altre pagine entro lo stesso budget")
+        if doc['stored_metrics']:
+            st.write(f"**Metriche dai risultati salvati**: {', '.join(doc['stored_metrics'])}")
+        if doc['ocr'] and (doc['ocr']['pages'] or doc['ocr']['failed']):
+            ocr = doc['ocr']
+            st.write(f"**Pagine lette con OCR**: {', '.join(map(str, ocr['pages'])) or 'nessuna'} ({len(ocr['cached'])} dalla cache)")
+            if ocr['failed']:
+                st.write(f"**OCR non riuscito**: pagine {', '.join(map(str, ocr['failed']))}")
+        if doc['cascade']:
+            cascade = doc['cascade']
+            st.write(f"**Cascata**: primo passaggio con `{cascade['model']}`")
+            if cascade['identification_escalated']:
+                st.write(f"- Identificazione ripetuta: {', '.join(cascade['identification_problems'])}")
+            for metric, reason in cascade['escalated_metrics'].items():
+                st.write(f"- {metric} ripetuta: {reason}")
+            if cascade['discarded_metrics']:
+                st.write(f"- Valori non validi scartati: {', '.join(cascade['discarded_metrics'])}")
+        for call in doc['api_calls']:
+            origin = "cache" if call['cached'] else f"{call['attempts']} tentativi"
+            st.write(f"**Chiamata {call['call']}**: {call['seconds']:.2f} s ({origin}), "
+                     f"{call['prompt_tokens']} token prompt ({call.get('cached_tokens', 0)} dalla cache del provider) / "
+                     f"{call['completion_tokens']} completamento, "
+                     f"{call['request_bytes'] / 1024:.1f} KB inviati")
     
-    data = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user", 
-                "content": prompt
-            }
-        ],
-        "max_tokens": 4000,
-        "temperature": 0.1
-    }
+    # Documento duplicato: analizzato solo l'originale
+    if doc['duplicate']:
+        return
     
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        
-        if 'choices' in result and len(result['choices']) > 0:
-            return result['choices'][0]['message']['content']
-        else:
-            st.error("❌ Risposta API non valida")
-            return None
-            
-    except requests.exceptions.Timeout:
-        st.error("❌ Timeout della richiesta API. Riprova.")
-        return None
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 401:
-            st.error("❌ Chiave API non valida. Controlla le tue credenziali OpenRouter.")
-        elif response.status_code == 402:
-            st.error("❌ Credito API insufficiente. Ricarica il tuo account OpenRouter.")
-        elif response.status_code == 429:
-            st.error("❌ Troppi richieste. Attendi un momento e riprova.")
-        else:
-            st.error(f"❌ Errore API HTTP {response.status_code}: {str(e)}")
-        return None
-    except Exception as e:
-        st.error(f"❌ Errore nella chiamata API OpenRouter: {str(e)}")
-        return None
-
-# Funzione per estrarre JSON da risposta AI
-def extract_json_from_response(response_text):
-    """Estrae JSON da una risposta che potrebbe contenere testo aggiuntivo"""
-    if not response_text:
-        return None
+    # Documento già analizzato: nessuna elaborazione in questa esecuzione
+    if doc['company_source'] == 'store' and doc['page_count'] == 0:
+        with st.expander(f"💾 Debug Risultati Salvati: {pdf_source['name']}", expanded=False):
+            st.json(doc['company_info'])
+            st.json(doc['financial_data'])
+        return
     
-    # Cerca il primo { e l'ultimo }
-    start = response_text.find('{')
-    end = response_text.rfind('}')
+    # Debug: Testo estratto
+    if pdf_text:
+        with st.expander(f"📄 Testo estratto da {pdf_source['name']}", expanded=False):
+            st.write(f"**Lunghezza testo**: {len(pdf_text)} caratteri")
+            st.write(f"**Prime 1000 caratteri**:")
+            st.text(pdf_text[:1000])
+            st.write(f"**Ultime 500 caratteri**:")
+            st.text(pdf_text[-500:])
+    elif doc['text_chars']:
+        with st.expander(f"📄 Testo estratto da {pdf_source['name']}", expanded=False):
+            st.write(f"**Pagine**: {doc['page_count']}, **caratteri**: {doc['text_chars']}")
+            st.write("Testo non conservato (modalità memoria ridotta)")
     
-    if start != -1 and end != -1 and end > start:
-        json_str = response_text[start:end+1]
-        try:
-            return json.loads(json_str)
-        except json.JSONDecodeError:
-            return None
-    return None
-
-# Funzione per identificare azienda e anno
-def identify_company_and_year(pdf_text):
-    prompt = f"""
-    Analizza questo documento finanziario e identifica le informazioni richieste.
+    if doc['text_chars'] <= 100:
+        if pdf_text:
+            with st.expander(f"⚠️ Debug Testo Insufficiente: {pdf_source['name']}", expanded=True):
+                st.write(f"**Testo estratto ({len(pdf_text)} caratteri):**")
+                st.text(pdf_text[:500] if pdf_text else "Nessun testo estratto")
+        return
     
-    IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo.
+    # Debug: Estrazione locale
+    if doc['local_items'] is not None:
+        with st.expander(f"⚡ Debug Estrazione Locale: {pdf_source['name']}", expanded=False):
+            st.write("**Voci di bilancio trovate:**")
+            st.json(doc['local_items'])
+            st.write(f"**Metriche risolte localmente**: {', '.join(doc['local_metrics']) or 'nessuna'}")
+            st.write(f"**Metriche richieste all'AI**: {', '.join(doc['ai_metrics']) or 'nessuna'}")
     
-    Formato richiesto:
-    {{
-        "company_name": "Nome Azienda S.p.A.",
-        "fiscal_year": "2023", 
-        "currency": "EUR",
-        "document_type": "Relazione Annuale"
-    }}
+    # Identificazione ed estrazione in un'unica chiamata
+    if doc['combined']:
+        with st.expander(f"🔗 Debug Chiamata Unica: {pdf_source['name']}", expanded=False):
+            st.write(f"**Metriche richieste**: {', '.join(doc['ai_metrics'])}")
+            st.write(f"**Pagine inviate**: {', '.join(map(str, doc['financial_pages']))} (~{estimate_tokens(doc['financial_text'] or '')} token)")
+            st.write("**Risposta completa dell'AI:**")
+            if doc['financial_response']:
+                st.text(doc['financial_response'])
+            else:
+                st.error("Nessuna risposta ricevuta")
+        with st.expander(f"💱 Debug JSON Parsing: {pdf_source['name']}", expanded=False):
+            if doc['company_info']:
+                st.json(doc['company_info'])
+            if doc['financial_data']:
+                st.json(doc['financial_data'])
+            if not doc['company_info'] and not doc['financial_data']:
+                st.error("Impossibile estrarre JSON valido dalla risposta")
+        return
     
-    Cerca nel documento:
-    1. Nome dell'azienda (nome legale completo)
-    2. Anno fiscale o periodo coperto
-    3. Valuta utilizzata nei bilanci
-    4. Tipo di documento (relazione annuale, bilancio, ecc.)
+    if doc['company_source'] in ('local', 'store'):
+        source_label = "Locale" if doc['company_source'] == 'local' else "da Risultati Salvati"
+        with st.expander(f"🏢 Debug Identificazione {source_label}: {pdf_source['name']}", expanded=False):
+            st.json(doc['company_info'])
+    else:
+        show_identification_debug(doc)
     
-    Testo del documento (primi 3000 caratteri):
-    {pdf_text[:3000]}
-    """
+    company_info = doc['company_info']
+    if not company_info or not doc['ai_metrics']:
+        return
     
-    return call_openrouter_api(prompt)
+    # Debug: Risposta estrazione finanziaria
+    company_name = doc['company_name']
+    financial_response = doc['financial_response']
+    with st.expander(f"💰 Debug Estrazione Finanziaria: {company_name}", expanded=False):
+        st.write("**Prompt inviato all'AI:**")
+        metrics_str = ", ".join(doc['ai_metrics'])
+        prompt_preview = f"""
+Sei un analista finanziario. Ricevi il testo di un documento finanziario, seguito da una richiesta.
 
-# Funzione per estrarre dati finanziari
-def extract_financial_data(pdf_text, company_info, metrics):
-    metrics_str = ", ".join(metrics)
-    
-    prompt = f"""
-    Estrai le metriche finanziarie richieste da questo documento.
-    
-    IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo o spiegazioni.
-    
-    Azienda: {company_info.get('company_name', 'azienda')}
-    Anno fiscale: {company_info.get('fiscal_year', 'sconosciuto')}
-    Metriche da estrarre: {metrics_str}
+IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo o spiegazioni.
+
+Testo del documento (pagine più rilevanti):
+{doc['financial_text'][:200]}...[TRONCATO]
+
+Richiesta: estrai le metriche finanziarie richieste dal documento.
+
+Azienda: {company_name}
+Anno fiscale: {company_info.get('fiscal_year', 'sconosciuto')}
+Metriche da estrarre: {metrics_str}
+        """
+        st.code(prompt_preview, language="text")
+        st.write(f"**Pagine inviate**: {', '.join(map(str, doc['financial_pages']))} (~{estimate_tokens(doc['financial_text'])} token)")
+        for position, chunk in enumerate(doc['financial_chunks']):
+            found = ', '.join(chunk['data']) if chunk['data'] else "nessuna metrica"
+            st.write(f"**Blocco {position + 1}/{len(doc['financial_chunks'])}** (pagine {', '.join(map(str, chunk['pages']))}): {found}")
+        
+        st.write("**Risposta completa dell'AI:**")
+        if financial_response:
+            st.text(financial_response)
+        else:
+            st.error("Nessuna risposta ricevuta")
     
-    Formato richiesto:
-    {{
-        "Ricavi/Vendite": {{"value": 123456789, "unit": "milioni"}},
-        "EBITDA": {{"value": 23456789, "unit": "milioni"}},
-        "EBIT": {{"value": 20000000, "unit": "milioni"}},
-        "PFN (Posizione Finanziaria Netta)": {{"value": 15000000, "unit": "milioni"}}
-    }}
+    # Debug: Parsing JSON finanziario
+    financial_data = doc['financial_data']
+    with st.expander(f"💱 Debug JSON Parsing Finanziario: {company_name}", expanded=False):
+        st.write("**JSON estratto:**")
+        if financial_data:
+            st.json(financial_data)
+        else:
+            st.error("Impossibile estrarre JSON valido dalla risposta")
+
+# Funzione per mostrare il debug dell'identificazione azienda tramite AI
+def show_identification_debug(doc):
+    pdf_source = doc['source']
     
-    Regole specifiche:
-    - Converti tutti i valori nella stessa unità (preferibilmente milioni)
-    - Se una metrica non viene trovata direttamente, CALCOLALA dai dati disponibili:
-      * EBITDA = EBIT + Ammortamenti (ammort. immateriali + ammort. materiali)
-      * EBIT = Risultato operativo (A-B nel conto economico italiano)
-      * PFN = Debiti verso banche - Disponibilità liquide - Titoli facilmente liquidabili
-      * Se PFN è negativo = posizione di liquidità netta (bene per l'azienda)
-    - Per i rapporti, usa il formato decimale (es. 0.25 per 25%)
-    - Cerca in tutto il documento, non solo all'inizio
-    - Identifica voci come "Ricavi delle vendite", "TOTALE VALORE DELLA PRODUZIONE", "TOTALE COSTI DELLA PRODUZIONE"
-    - Per ammortamenti cerca "AMM.TO" o "ammortamenti"
-    - Per debiti bancari cerca "Debiti verso banche"
-    - Per liquidità cerca "Disponibilità liquide" o "Depositi bancari"
+    # Debug: Risposta identificazione azienda
+    company_response = doc['company_response']
+    with st.expander(f"🏢 Debug Identificazione Azienda: {pdf_source['name']}", expanded=False):
+        st.write("**Prompt inviato all'AI:**")
+        prompt_preview = f"""
+Sei un analista finanziario. Ricevi il testo di un documento finanziario, seguito da una richiesta.
+
+IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo o spiegazioni.
+
+Testo del documento (pagine più rilevanti):
+{doc['identification_text'][:200]}...[TRONCATO]
+
+Richiesta: identifica l'azienda e il periodo del documento.
+
+Formato richiesto:
+{{
+    "company_name": "Nome Azienda S.p.A.",
+    "fiscal_year": "2023", 
+    "currency": "EUR",
+    "document_type": "Relazione Annuale"
+}}
+        """
+        st.code(prompt_preview, language="text")
+        st.write(f"**Pagine inviate**: {', '.join(map(str, doc['identification_pages']))} (~{estimate_tokens(doc['identification_text'])} token)")
+        
+        st.write("**Risposta completa dell'AI:**")
+        if company_response:
+            st.text(company_response)
+        else:
+            st.error("Nessuna risposta ricevuta")
     
-    Testo del documento (primi 20000 caratteri):
-    {pdf_text[:20000]}
-    """
+    if not company_response:
+        return
     
-    return call_openrouter_api(prompt)
+    # Debug: Parsing JSON azienda
+    company_info = doc['company_info']
+    with st.expander(f"🔧 Debug JSON Parsing Azienda: {pdf_source['name']}", expanded=False):
+        st.write("**JSON estratto:**")
+        if company_info:
+            st.json(company_info)
+        else:
+            st.error("Impossibile estrarre JSON valido dalla risposta")
 
 # Interfaccia principale dell'app
 st.header("📁 Carica Documenti")
@@ -267,171 +491,113 @@ if uploaded_files:
             "source": "upload"
         })
 
+# Esecuzione delle analisi in background: un runner per sessione, così l'analisi di un
+# utente non resta in coda dietro a quella di un altro
+def get_job_runner():
+    if 'job_runner' not in st.session_state:
+        st.session_state['job_runner'] = JobRunner()
+    return st.session_state['job_runner']
+
+# Intervallo di aggiornamento della pagina mentre un'analisi è in corso (secondi)
+JOB_POLL_SECONDS = 1.0
+
+# Oltre questo numero di aziende i risultati mostrano un riepilogo e un'azienda alla volta invece dei tab
+MAX_COMPANY_TABS = 12
+
 # Elaborazione documenti
 if pdf_sources and selected_metrics and openrouter_api_key:
     st.header("🔄 Elaborazione Documenti")
     
-    if st.button("🚀 Analizza Documenti Finanziari", type="primary"):
-        results = {}
-        
-        # Tracciamento progresso
-        total_docs = len(pdf_sources)
-        progress_bar = st.progress(0)
-        status_container = st.container()
+    current_job = st.session_state.get('analysis_job')
+    job_running = current_job is not None and not current_job.finished
+    if st.button("🚀 Analizza Documenti Finanziari", type="primary", disabled=job_running):
+        # Memoria ridotta: gli upload vengono copiati su disco e letti da lì con mmap
+        upload_dir = None
+        run_sources = pdf_sources
+        if low_memory:
+            upload_dir = tempfile.TemporaryDirectory(prefix="fpa-upload-")
+            run_sources = [
+                {**pdf_source, "content": spill_to_temp(pdf_source["content"], upload_dir.name)}
+                for pdf_source in pdf_sources
+            ]
         
-        # Container per debug (se abilitato)
-        if debug_mode:
-            debug_container = st.container()
-            debug_container.header("🐛 Debug Panel")
-        
-        for i, pdf_source in enumerate(pdf_sources):
-            with status_container:
-                st.write(f"📄 Elaborando: {pdf_source['name']}")
-            
-            # Debug: Informazioni documento
-            if debug_mode:
-                with debug_container:
-                    with st.expander(f"🔍 Debug: {pdf_source['name']}", expanded=False):
-                        st.write(f"**Nome file**: {pdf_source['name']}")
-                        st.write(f"**Sorgente**: File caricato")
-            
-            # Estrai testo dal PDF
-            pdf_text = extract_pdf_text(pdf_source['content'])
-            
-            # Debug: Testo estratto
-            if debug_mode and pdf_text:
-                with debug_container:
-                    with st.expander(f"📄 Testo estratto da {pdf_source['name']}", expanded=False):
-                        st.write(f"**Lunghezza testo**: {len(pdf_text)} caratteri")
-                        st.write(f"**Prime 1000 caratteri**:")
-                        st.text(pdf_text[:1000])
-                        st.write(f"**Ultime 500 caratteri**:")
-                        st.text(pdf_text[-500:])
-            
-            if pdf_text and len(pdf_text.strip()) > 100:  # Assicurati che ci sia testo significativo
-                # Passo 1: Identifica azienda e anno
-                with st.spinner(f"🔍 Identificando azienda per {pdf_source['name']}..."):
-                    company_response = identify_company_and_year(pdf_text)
-                
-                # Debug: Risposta identificazione azienda
-                if debug_mode:
-                    with debug_container:
-                        with st.expander(f"🏢 Debug Identificazione Azienda: {pdf_source['name']}", expanded=False):
-                            st.write("**Prompt inviato all'AI:**")
-                            prompt_preview = f"""
-Analizza questo documento finanziario e identifica le informazioni richieste.
-
-IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo.
-
-Formato richiesto:
-{{
-    "company_name": "Nome Azienda S.p.A.",
-    "fiscal_year": "2023", 
-    "currency": "EUR",
-    "document_type": "Relazione Annuale"
-}}
-
-Testo del documento (primi 3000 caratteri):
-{pdf_text[:200]}...[TRONCATO]
-                            """
-                            st.code(prompt_preview, language="text")
-                            
-                            st.write("**Risposta completa dell'AI:**")
-                            if company_response:
-                                st.text(company_response)
-                            else:
-                                st.error("Nessuna risposta ricevuta")
-                
-                if company_response:
-                    # Prova a estrarre JSON dalla risposta
-                    company_info = extract_json_from_response(company_response)
-                    
-                    # Debug: Parsing JSON azienda
-                    if debug_mode:
-                        with debug_container:
-                            with st.expander(f"🔧 Debug JSON Parsing Azienda: {pdf_source['name']}", expanded=False):
-                                st.write("**JSON estratto:**")
-                                if company_info:
-                                    st.json(company_info)
-                                else:
-                                    st.error("Impossibile estrarre JSON valido dalla risposta")
-                    
-                    if company_info:
-                        company_name = company_info.get('company_name', f'Azienda Sconosciuta {i+1}')
-                        
-                        # Passo 2: Estrai dati finanziari
-                        with st.spinner(f"💰 Estraendo dati finanziari per {company_name}..."):
-                            financial_response = extract_financial_data(pdf_text, company_info, selected_metrics)
-                        
-                        # Debug: Risposta estrazione finanziaria
-                        if debug_mode:
-                            with debug_container:
-                                with st.expander(f"💰 Debug Estrazione Finanziaria: {company_name}", expanded=False):
-                                    st.write("**Prompt inviato all'AI:**")
-                                    metrics_str = ", ".join(selected_metrics)
-                                    prompt_preview = f"""
-Estrai le metriche finanziarie richieste da questo documento.
+        # L'analisi prosegue in background: le esecuzioni successive dello script la ritrovano in session_state
+        st.session_state['analysis_job'] = get_job_runner().submit(AnalysisJob(
+            analyzer,
+            run_sources,
+            selected_metrics,
+            keep_details=debug_mode,
+            on_finish=upload_dir.cleanup if upload_dir is not None else None
+        ))
 
-IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo o spiegazioni.
+elif pdf_sources and selected_metrics and not openrouter_api_key:
+    st.warning("⚠️ Inserisci la tua chiave API OpenRouter nella barra laterale per procedere con l'analisi.")
 
-Azienda: {company_name}
-Anno fiscale: {company_info.get('fiscal_year', 'sconosciuto')}
-Metriche da estrarre: {metrics_str}
+elif pdf_sources and not selected_metrics:
+    st.warning("⚠️ Seleziona almeno una metrica finanziaria da estrarre.")
 
-Testo del documento (primi 8000 caratteri):
-{pdf_text[:200]}...[TRONCATO]
-                                    """
-                                    st.code(prompt_preview, language="text")
-                                    
-                                    st.write("**Risposta completa dell'AI:**")
-                                    if financial_response:
-                                        st.text(financial_response)
-                                    else:
-                                        st.error("Nessuna risposta ricevuta")
-                        
-                        if financial_response:
-                            financial_data = extract_json_from_response(financial_response)
-                            
-                            # Debug: Parsing JSON finanziario
-                            if debug_mode:
-                                with debug_container:
-                                    with st.expander(f"💱 Debug JSON Parsing Finanziario: {company_name}", expanded=False):
-                                        st.write("**JSON estratto:**")
-                                        if financial_data:
-                                            st.json(financial_data)
-                                        else:
-                                            st.error("Impossibile estrarre JSON valido dalla risposta")
-                            
-                            if financial_data:
-                                # Memorizza risultati
-                                if company_name not in results:
-                                    results[company_name] = {}
-                                
-                                fiscal_year = company_info.get('fiscal_year', 'Sconosciuto')
-                                results[company_name][fiscal_year] = {
-                                    'company_info': company_info,
-                                    'financial_data': financial_data,
-                                    'source': pdf_source
-                                }
-                                
-                                st.success(f"✅ Completato: {pdf_source['name']} - {company_name}")
-                            else:
-                                st.error(f"❌ Impossibile estrarre dati finanziari validi per {pdf_source['name']}")
-                        else:
-                            st.error(f"❌ Nessuna risposta dall'AI per l'estrazione finanziaria di {pdf_source['name']}")
-                    else:
-                        st.error(f"❌ Impossibile identificare l'azienda per {pdf_source['name']}")
-                else:
-                    st.error(f"❌ Nessuna risposta dall'AI per l'identificazione azienda di {pdf_source['name']}")
-            else:
-                st.error(f"❌ Impossibile estrarre testo significativo da {pdf_source['name']}")
-                if pdf_text and debug_mode:
-                    with debug_container:
-                        with st.expander(f"⚠️ Debug Testo Insufficiente: {pdf_source['name']}", expanded=True):
-                            st.write(f"**Testo estratto ({len(pdf_text)} caratteri):**")
-                            st.text(pdf_text[:500] if pdf_text else "Nessun testo estratto")
-            
-            progress_bar.progress((i + 1) / total_docs)
+# Analisi in corso o completata: lo stato viene letto dal job a ogni esecuzione dello script
+job = st.session_state.get('analysis_job')
+if job is not None:
+    progress = job.progress()
+    documents = progress['documents']
+    metrics = job.metrics
+    total_docs = progress['total']
+    
+    # Tracciamento progresso
+    st.progress(progress['completed'] / total_docs if total_docs else 1.0)
+    if progress['state'] == 'queued':
+        st.info("⏳ Analisi in coda: partirà al termine di quella in corso")
+    elif progress['state'] == 'running':
+        if job.cancel_requested:
+            st.info("⏹️ Annullamento in corso: i documenti già avviati vengono completati")
+        elif st.button("⏹️ Annulla analisi"):
+            job.cancel()
+            st.rerun()
+    elif progress['state'] == 'cancelled':
+        st.warning(f"⏹️ Analisi annullata: {progress['completed']} documenti su {total_docs} completati")
+    elif progress['state'] == 'failed':
+        st.error(f"❌ Analisi interrotta: {progress['error']}")
+    
+    # Stato per documento, con le metriche già disponibili per quelli in corso
+    for index, name in enumerate(job.names):
+        doc = documents[index]
+        status_message = progress['status_messages'][index]
+        partial_metrics = progress['partial_metrics'][index]
+        if doc is not None:
+            if doc['duplicate']:
+                st.info(f"⏭️ Saltato: {name} - {describe_duplicate(doc['duplicate'])}")
+            elif doc['financial_data']:
+                st.success(f"✅ Completato: {name} - {doc['company_name']}")
+            for error in doc['errors']:
+                st.error(error)
+        elif status_message or partial_metrics:
+            if status_message:
+                st.write(status_message)
+            if partial_metrics:
+                st.caption(" · ".join(
+                    f"{metric}: {value.get('value')} {value.get('unit') or ''}".strip()
+                    for metric, value in partial_metrics.items()
+                ))
+        elif job.finished:
+            st.write(f"⏹️ Non elaborato: {name}")
+        else:
+            st.write(f"⏳ In coda: {name}")
+    
+    # Container per debug (se abilitato)
+    if debug_mode:
+        debug_container = st.container()
+        debug_container.header("🐛 Debug Panel")
+        with debug_container:
+            if not job.keep_details:
+                st.info("Dettagli per documento non disponibili: attiva la modalità debug prima di avviare l'analisi")
+            for detail in progress['details']:
+                if detail is not None:
+                    show_document_debug(detail, metrics)
+    
+    if job.finished:
+        # Memorizza risultati nell'ordine di caricamento
+        results = collect_results(documents)
         
         # Debug: Riepilogo finale
         if debug_mode:
@@ -440,7 +606,8 @@ Testo del documento (primi 8000 caratteri):
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
-                    st.metric("📄 Documenti processati", total_docs)
+                    duplicates = sum(1 for doc in documents if doc and doc['duplicate'])
+                    st.metric("📄 Documenti processati", total_docs, help=f"{duplicates} duplicati saltati")
                 
                 with col2:
                     successful_companies = len(results)
@@ -450,6 +617,84 @@ Testo del documento (primi 8000 caratteri):
                     total_extractions = sum(len(years) for years in results.values())
                     st.metric("💰 Estrazioni completate", total_extractions)
                 
+                # Statistiche cache risposte per questa esecuzione
+                cache_stats = response_cache.stats()
+                cache_before = job.cache_stats_before or cache_stats
+                cache_after = job.cache_stats_after or cache_stats
+                col1, col2, col3 = st.columns(3)
+                
+                with col1:
+                    st.metric("🎯 Cache hit", cache_after['hits'] - cache_before['hits'])
+                
+                with col2:
+                    st.metric("🌐 Cache miss", cache_after['misses'] - cache_before['misses'])
+                
+                with col3:
+                    st.metric("🗄️ Voci in cache", cache_stats['entries'], help=f"{cache_stats['size_bytes'] / 1024:.0f} KB su disco")
+                
+                # Statistiche richieste HTTP per questa esecuzione
+                request_stats = job.request_stats or openrouter_client.request_stats(since=job.submitted_at)
+                col1, col2, col3 = st.columns(3)
+                
+                with col1:
+                    st.metric("🌐 Richieste API", request_stats['requests'], help=f"{request_stats['failures']} fallite")
+                
+                with col2:
+                    st.metric("🔁 Ritentativi", request_stats['retries'])
+                
+                with col3:
+                    st.metric("⏱️ Latenza media", f"{request_stats['avg_latency']:.1f} s", help=f"p95: {request_stats['p95_latency']:.1f} s")
+
+                # Cascata di modelli: quante risposte del modello veloce sono state ripetute
+                escalations = escalation_stats([doc for doc in documents if doc])
+                if escalations['documents']:
+                    col1, col2, col3 = st.columns(3)
+                    
+                    with col1:
+                        st.metric("🪜 Documenti escalati", f"{escalations['documents_rate']:.0%}", help=f"{escalations['escalated_documents']} su {escalations['documents']}")
+                    
+                    with col2:
+                        st.metric("🏢 Identificazioni escalate", f"{escalations['identifications_rate']:.0%}", help=f"{escalations['escalated_identifications']} su {escalations['identifications']}")
+                    
+                    with col3:
+                        st.metric("📐 Metriche escalate", f"{escalations['metrics_rate']:.0%}", help=f"{escalations['escalated_metrics']} su {escalations['metrics']}")
+
+                # Tempi per fase, token e byte per documento
+                import pandas as pd
+
+                completed = [doc for doc in documents if doc]
+                col1, col2, col3 = st.columns(3)
+                
+                with col1:
+                    peak_rss = job.peak_rss_mb
+                    st.metric("🧠 Picco memoria (RSS)", f"{peak_rss} MB" if peak_rss is not None else "n/d", help="Massimo dall'avvio del processo Streamlit, processi di estrazione inclusi")
+                
+                with col2:
+                    st.metric("📑 Pagine elaborate", sum(doc['page_count'] for doc in completed))
+                
+                with col3:
+                    st.metric("💾 PDF elaborati", f"{sum(doc['pdf_bytes'] for doc in completed) / (1024 * 1024):.1f} MB")
+
+                st.write("**⏱️ Telemetria per documento:**")
+                st.dataframe(pd.DataFrame([document_telemetry(doc) for doc in completed]), use_container_width=True)
+
+                run_stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button(
+                        label="📥 Telemetria JSON",
+                        data=telemetry_json(completed),
+                        file_name=f"telemetria_{run_stamp}.json",
+                        mime="application/json"
+                    )
+                with col2:
+                    st.download_button(
+                        label="📥 Metriche Prometheus",
+                        data=prometheus_text(completed),
+                        file_name=f"telemetria_{run_stamp}.prom",
+                        mime="text/plain"
+                    )
+
                 if results:
                     st.write("**Dettagli risultati:**")
                     for company, years_data in results.items():
@@ -460,129 +705,114 @@ Testo del documento (primi 8000 caratteri):
         
         # Visualizza risultati
         if results:
-            st.header("📊 Risultati Analisi")
+            # Import ritardati: pandas e plotly servono solo per i risultati
+            from financial_analyzer.results_frame import (
+                results_frame, company_table, company_chart_data, summary_frame,
+                unrecognized_units, export_csv, export_excel, export_parquet, parquet_unavailable_reason,
+                RATIO_METRICS, DISPLAY_UNIT
+            )
+            import plotly.graph_objects as go
             
-            # Crea tab per ogni azienda
-            company_names = list(results.keys())
-            tabs = st.tabs(company_names)
+            # Frame dei risultati costruito una volta per analisi; le esportazioni solo quando richieste
+            cached = st.session_state.get('results_view')
+            if cached is None or cached['job'] != job.id:
+                cached = {'job': job.id, 'frame': results_frame(results, metrics), 'exports': {}}
+                st.session_state['results_view'] = cached
+            frame = cached['frame']
             
-            for tab, company_name in zip(tabs, company_names):
-                with tab:
-                    st.subheader(f"📈 {company_name}")
-                    
-                    # Ottieni anni per questa azienda
-                    years_data = results[company_name]
-                    years = sorted(years_data.keys())
-                    
-                    # Crea DataFrame per visualizzazione
-                    df_data = []
-                    for year in years:
-                        row = {'Anno': year}
-                        financial_data = years_data[year]['financial_data']
-                        
-                        for metric in selected_metrics:
-                            if metric in financial_data:
-                                value = financial_data[metric].get('value')
-                                unit = financial_data[metric].get('unit', '')
-                                row[metric] = f"{value} {unit}" if value else "N/D"
-                            else:
-                                row[metric] = "N/D"
-                        
-                        df_data.append(row)
+            st.header("📊 Risultati Analisi")
+            st.caption(f"Importi in {DISPLAY_UNIT} nella valuta del documento, convertiti secondo l'unità riportata; i rapporti restano invariati")
+            unknown_units = unrecognized_units(frame)
+            if unknown_units:
+                st.warning(f"⚠️ Unità non riconosciute, valori esclusi da tabelle e grafici: {', '.join(unknown_units)}")
+            
+            def show_company_results(company_name):
+                st.subheader(f"📈 {company_name}")
+                
+                # Tabella: una riga per anno, una colonna per metrica
+                table = company_table(frame, company_name, metrics)
+                st.dataframe(table.style.format(precision=2, na_rep="N/D"), use_container_width=True)
+                
+                # Grafico a linee se ci sono almeno due anni confrontabili
+                chart = company_chart_data(frame, company_name)
+                if len(chart) > 1:
+                    fig = go.Figure()
+                    for metric in chart.columns:
+                        fig.add_trace(go.Scatter(
+                            x=chart.index.astype(int),
+                            y=chart[metric],
+                            mode='lines+markers',
+                            name=metric,
+                            line=dict(width=3),
+                            marker=dict(size=8),
+                            # I rapporti hanno un asse proprio
+                            yaxis='y2' if metric in RATIO_METRICS else 'y'
+                        ))
                     
-                    # Visualizza tabella
-                    if df_data:
-                        df = pd.DataFrame(df_data)
-                        st.dataframe(df, use_container_width=True)
-                        
-                        # Crea grafici per metriche numeriche
-                        numeric_data = []
-                        for year in years:
-                            row = {'Anno': int(year) if year.isdigit() else year}
-                            financial_data = years_data[year]['financial_data']
-                            
-                            for metric in selected_metrics:
-                                if metric in financial_data:
-                                    value = financial_data[metric].get('value')
-                                    if value and isinstance(value, (int, float)):
-                                        row[metric] = value
-                            
-                            if len(row) > 1:  # Più del solo anno
-                                numeric_data.append(row)
-                        
-                        # Disegna grafici se abbiamo dati numerici
-                        if len(numeric_data) > 1:
-                            df_numeric = pd.DataFrame(numeric_data)
-                            
-                            # Crea grafico a linee
-                            fig = go.Figure()
-                            
-                            for metric in selected_metrics:
-                                if metric in df_numeric.columns:
-                                    fig.add_trace(go.Scatter(
-                                        x=df_numeric['Anno'],
-                                        y=df_numeric[metric],
-                                        mode='lines+markers',
-                                        name=metric,
-                                        line=dict(width=3),
-                                        marker=dict(size=8)
-                                    ))
-                            
-                            fig.update_layout(
-                                title=f"{company_name} - Trend Finanziari",
-                                xaxis_title="Anno",
-                                yaxis_title="Valore (Milioni)",
-                                hovermode='x unified'
-                            )
-                            
-                            st.plotly_chart(fig, use_container_width=True)
+                    fig.update_layout(
+                        title=f"{company_name} - Trend Finanziari",
+                        xaxis_title="Anno",
+                        yaxis_title=f"Valore ({DISPLAY_UNIT.capitalize()})",
+                        hovermode='x unified'
+                    )
+                    if any(metric in RATIO_METRICS for metric in chart.columns):
+                        fig.update_layout(yaxis2=dict(title="Rapporto", overlaying='y', side='right', showgrid=False))
+                    fig.update_xaxes(dtick=1)
                     
-                    # Informazioni sulle fonti
-                    st.write("**Fonti Documenti:**")
-                    for year, data in years_data.items():
-                        source_info = data['source']
-                        st.write(f"- {year}: {source_info['name']} (caricato)")
+                    st.plotly_chart(fig, use_container_width=True)
+                
+                # Informazioni sulle fonti
+                st.write("**Fonti Documenti:**")
+                company_rows = frame[frame['company'] == company_name].drop_duplicates('fiscal_year')
+                for row in company_rows.itertuples(index=False):
+                    if row.comparative:
+                        st.write(f"- {row.fiscal_year}: {row.source} (colonna comparativa)")
+                    else:
+                        st.write(f"- {row.fiscal_year}: {row.source} (caricato)")
+                    if row.merged_sources:
+                        st.write(f"  - unito con {row.merged_sources}")
+            
+            # Poche aziende: un tab ciascuna; molte aziende: riepilogo e una sola azienda alla volta
+            company_names = [company for company in results if (frame['company'] == company).any()]
+            if len(company_names) <= MAX_COMPANY_TABS:
+                tabs = st.tabs(company_names)
+                for tab, company_name in zip(tabs, company_names):
+                    with tab:
+                        show_company_results(company_name)
+            elif company_names:
+                st.write(f"**Riepilogo ({len(company_names)} aziende):**")
+                st.dataframe(summary_frame(frame, metrics), use_container_width=True, hide_index=True)
+                selected_company = st.selectbox("🏢 Dettaglio azienda", company_names)
+                show_company_results(selected_company)
             
             # Funzionalità di esportazione
             st.header("💾 Esporta Risultati")
             
-            # Prepara dati per esportazione
-            export_data = []
-            for company_name, years_data in results.items():
-                for year, data in years_data.items():
-                    row = {
-                        'Azienda': company_name,
-                        'Anno': year,
-                        'Valuta': data['company_info'].get('currency', 'Sconosciuta')
-                    }
-                    
-                    financial_data = data['financial_data']
-                    for metric in selected_metrics:
-                        if metric in financial_data:
-                            row[metric] = financial_data[metric].get('value')
-                        else:
-                            row[metric] = None
-                    
-                    export_data.append(row)
-            
-            if export_data:
-                export_df = pd.DataFrame(export_data)
+            export_formats = {
+                "CSV (riepilogo)": ("csv", "text/csv", lambda: export_csv(frame, metrics)),
+                "Excel (riepilogo, dati e fonti)": (
+                    "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    lambda: export_excel(frame, metrics)
+                ),
+                "Parquet (formato lungo)": ("parquet", "application/octet-stream", lambda: export_parquet(frame)),
+            }
+            export_format = st.radio("Formato", list(export_formats), horizontal=True)
+            extension, mime, build_export = export_formats[export_format]
+            if extension == "parquet" and parquet_unavailable_reason():
+                st.warning(f"⚠️ Parquet non disponibile: {parquet_unavailable_reason()}")
+            elif not frame.empty:
+                # Il file viene generato al primo utilizzo del formato e riusato nelle esecuzioni successive
+                if extension not in cached['exports']:
+                    cached['exports'][extension] = build_export()
                 
                 # Pulsante di download
-                csv = export_df.to_csv(index=False)
                 st.download_button(
-                    label="📥 Scarica Risultati come CSV",
-                    data=csv,
-                    file_name=f"analisi_finanziaria_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                    mime="text/csv"
+                    label=f"📥 Scarica Risultati ({extension.upper()})",
+                    data=cached['exports'][extension],
+                    file_name=f"analisi_finanziaria_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}",
+                    mime=mime
                 )
 
-elif pdf_sources and selected_metrics and not openrouter_api_key:
-    st.warning("⚠️ Inserisci la tua chiave API OpenRouter nella barra laterale per procedere con l'analisi.")
-
-elif pdf_sources and not selected_metrics:
-    st.warning("⚠️ Seleziona almeno una metrica finanziaria da estrarre.")
-
 # Sezione informativa
 with st.expander("ℹ️ Come utilizzare l'applicazione"):
     st.markdown("""
@@ -594,7 +824,7 @@ with st.expander("ℹ️ Come utilizzare l'applicazione"):
     4. **Carica Documenti**: Upload dei file PDF
     5. **Analizza**: Clicca "Analizza Documenti Finanziari"
     6. **Visualizza**: Esplora i risultati per azienda
-    7. **Esporta**: Scarica i dati in formato CSV
+    7. **Esporta**: Scarica i dati in formato CSV, Excel o Parquet
     
     ### 📋 Requisiti Documenti:
     - **Formato**: PDF di relazioni finanziarie, bilanci, report annuali
@@ -604,9 +834,16 @@ with st.expander("ℹ️ Come utilizzare l'applicazione"):
     ### 🔒 Privacy e Sicurezza:
     - Le chiavi API sono gestite localmente e non memorizzate
     - I documenti sono processati temporaneamente e non salvati
+    - Il testo estratto e le risposte dell'AI sono memorizzati in una cache locale (svuotabile dalla barra laterale)
+    - Le metriche estratte sono salvate in un archivio locale (cancellabile dalla barra laterale)
     - Tutti i dati rimangono privati durante l'analisi
     """)
 
 # Footer
 st.markdown("---")
-st.markdown("📊 Financial PDF Analyzer")
\ No newline at end of file
+st.markdown("📊 Financial PDF Analyzer")
+
+# Analisi in background ancora in corso: la pagina si aggiorna finché non termina
+if job is not None and not job.finished:
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
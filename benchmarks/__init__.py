@@ -0,0 +1 @@
+"""Benchmark della pipeline con PDF sintetici e un server OpenRouter simulato."""
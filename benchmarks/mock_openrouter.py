@@ -0,0 +1,224 @@
+"""Server HTTP locale che imita https://openrouter.ai/api/v1/chat/completions.
+
+Risponde con JSON predefiniti (identificazione azienda o metriche richieste),
+con latenza, tasso di errore e tasso di risposte JSON difettose configurabili. Simula anche la cache dei prompt:
+i prefissi marcati con cache_control già visti vengono riportati in
+usage.prompt_tokens_details.cached_tokens. Utilizzabile da riga di comando:
+
+    python -m benchmarks.mock_openrouter --port 8765 --latency 0.5 --error-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPANY_RE = re.compile(r"Azienda Sintetica \d+ (?:S\.p\.A\.|Ltd)")
+YEAR_RE = re.compile(r"\b(20\d\d)\b")
+METRICS_RE = re.compile(r"Metriche da estrarre:\s*(.+)")
+VALUE_RE = re.compile(r'("value": )(\d+)\.(\d+)')
+
+
+def canned_content(prompt, rng):
+    """Contenuto della risposta simulata in base al tipo di prompt."""
+    company = COMPANY_RE.search(prompt)
+    year = YEAR_RE.search(prompt)
+    identification = {
+        "company_name": company.group(0) if company else "Azienda Simulata S.p.A.",
+        "fiscal_year": year.group(1) if year else "2023",
+        "currency": "EUR",
+        "document_type": "Bilancio"
+    }
+    metrics_match = METRICS_RE.search(prompt)
+    if not metrics_match:
+        return json.dumps(identification)
+    metrics = [metric.strip() for metric in metrics_match.group(1).split(", ") if metric.strip()]
+    values = {metric: {"value": round(rng.uniform(1, 500), 2), "unit": "milioni"} for metric in metrics}
+    if "Risposta da correggere:" in prompt:
+        # Prompt di correzione: solo le metriche richieste, qualunque sia il contenuto della risposta
+        return json.dumps(values, ensure_ascii=False)
+    extra = {}
+    if '"prior_years"' in prompt:
+        # Più esercizi: i due anni precedenti a quello del documento
+        current = int(identification["fiscal_year"])
+        extra["prior_years"] = [
+            {"fiscal_year": str(current - offset),
+             "metrics": {metric: {"value": round(rng.uniform(1, 500), 2), "unit": "milioni"} for metric in metrics}}
+            for offset in (1, 2)
+        ]
+    if '"company_name"' in prompt:
+        # Prompt unico: identificazione e metriche nella stessa risposta
+        return json.dumps({**identification, "metrics": values, **extra}, ensure_ascii=False)
+    return json.dumps({**values, **extra}, ensure_ascii=False)
+
+
+def malformed_content(content, rng):
+    """Risposta con un difetto tipico dei modelli: virgola finale, numeri all'italiana, troncamento o voce illeggibile."""
+    defect = rng.choice(["trailing_comma", "locale_numbers", "truncated", "unreadable"])
+    if defect == "trailing_comma":
+        return content[:-1] + ",}"
+    if defect == "locale_numbers":
+        return VALUE_RE.sub(r"\1\2,\3", content)
+    if defect == "truncated":
+        return content[:int(len(content) * 0.7)]
+    return VALUE_RE.sub(r"\1\2.\3 mln", content, count=1)
+
+
+class MockOpenRouterServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, latency_jitter=0.1, error_rate=0.0, malformed_rate=0.0, seed=0):
+        super().__init__(address, MockOpenRouterHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        # Impronte dei prefissi già scritti nella cache dei prompt simulata
+        self.cached_prefixes = set()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1/chat/completions"
+
+
+class MockOpenRouterHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt_parts = []
+        cached_prefix = None
+        for message in request.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                prompt_parts.append(content)
+                continue
+            # Contenuto a parti: il testo fino all'ultimo breakpoint cache_control è il prefisso riusabile
+            for part in content or []:
+                prompt_parts.append(part.get("text", ""))
+                if part.get("cache_control"):
+                    cached_prefix = "".join(prompt_parts)
+        prompt = "".join(prompt_parts)
+
+        cached_tokens = 0
+        with server.rng_lock:
+            server.requests += 1
+            if cached_prefix is not None:
+                key = (request.get("model"), hashlib.sha256(cached_prefix.encode("utf-8")).hexdigest())
+                if key in server.cached_prefixes:
+                    cached_tokens = len(cached_prefix) // 4
+                server.cached_prefixes.add(key)
+            delay = max(0.0, server.latency + server.rng.uniform(-server.latency_jitter, server.latency_jitter))
+            failure = server.rng.random() < server.error_rate
+            status = server.rng.choice([429, 500, 503]) if failure else 200
+            content = None if failure else canned_content(prompt, server.rng)
+            if content is not None and server.rng.random() < server.malformed_rate:
+                content = malformed_content(content, server.rng)
+            if failure:
+                server.errors += 1
+        if failure:
+            time.sleep(delay)
+            headers = {"Retry-After": "0"} if status == 429 else None
+            self._send_json(status, {"error": {"code": status, "message": "errore simulato"}}, headers)
+            return
+
+        prompt_tokens = len(prompt) // 4 + 1
+        completion_tokens = len(content) // 4 + 1
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+        if cached_tokens:
+            usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+        if request.get("stream"):
+            try:
+                self._send_stream(request, content, usage, delay)
+            except (BrokenPipeError, ConnectionResetError):
+                # Il client ha chiuso la connessione (es. timeout di inattività)
+                pass
+            return
+
+        time.sleep(delay)
+        self._send_json(200, {
+            "id": f"mock-{server.requests}",
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        })
+
+    def _send_stream(self, request, content, usage, delay, pieces=8):
+        # Metà della latenza prima del primo frammento, il resto distribuito sui frammenti
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(b": OPENROUTER PROCESSING\n\n")
+        self.wfile.flush()
+        time.sleep(delay / 2)
+        size = max(1, -(-len(content) // pieces))
+        for start in range(0, len(content), size):
+            event = {
+                "model": request.get("model"),
+                "choices": [{"index": 0, "delta": {"content": content[start:start + size]}}]
+            }
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(delay / 2 / pieces)
+        final = {"model": request.get("model"), "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                 "usage": usage}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+def start_mock_server(host="127.0.0.1", port=0, **options):
+    """Avvia il server in un thread in background e lo restituisce (server.url, server.shutdown())."""
+    server = MockOpenRouterServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server OpenRouter simulato per i benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="latenza media in secondi")
+    parser.add_argument("--latency-jitter", type=float, default=0.1, help="variazione massima della latenza")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="frazione di risposte 429/5xx")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="frazione di risposte con JSON difettoso")
+    args = parser.parse_args(argv)
+
+    server = MockOpenRouterServer(
+        (args.host, args.port), latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate
+    )
+    print(f"Server simulato in ascolto su {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Benchmark della pipeline: corpus PDF sintetico + server OpenRouter simulato.
+
+    python -m benchmarks.run --docs 40 --pages 200 --latency 0.5 --concurrency 8 --output bench.json
+
+Riporta i tempi per fase (estrazione PDF, costruzione prompt, API, parsing JSON),
+documenti al minuto, picco di memoria (RSS) e token inviati, in formato JSON
+confrontabile tra esecuzioni.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_openrouter import start_mock_server
+from benchmarks.synthetic_pdf import generate_corpus
+from financial_analyzer.openrouter_client import OpenRouterClient
+from financial_analyzer.pipeline import Analyzer, DEFAULT_METRICS, AVAILABLE_METRICS, compact_document
+from financial_analyzer.telemetry import STAGES, escalation_stats, peak_rss_mb
+
+
+def summarize(values):
+    if not values:
+        return {"total": 0.0, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    values = sorted(values)
+    return {
+        "total": round(sum(values), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "p50": round(values[len(values) // 2], 4),
+        "p95": round(values[int(0.95 * (len(values) - 1))], 4),
+        "max": round(values[-1], 4),
+    }
+
+
+def run_benchmark(args):
+    with tempfile.TemporaryDirectory(prefix="fpa-bench-") as workdir:
+        corpus_started = time.perf_counter()
+        paths = generate_corpus(os.path.join(workdir, "pdf"), args.docs, args.pages, args.language, args.seed)
+        corpus_seconds = time.perf_counter() - corpus_started
+
+        server = start_mock_server(
+            latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate, seed=args.seed
+        )
+        try:
+            client = OpenRouterClient(
+                requests_per_minute=args.requests_per_minute, url=server.url,
+                backoff_base=0.05, pool_size=max(args.concurrency, 10)
+            )
+            # Nessuna cache né archivio risultati: ogni esecuzione misura il percorso completo
+            analyzer = Analyzer(
+                "sk-benchmark-0000000000",
+                client=client,
+                use_local_extraction=not args.no_local,
+                chunked_extraction=args.chunked,
+                combined_extraction=args.combined,
+                cascade_model=args.cascade_model,
+                stream_responses=args.stream,
+                low_memory=args.low_memory,
+                multi_year=args.multi_year,
+                prompt_caching=args.prompt_cache,
+                text_cleanup=args.clean_text,
+                max_concurrent_requests=args.concurrency,
+                pdf_extraction_workers=args.pdf_workers
+            )
+            pdf_sources = [{"name": os.path.basename(path), "content": path, "source": "file"} for path in paths]
+
+            documents = []
+            started = time.perf_counter()
+            for event, index, doc in analyzer.iter_analysis(pdf_sources, args.metrics):
+                if event == "done":
+                    # Come la CLI: dei documenti completati resta solo il riepilogo
+                    documents.append(compact_document(doc))
+            wall_seconds = time.perf_counter() - started
+            request_stats = client.request_stats()
+        finally:
+            server.shutdown()
+
+    succeeded = sum(1 for doc in documents if doc["financial_data"])
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "docs": args.docs, "pages": args.pages, "language": args.language, "metrics": args.metrics,
+            "latency": args.latency, "latency_jitter": args.latency_jitter, "error_rate": args.error_rate,
+            "malformed_rate": args.malformed_rate,
+            "concurrency": args.concurrency, "pdf_workers": args.pdf_workers,
+            "requests_per_minute": args.requests_per_minute, "local_extraction": not args.no_local,
+            "chunked_extraction": args.chunked, "combined_extraction": args.combined,
+            "cascade_model": args.cascade_model, "stream": args.stream, "low_memory": args.low_memory,
+            "multi_year": args.multi_year, "prompt_cache": args.prompt_cache,
+            "clean_text": args.clean_text,
+        },
+        "corpus_generation_seconds": round(corpus_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "docs_per_minute": round(len(documents) / wall_seconds * 60, 2) if wall_seconds else None,
+        "documents": len(documents),
+        "succeeded": succeeded,
+        "failed": len(documents) - succeeded,
+        "stages": {
+            stage: summarize([doc["timings"][stage] for doc in documents if stage in doc["timings"]])
+            for stage in STAGES
+        },
+        "tokens_sent": sum(doc["tokens_sent"] for doc in documents),
+        "usage_tokens": {
+            "prompt": sum(call["prompt_tokens"] for doc in documents for call in doc["api_calls"]),
+            "completion": sum(call["completion_tokens"] for doc in documents for call in doc["api_calls"]),
+            "cached_prompt": sum(call["cached_tokens"] for doc in documents for call in doc["api_calls"]),
+        },
+        "api": {
+            "requests": request_stats["requests"],
+            "retries": request_stats["retries"],
+            "failures": request_stats["failures"],
+            "avg_latency": round(request_stats["avg_latency"], 4),
+            "p95_latency": round(request_stats["p95_latency"], 4),
+        },
+        "escalation": escalation_stats(documents) if args.cascade_model else None,
+        "json_repairs": {
+            "documents": sum(1 for doc in documents if doc["json_repairs"]),
+            "repair_calls": sum(1 for doc in documents for call in doc["api_calls"] if call["call"] == "json_repair"),
+        },
+        "text_cleanup": {
+            # Caratteri tolti dalle pagine effettivamente inviate: il budget dei prompt resta pieno,
+            # quindi non corrispondono a meno token inviati (vedi usage_tokens.prompt)
+            "prompt_chars_saved": sum(doc["text_cleanup"]["prompt_chars_saved"] for doc in documents if doc["text_cleanup"]),
+            "prompt_tokens_saved": sum(doc["text_cleanup"]["prompt_tokens_saved"] for doc in documents if doc["text_cleanup"]),
+            "document_chars_removed": sum(
+                doc["text_cleanup"]["document_chars_removed"] for doc in documents if doc["text_cleanup"]
+            ),
+        } if args.clean_text else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark della pipeline di analisi")
+    parser.add_argument("--docs", type=int, default=10, help="numero di documenti sintetici")
+    parser.add_argument("--pages", type=int, default=50, help="pagine per documento")
+    parser.add_argument("--language", choices=["it", "en", "mixed"], default="mixed")
+    parser.add_argument("--metrics", type=lambda value: [m.strip() for m in value.split(",")],
+                        default=list(DEFAULT_METRICS), help="metriche separate da virgola")
+    parser.add_argument("--latency", type=float, default=0.2, help="latenza media del server simulato (s)")
+    parser.add_argument("--latency-jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="frazione di risposte 429/5xx simulate")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="frazione di risposte con JSON difettoso (virgole finali, numeri all'italiana, troncamenti)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--pdf-workers", type=int, default=1)
+    parser.add_argument("--requests-per-minute", type=int, default=6000)
+    parser.add_argument("--no-local", action="store_true", help="disattiva l'estrazione locale (schema CEE)")
+    parser.add_argument("--chunked", action="store_true", help="estrazione a blocchi in parallelo")
+    parser.add_argument("--combined", action="store_true", help="azienda e metriche in un'unica chiamata")
+    parser.add_argument("--cascade-model", default=None, help="modello veloce per il primo passaggio della cascata")
+    parser.add_argument("--stream", action="store_true", help="risposte in streaming (SSE)")
+    parser.add_argument("--low-memory", action="store_true", help="PDF mappati da disco e pagine lette una alla volta")
+    parser.add_argument("--multi-year", action="store_true", help="anche gli esercizi precedenti (colonne comparative)")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="prefisso comune delle chiamate marcato per la cache dei prompt del provider")
+    parser.add_argument("--clean-text", action="store_true",
+                        help="pulizia del testo dei prompt (righe ripetute ai margini, riempimenti, spazi)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default=None, help="file JSON dei risultati (predefinito: stdout)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    unknown = [m for m in args.metrics if m not in AVAILABLE_METRICS]
+    if unknown:
+        print(f"Metriche non riconosciute: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    report = run_benchmark(args)
+    payload = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+    print(
+        f"{report['documents']} documenti in {report['wall_seconds']} s "
+        f"({report['docs_per_minute']} doc/min), {report['tokens_sent']} token inviati, "
+        f"picco RSS {report['peak_rss_mb']} MB",
+        file=sys.stderr
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
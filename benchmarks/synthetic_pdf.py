@@ -0,0 +1,174 @@
+"""Generatore di bilanci PDF sintetici (italiano o inglese), senza dipendenze esterne.
+
+Ogni documento ha una copertina, pagine di relazione con testo generico e i
+prospetti (stato patrimoniale e conto economico) collocati verso la fine, come
+nei bilanci reali.
+"""
+import os
+import random
+
+FILLER_IT = (
+    "La società ha proseguito nel corso dell'esercizio lo sviluppo delle proprie attività "
+    "caratteristiche, con particolare attenzione al contenimento dei costi operativi e al "
+    "rafforzamento della struttura patrimoniale. Gli amministratori ritengono che le prospettive "
+    "per il prossimo esercizio siano positive, pur in un contesto di mercato incerto."
+)
+FILLER_EN = (
+    "During the year the company continued to develop its core business, with particular focus "
+    "on operating cost control and on strengthening its financial position. The directors "
+    "believe the outlook for the next financial year is positive despite an uncertain market."
+)
+
+LINES_PER_PAGE = 60
+
+
+def _fmt(value):
+    # Formato italiano con separatore delle migliaia
+    return f"{value:,}".replace(",", ".")
+
+
+def statement_lines(language, figures):
+    """Righe dei prospetti di bilancio con esercizio corrente e precedente."""
+    f = figures
+    prior = {key: int(value * 0.93) for key, value in figures.items()}
+    if language == "it":
+        return [
+            "STATO PATRIMONIALE",
+            f"IV - Disponibilità liquide {_fmt(f['cash'])} {_fmt(prior['cash'])}",
+            f"Totale disponibilità liquide {_fmt(f['cash'])} {_fmt(prior['cash'])}",
+            f"Totale attivo {_fmt(f['assets'])} {_fmt(prior['assets'])}",
+            f"Totale patrimonio netto {_fmt(f['equity'])} {_fmt(prior['equity'])}",
+            f"4) debiti verso banche {_fmt(f['bank_debt'])} {_fmt(prior['bank_debt'])}",
+            f"Totale debiti {_fmt(f['debt'])} {_fmt(prior['debt'])}",
+            f"Totale passivo {_fmt(f['assets'])} {_fmt(prior['assets'])}",
+            "CONTO ECONOMICO",
+            f"1) ricavi delle vendite e delle prestazioni {_fmt(f['revenue'])} {_fmt(prior['revenue'])}",
+            f"Totale valore della produzione {_fmt(f['revenue'])} {_fmt(prior['revenue'])}",
+            f"a) ammortamento delle immobilizzazioni immateriali {_fmt(f['amm_imm'])} {_fmt(prior['amm_imm'])}",
+            f"b) ammortamento delle immobilizzazioni materiali {_fmt(f['amm_mat'])} {_fmt(prior['amm_mat'])}",
+            f"Totale costi della produzione {_fmt(f['costs'])} {_fmt(prior['costs'])}",
+            f"Differenza tra valore e costi della produzione (A - B) {_fmt(f['ebit'])} {_fmt(prior['ebit'])}",
+            f"21) Utile (perdita) dell'esercizio {_fmt(f['net_income'])} {_fmt(prior['net_income'])}",
+        ]
+    return [
+        "BALANCE SHEET",
+        f"Cash and cash equivalents {_fmt(f['cash'])} {_fmt(prior['cash'])}",
+        f"Total assets {_fmt(f['assets'])} {_fmt(prior['assets'])}",
+        f"Total equity {_fmt(f['equity'])} {_fmt(prior['equity'])}",
+        f"Bank borrowings {_fmt(f['bank_debt'])} {_fmt(prior['bank_debt'])}",
+        "INCOME STATEMENT",
+        f"Revenue {_fmt(f['revenue'])} {_fmt(prior['revenue'])}",
+        f"Depreciation and amortisation {_fmt(f['amm_imm'] + f['amm_mat'])}",
+        f"Operating income {_fmt(f['ebit'])} {_fmt(prior['ebit'])}",
+        f"Net income {_fmt(f['net_income'])} {_fmt(prior['net_income'])}",
+    ]
+
+
+def random_figures(rng):
+    revenue = rng.randint(5_000_000, 500_000_000)
+    costs = int(revenue * rng.uniform(0.8, 0.97))
+    assets = int(revenue * rng.uniform(0.6, 1.5))
+    equity = int(assets * rng.uniform(0.2, 0.5))
+    return {
+        "revenue": revenue,
+        "costs": costs,
+        "ebit": revenue - costs,
+        "amm_imm": int(revenue * rng.uniform(0.005, 0.02)),
+        "amm_mat": int(revenue * rng.uniform(0.01, 0.04)),
+        "cash": int(assets * rng.uniform(0.02, 0.15)),
+        "bank_debt": int(assets * rng.uniform(0.05, 0.3)),
+        "assets": assets,
+        "equity": equity,
+        "debt": assets - equity,
+        "net_income": int((revenue - costs) * rng.uniform(0.5, 0.75)),
+    }
+
+
+def document_pages(company, year, pages, language, rng):
+    """Testo (lista di righe) di ogni pagina del documento sintetico."""
+    figures = random_figures(rng)
+    if language == "it":
+        cover = [company, f"Sede in Via Roma {rng.randint(1, 200)} - Milano",
+                 "Capitale sociale euro 1.000.000 i.v.", f"Bilancio al 31/12/{year}",
+                 "Importi in euro"]
+        header, filler = f"{company} - Bilancio {year}", FILLER_IT
+    else:
+        cover = [company, f"Annual Report {year}", "Amounts in euro"]
+        header, filler = f"{company} - Annual Report {year}", FILLER_EN
+
+    statements = statement_lines(language, figures)
+    statement_page = max(1, int(pages * 0.7))
+    result = []
+    for number in range(pages):
+        if number == 0:
+            lines = list(cover)
+        elif number == statement_page:
+            lines = [header] + statements
+        else:
+            lines = [header]
+            words = filler.split()
+            while len(lines) < LINES_PER_PAGE - 1:
+                start = rng.randrange(len(words))
+                lines.append(" ".join((words * 2)[start:start + 14]))
+        lines.append(f"Pagina {number + 1}" if language == "it" else f"Page {number + 1}")
+        result.append(lines)
+    return result
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """Scrive un PDF minimale (Helvetica, WinAnsiEncoding) con una riga di testo per elemento."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Pages, compilato dopo aver creato le pagine
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        body = ["BT", "/F1 9 Tf", "11 TL", "40 810 Td"]
+        for line in lines:
+            body.append(f"({_escape(line)}) Tj T*")
+        body.append("ET")
+        stream = "\n".join(body).encode("cp1252", errors="replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def generate_corpus(directory, docs=10, pages=50, language="it", seed=0):
+    """Genera docs PDF nella cartella e ne restituisce i percorsi."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(docs):
+        languages = ["it", "en"] if language == "mixed" else [language]
+        doc_language = languages[number % len(languages)]
+        suffix = "S.p.A." if doc_language == "it" else "Ltd"
+        company = f"Azienda Sintetica {number + 1} {suffix}"
+        year = 2015 + number % 10
+        path = os.path.join(directory, f"bilancio_{number + 1:04d}_{doc_language}.pdf")
+        write_pdf(path, document_pages(company, year, pages, doc_language, rng))
+        paths.append(path)
+    return paths
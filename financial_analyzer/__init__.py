@@ -0,0 +1 @@
+"""Componenti riutilizzabili dell'Analizzatore PDF Finanziari (senza dipendenze da Streamlit)."""
@@ -0,0 +1,122 @@
+"""Cache persistente su disco (SQLite) con scadenza (TTL) ed eviction LRU."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Cartella predefinita per i file di cache (sovrascrivibile con FPA_CACHE_DIR)
+DEFAULT_CACHE_DIR = os.environ.get(
+    "FPA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "financial_pdf_analyzer")
+)
+
+
+def response_cache_key(model, prompt, temperature, max_tokens, response_format=None):
+    """Chiave content-addressed per una richiesta al modello."""
+    parts = [model, prompt, temperature, max_tokens]
+    if response_format is not None:
+        parts.append(response_format)
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """Dizionario persistente chiave -> valore JSON.
+
+    Le voci più vecchie di ttl_seconds vengono ignorate ed eliminate; quando la
+    dimensione totale supera max_bytes vengono rimosse le voci usate meno di recente.
+    Sicura per l'uso da più thread (una connessione protetta da lock).
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, ttl_seconds=30 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return default
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        # Rimuove le voci scadute, poi le meno usate finché si rientra nel limite
+        if self.ttl_seconds:
+            self._conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed_at ASC"):
+            evicted_keys.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted_keys)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size_bytes": size
+            }
@@ -0,0 +1,283 @@
+"""Estrazione deterministica delle voci dei bilanci italiani in schema CEE (artt. 2424-2425 c.c.).
+
+Le voci vengono cercate riga per riga nel testo estratto; le metriche derivate usano
+le stesse formule indicate nel prompt di estrazione. Le metriche non risolte restano
+escluse dal risultato e vengono richieste all'AI.
+"""
+import re
+
+_A = r"(?:à|a'|a)"  # "disponibilità" può essere estratto come "disponibilita'" o "disponibilita"
+
+# Voci di bilancio: per ciascuna, espressioni alternative in ordine di preferenza
+LINE_ITEMS = {
+    "valore_produzione": [r"totale\s+valore\s+della\s+produzione"],
+    "costi_produzione": [r"totale\s+costi\s+della\s+produzione"],
+    "differenza_a_b": [
+        r"differenza\s+tra\s+valore\s+e\s+costi\s+della\s+produzione(?:\s*\(\s*a\s*-\s*b\s*\))?",
+    ],
+    "ricavi": [r"ricavi\s+delle\s+vendite\s+e\s+delle\s+prestazioni"],
+    "amm_immateriali": [
+        r"amm(?:\.\s*to|ortamento)\s+(?:delle\s+)?immobilizzazioni\s+immateriali",
+    ],
+    "amm_materiali": [
+        r"amm(?:\.\s*to|ortamento)\s+(?:delle\s+)?immobilizzazioni\s+materiali",
+    ],
+    "debiti_banche": [r"debiti\s+verso\s+banche"],
+    "disponibilita_liquide": [
+        rf"totale\s+disponibilit{_A}\s+liquide",
+        rf"disponibilit{_A}\s+liquide",
+    ],
+    "titoli": [
+        rf"totale\s+attivit{_A}\s+finanziarie\s+che\s+non\s+costituiscono\s+immobilizzazioni",
+    ],
+    "utile": [
+        r"utile\s*\(\s*perdita\s*\)\s+dell'esercizio",
+        r"utile\s+(?:netto\s+)?dell'esercizio",
+    ],
+    "totale_attivo": [r"totale\s+attivo"],
+    "totale_passivo": [r"totale\s+passivo"],
+    "patrimonio_netto": [r"totale\s+patrimonio\s+netto"],
+    "totale_debiti": [r"totale\s+debiti(?!\s+verso)"],
+    "flusso_operativo": [
+        rf"flusso\s+finanziario\s+(?:dell'|della\s+)?(?:attivit{_A}\s+operativa|gestione\s+reddituale)",
+    ],
+}
+
+_LINE_ITEM_PATTERNS = {
+    item: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    for item, patterns in LINE_ITEMS.items()
+}
+
+# Importi in formato italiano: 1.234.567 / -1.234 / (1.234) / 1.234,56
+AMOUNT_RE = re.compile(r"(?<![\w.,/])(\(?-?\s?\d{1,3}(?:\.\d{3})+(?:,\d+)?\)?|\(?-?\s?\d+(?:,\d+)?\)?)(?![\w.,/])")
+
+# Scala degli importi dichiarata nel documento
+UNIT_PATTERNS = [
+    (re.compile(r"milioni\s+di\s+euro|euro\s*/\s*milioni|€\s*/\s*mln|in\s+mln", re.IGNORECASE), "milioni"),
+    (re.compile(r"migliaia\s+di\s+euro|euro\s*/\s*migliaia|€\s*/\s*000|in\s+k€|importi\s+in\s+migliaia", re.IGNORECASE), "migliaia"),
+]
+
+LEGAL_FORM_RE = re.compile(
+    r"\b(?:S\.?\s?P\.?\s?A\.?|S\.?\s?R\.?\s?L\.?(?:\s+semplificata)?|S\.?\s?A\.?\s?S\.?|S\.?\s?N\.?\s?C\.?|S\.?\s?C\.?\s?A\.?\s?R\.?\s?L\.?)(?![\w])",
+    re.IGNORECASE
+)
+FISCAL_YEAR_RES = [
+    re.compile(r"bilancio\s+(?:d'esercizio\s+|consolidato\s+|abbreviato\s+)?al\s+31[./-]12[./-](\d{4})", re.IGNORECASE),
+    re.compile(r"esercizio\s+chiuso\s+al\s+31[./\s-](?:12|dicembre)[./\s-](\d{4})", re.IGNORECASE),
+    re.compile(r"bilancio\s+(?:d'esercizio\s+|consolidato\s+)?(?:al\s+31\s+dicembre\s+)?(\d{4})", re.IGNORECASE),
+]
+
+
+def parse_amount(token):
+    """Converte un importo in formato italiano in numero (le parentesi indicano un valore negativo)."""
+    token = token.strip()
+    negative = (token.startswith("(") and token.endswith(")")) or token.lstrip("(").startswith("-")
+    digits = token.strip("()").replace("-", "").replace(" ", "").replace(".", "").replace(",", ".")
+    try:
+        value = float(digits)
+    except ValueError:
+        return None
+    if value.is_integer():
+        value = int(value)
+    return -value if negative else value
+
+
+def _amounts_after(line, match):
+    # Dopo l'etichetta devono esserci solo importi (al massimo poche parole, es. "esigibili")
+    remainder = line[match.end():]
+    amounts = AMOUNT_RE.findall(remainder)
+    if not amounts:
+        return None
+    words = re.findall(r"[^\W\d_]{3,}", AMOUNT_RE.sub(" ", remainder))
+    if len(words) > 3:
+        return None
+    return [parse_amount(amount) for amount in amounts]
+
+
+def _ranked_line_items(text):
+    # {voce: (posizione dell'espressione tra le alternative, importo, importo della seconda colonna)}
+    # per la prima occorrenza valida; la seconda colonna è None se la riga ne ha una sola
+    lines = text.splitlines()
+    items = {}
+    for item, patterns in _LINE_ITEM_PATTERNS.items():
+        for rank, pattern in enumerate(patterns):
+            for line in lines:
+                match = pattern.search(line)
+                if not match:
+                    continue
+                amounts = _amounts_after(line, match)
+                if amounts and amounts[0] is not None:
+                    items[item] = (rank, amounts[0], amounts[1] if len(amounts) > 1 else None)
+                    break
+            if item in items:
+                break
+    return items
+
+
+def find_line_items(text):
+    """Restituisce {voce: importo} con la prima occorrenza valida di ciascuna voce.
+
+    Se una riga riporta più colonne si usa la prima (esercizio corrente).
+    """
+    return {item: value for item, (rank, value, prior) in _ranked_line_items(text).items()}
+
+
+def find_prior_line_items(text):
+    """Come find_line_items, ma con la seconda colonna delle stesse righe (esercizio precedente)."""
+    return {item: prior for item, (rank, value, prior) in _ranked_line_items(text).items() if prior is not None}
+
+
+# Caratteri iniziali del documento in cui cercare scala degli importi e intestazione
+UNIT_HEAD_CHARS = 20000
+IDENTIFICATION_HEAD_CHARS = 6000
+
+
+def detect_unit(text):
+    """Scala degli importi ("milioni", "migliaia" o "euro")."""
+    head = text[:UNIT_HEAD_CHARS]
+    for pattern, unit in UNIT_PATTERNS:
+        if pattern.search(head):
+            return unit
+    return "euro"
+
+
+def identify_company_locally(text):
+    """Prova a ricavare azienda, esercizio e valuta dalle prime righe del documento.
+
+    Restituisce None se nome o anno non sono riconoscibili con certezza.
+    """
+    head = text[:IDENTIFICATION_HEAD_CHARS]
+    company_name = None
+    for line in head.splitlines():
+        line = line.strip()
+        if 3 < len(line) <= 80 and LEGAL_FORM_RE.search(line) and not re.search(r"\d{4}", line):
+            company_name = re.sub(r"\s+", " ", line)
+            break
+
+    fiscal_year = None
+    for pattern in FISCAL_YEAR_RES:
+        match = pattern.search(head)
+        if match:
+            fiscal_year = match.group(1)
+            break
+
+    if not company_name or not fiscal_year:
+        return None
+    return {
+        "company_name": company_name,
+        "fiscal_year": fiscal_year,
+        "currency": "EUR" if re.search(r"\beuro\b|€", head, re.IGNORECASE) else "Sconosciuta",
+        "document_type": "Bilancio"
+    }
+
+
+def compute_metrics(items):
+    """Calcola le metriche dalle voci trovate, con le formule del prompt di estrazione."""
+    metrics = {}
+
+    if "ricavi" in items:
+        metrics["Ricavi/Vendite"] = items["ricavi"]
+
+    # EBIT = Differenza tra valore e costi della produzione (A - B)
+    ebit = items.get("differenza_a_b")
+    if ebit is None and "valore_produzione" in items and "costi_produzione" in items:
+        ebit = items["valore_produzione"] - abs(items["costi_produzione"])
+    if ebit is not None:
+        metrics["EBIT"] = ebit
+
+    # EBITDA = EBIT + ammortamenti immateriali + ammortamenti materiali
+    if ebit is not None and ("amm_immateriali" in items or "amm_materiali" in items):
+        depreciation = abs(items.get("amm_immateriali", 0)) + abs(items.get("amm_materiali", 0))
+        metrics["EBITDA"] = ebit + depreciation
+
+    if "utile" in items:
+        metrics["Utile Netto"] = items["utile"]
+    if "totale_attivo" in items:
+        metrics["Totale Attività"] = items["totale_attivo"]
+    if "patrimonio_netto" in items:
+        metrics["Patrimonio Netto"] = items["patrimonio_netto"]
+        # Nello schema CEE il totale passivo include il patrimonio netto
+        if "totale_passivo" in items:
+            metrics["Totale Passività"] = items["totale_passivo"] - items["patrimonio_netto"]
+        if "totale_debiti" in items and items["patrimonio_netto"]:
+            metrics["Rapporto Debito/Patrimonio"] = round(items["totale_debiti"] / items["patrimonio_netto"], 4)
+    if "flusso_operativo" in items:
+        metrics["Flusso di Cassa Operativo"] = items["flusso_operativo"]
+
+    # PFN = Debiti verso banche - Disponibilità liquide - Titoli facilmente liquidabili
+    if "debiti_banche" in items and "disponibilita_liquide" in items:
+        metrics["PFN (Posizione Finanziaria Netta)"] = (
+            items["debiti_banche"] - items["disponibilita_liquide"] - items.get("titoli", 0)
+        )
+
+    return metrics
+
+
+def _metrics_data(items, unit, requested_metrics):
+    # I rapporti sono adimensionali
+    return {
+        metric: {"value": value, "unit": "" if metric == "Rapporto Debito/Patrimonio" else unit, "source": "local"}
+        for metric, value in compute_metrics(items).items()
+        if metric in requested_metrics
+    }
+
+
+def extract_local_metrics(text, requested_metrics):
+    """Estrae le metriche richieste senza chiamate API.
+
+    Restituisce (dati nel formato della risposta AI, voci di bilancio trovate).
+    """
+    items = find_line_items(text)
+    return _metrics_data(items, detect_unit(text), requested_metrics), items
+
+
+def extract_local_prior_metrics(text, requested_metrics):
+    """Come extract_local_metrics, per l'esercizio precedente (colonna comparativa dei prospetti)."""
+    items = find_prior_line_items(text)
+    return _metrics_data(items, detect_unit(text), requested_metrics), items
+
+
+class PageScanner:
+    """Estrazione locale su pagine lette una alla volta, senza unirle in un unico testo.
+
+    Il risultato coincide con quello di extract_local_metrics e
+    identify_company_locally sul testo completo: per ogni voce vince
+    l'espressione preferita e, a parità, la pagina precedente. Del documento
+    restano in memoria solo i primi UNIT_HEAD_CHARS caratteri.
+    """
+
+    def __init__(self):
+        self.head = ""
+        self._items = {}
+
+    def add(self, page):
+        if len(self.head) < UNIT_HEAD_CHARS:
+            self.head = (self.head + page + "\n")[:UNIT_HEAD_CHARS]
+        for item, entry in _ranked_line_items(page).items():
+            if item not in self._items or entry[0] < self._items[item][0]:
+                self._items[item] = entry
+
+    @property
+    def items(self):
+        return {item: value for item, (rank, value, prior) in self._items.items()}
+
+    @property
+    def prior_items(self):
+        return {item: prior for item, (rank, value, prior) in self._items.items() if prior is not None}
+
+    @property
+    def unit(self):
+        return detect_unit(self.head)
+
+    def local_metrics(self, requested_metrics):
+        """Come extract_local_metrics: (dati nel formato della risposta AI, voci trovate)."""
+        items = self.items
+        return _metrics_data(items, self.unit, requested_metrics), items
+
+    def prior_metrics(self, requested_metrics):
+        """Come extract_local_prior_metrics: metriche dell'esercizio precedente e voci trovate."""
+        items = self.prior_items
+        return _metrics_data(items, self.unit, requested_metrics), items
+
+    def identify_company(self):
+        return identify_company_locally(self.head)
@@ -0,0 +1,220 @@
+"""Elaborazione batch da riga di comando, senza Streamlit.
+
+Esempio:
+    python -m financial_analyzer ./bilanci --metrics "EBITDA,EBIT" --output risultati.jsonl
+
+I risultati vengono scritti un documento alla volta (JSONL o CSV), appena disponibili.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+
+def find_pdfs(directory, recursive=False):
+    """Percorsi dei PDF nella cartella, in ordine alfabetico."""
+    if recursive:
+        paths = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(directory)
+            for name in names if name.lower().endswith(".pdf")
+        ]
+    else:
+        paths = [
+            os.path.join(directory, name)
+            for name in os.listdir(directory) if name.lower().endswith(".pdf")
+        ]
+    return sorted(paths)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m financial_analyzer",
+        description="Estrae metriche finanziarie da una cartella di PDF."
+    )
+    parser.add_argument("directory", help="cartella contenente i PDF")
+    parser.add_argument("-o", "--output", default="-", help="file di output (predefinito: stdout)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default=None,
+                        help="formato di output (predefinito: dall'estensione del file, altrimenti jsonl)")
+    parser.add_argument("--metrics", default=None,
+                        help="metriche separate da virgola (predefinite: EBITDA, EBIT, PFN)")
+    parser.add_argument("--model", default=None, help="modello OpenRouter")
+    parser.add_argument("--api-key", default=os.environ.get("OPENROUTER_API_KEY"),
+                        help="chiave API OpenRouter (predefinita: $OPENROUTER_API_KEY)")
+    parser.add_argument("--concurrency", type=int, default=4, help="documenti elaborati in parallelo")
+    parser.add_argument("--pdf-workers", type=int, default=1, help="processi per l'estrazione del testo")
+    parser.add_argument("--requests-per-minute", type=int, default=120, help="limite di richieste al minuto")
+    parser.add_argument("--chunked", action="store_true",
+                        help="documenti lunghi: estrae da tutte le pagine rilevanti con più chiamate in parallelo")
+    parser.add_argument("--combined", action="store_true",
+                        help="azienda, anno e metriche con una sola chiamata per documento")
+    parser.add_argument("--cascade-model", default=None, metavar="MODEL",
+                        help="modello veloce per il primo passaggio; --model solo per le risposte che non superano i controlli")
+    parser.add_argument("--stream", action="store_true",
+                        help="risposte in streaming: il timeout vale per l'inattività, non per la durata totale")
+    parser.add_argument("--ocr", action="store_true",
+                        help="OCR (tesseract) delle pagine scansionate; le pagine con testo non vengono rielaborate")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="memoria limitata: PDF mappati da disco, pagine lette una alla volta e conservate compresse")
+    parser.add_argument("--multi-year", action="store_true",
+                        help="estrae anche gli esercizi precedenti riportati nel documento (colonne comparative)")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="prefisso comune (istruzioni e testo) per le chiamate di un documento, riletto dalla cache del provider")
+    parser.add_argument("--clean-text", action="store_true",
+                        help="toglie dai prompt intestazioni e piè di pagina ripetuti, riempimenti e spazi superflui")
+    parser.add_argument("--dedup", action="store_true",
+                        help="salta i file ripetuti, i testi quasi identici e i documenti della stessa azienda e anno con testo in buona parte contenuto in un documento più completo")
+    parser.add_argument("--recursive", action="store_true", help="cerca i PDF anche nelle sottocartelle")
+    parser.add_argument("--no-cache", action="store_true", help="non riutilizzare le risposte AI in cache")
+    parser.add_argument("--no-local", action="store_true", help="disattiva l'estrazione locale (schema CEE)")
+    parser.add_argument("--no-store", action="store_true",
+                        help="non riusare né salvare i risultati nell'archivio SQLite")
+    parser.add_argument("--cache-dir", default=None, help="cartella delle cache su disco")
+    parser.add_argument("--telemetry", default=None, metavar="FILE",
+                        help="scrive tempi per fase, token e byte per documento in formato JSON")
+    parser.add_argument("--prometheus", default=None, metavar="FILE",
+                        help="scrive le metriche aggregate nel formato testuale di Prometheus")
+    return parser
+
+
+def _csv_rows(record, metrics):
+    # Una riga per l'anno del documento e una per ogni esercizio precedente estratto
+    years = [(record["fiscal_year"], record["metrics"])] + list(record["prior_years"].items())
+    rows = []
+    for year, year_metrics in years:
+        row = {
+            "file": record["file"],
+            "azienda": record["company_name"],
+            "anno": year,
+            "valuta": record["currency"],
+        }
+        for metric in metrics:
+            data = year_metrics.get(metric) or {}
+            row[metric] = data.get("value") if isinstance(data, dict) else None
+            row[f"{metric} [unità]"] = data.get("unit") if isinstance(data, dict) else None
+        row["duplicato di"] = record["duplicate_of"]
+        row["errori"] = " | ".join(record["errors"])
+        rows.append(row)
+    return rows
+
+
+def _write_telemetry(args, documents):
+    from financial_analyzer.telemetry import telemetry_json, prometheus_text
+
+    if args.telemetry:
+        with open(args.telemetry, "w", encoding="utf-8") as f:
+            f.write(telemetry_json(documents))
+    if args.prometheus:
+        with open(args.prometheus, "w", encoding="utf-8") as f:
+            f.write(prometheus_text(documents))
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Import ritardati: --help e gli errori di argomenti restano immediati
+    from financial_analyzer.cache import DiskCache, DEFAULT_CACHE_DIR
+    from financial_analyzer.dedup import describe_duplicate
+    from financial_analyzer.openrouter_client import OpenRouterClient
+    from financial_analyzer.results_store import ResultsStore
+    from financial_analyzer.pipeline import (
+        Analyzer, AVAILABLE_METRICS, DEFAULT_METRICS, MODEL_OPTIONS, document_record, compact_document
+    )
+
+    metrics = [m.strip() for m in args.metrics.split(",")] if args.metrics else list(DEFAULT_METRICS)
+    unknown = [m for m in metrics if m not in AVAILABLE_METRICS]
+    if unknown:
+        print(f"Metriche non riconosciute: {', '.join(unknown)}", file=sys.stderr)
+        print(f"Disponibili: {', '.join(AVAILABLE_METRICS)}", file=sys.stderr)
+        return 2
+
+    if not os.path.isdir(args.directory):
+        print(f"Cartella non trovata: {args.directory}", file=sys.stderr)
+        return 2
+    paths = find_pdfs(args.directory, args.recursive)
+    if not paths:
+        print(f"Nessun PDF trovato in {args.directory}", file=sys.stderr)
+        return 2
+    if args.ocr:
+        from financial_analyzer.ocr import ocr_unavailable_reason
+
+        if ocr_unavailable_reason():
+            print(f"⚠️ OCR non disponibile: {ocr_unavailable_reason()}", file=sys.stderr)
+    if not args.api_key:
+        print("⚠️ Nessuna chiave API: saranno disponibili solo le metriche estratte localmente", file=sys.stderr)
+
+    cache_dir = args.cache_dir or DEFAULT_CACHE_DIR
+    client = OpenRouterClient(requests_per_minute=args.requests_per_minute, pool_size=max(args.concurrency, 10))
+    analyzer = Analyzer(
+        args.api_key,
+        model=args.model or MODEL_OPTIONS[0],
+        client=client,
+        response_cache=DiskCache(os.path.join(cache_dir, "responses.sqlite3")),
+        text_cache=DiskCache(os.path.join(cache_dir, "pdf_text.sqlite3"), max_bytes=500 * 1024 * 1024),
+        results_store=None if args.no_store else ResultsStore(os.path.join(cache_dir, "results.sqlite3")),
+        use_response_cache=not args.no_cache,
+        use_local_extraction=not args.no_local,
+        max_concurrent_requests=args.concurrency,
+        pdf_extraction_workers=args.pdf_workers,
+        chunked_extraction=args.chunked,
+        combined_extraction=args.combined,
+        cascade_model=args.cascade_model,
+        stream_responses=args.stream,
+        low_memory=args.low_memory,
+        ocr=args.ocr,
+        deduplicate=args.dedup,
+        multi_year=args.multi_year,
+        prompt_caching=args.prompt_cache,
+        text_cleanup=args.clean_text
+    )
+
+    output_format = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    csv_writer = None
+    if output_format == "csv":
+        fieldnames = ["file", "azienda", "anno", "valuta"]
+        for metric in metrics:
+            fieldnames += [metric, f"{metric} [unità]"]
+        fieldnames += ["duplicato di", "errori"]
+        csv_writer = csv.DictWriter(output, fieldnames=fieldnames)
+        csv_writer.writeheader()
+
+    pdf_sources = [
+        {"name": os.path.relpath(path, args.directory), "content": path, "source": "file"}
+        for path in paths
+    ]
+    failed = 0
+    completed = 0
+    documents = []
+    try:
+        for event, index, doc in analyzer.iter_analysis(pdf_sources, metrics):
+            if event != "done":
+                continue
+            completed += 1
+            # Per la telemetria basta il riepilogo: testi e risposte vengono rilasciati subito
+            documents.append(compact_document(doc))
+            record = document_record(doc, metrics)
+            if csv_writer:
+                csv_writer.writerows(_csv_rows(record, metrics))
+            else:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+            if doc["duplicate"]:
+                status = f"saltato, {describe_duplicate(doc['duplicate'])}"
+            elif not doc["financial_data"]:
+                status = "errore"
+                failed += 1
+            else:
+                status = "parziale" if doc["errors"] else "ok"
+            print(f"[{completed}/{len(pdf_sources)}] {record['file']}: {status}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrotto: i documenti già completati sono stati scritti", file=sys.stderr)
+        return 130
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        _write_telemetry(args, documents)
+
+    return 1 if failed else 0
@@ -0,0 +1,164 @@
+"""Rilevamento dei documenti ridondanti prima delle chiamate all'AI.
+
+Tre criteri, in ordine: file identico (SHA-256 dei byte), testo quasi
+identico (MinHash sulle sequenze di parole di ogni pagina) e stessa azienda
+e anno fiscale riconosciuti localmente (nome normalizzato) con il testo del
+documento più breve in buona parte contenuto nell'altro (es. bilancio
+abbreviato e relazione annuale completa): azienda e anno da soli possono
+essere sbagliati e non bastano.
+Di ogni gruppo si elabora il documento con più testo, gli altri vengono
+saltati.
+"""
+import hashlib
+import heapq
+import re
+import unicodedata
+
+# Parole per sequenza (shingle) e dimensione dello sketch MinHash (bottom-k)
+SHINGLE_WORDS = 5
+SKETCH_SIZE = 256
+# Somiglianza stimata oltre la quale due testi sono considerati lo stesso documento
+NEAR_DUPLICATE_THRESHOLD = 0.9
+# Quota minima del testo del documento più breve presente nell'altro perché stessa azienda e anno
+# bastino a saltarlo (es. bilancio abbreviato e relazione completa, bozza e versione finale)
+COMPANY_YEAR_MIN_CONTAINMENT = 0.5
+# Hash confrontabili minimi per stimare il contenimento
+MIN_CONTAINMENT_SAMPLE = 8
+# Sotto questo numero di shingle il confronto non è affidabile (es. PDF scansionati)
+MIN_SHINGLES = 50
+
+_WORD_RE = re.compile(r"\w+")
+
+# Forme societarie in fondo al nome, escluse dalla chiave di confronto ("ABC S.r.l." e "ABC SRL" sono la
+# stessa azienda); devono essere una parola a sé, così "Sa.Ba. S.p.A." non perde "Sa."
+_LEGAL_FORM_RE = re.compile(
+    r"[\s,]+(?:s\.?\s?p\.?\s?a|s\.?\s?r\.?\s?l(?:\.?\s+semplificata)?|s\.?\s?a\.?\s?s|s\.?\s?n\.?\s?c"
+    r"|s\.?\s?c\.?\s?a\.?\s?r\.?\s?l|s\.?\s?a|societa\s+per\s+azioni|societa\s+a\s+responsabilita\s+limitata"
+    r"|spa|srl|ltd|inc|gmbh)\.?\s*$"
+)
+# Artefatti di formattazione prima del nome (es. "Company 1 ABC SRL")
+_NAME_PREFIX_RE = re.compile(r"^(?:company|azienda|societa|impresa)\s+\d+\s+")
+
+
+def normalize_company_name(name):
+    """Chiave di confronto del nome di un'azienda: minuscole, senza accenti, punteggiatura né forma societaria."""
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    name = _NAME_PREFIX_RE.sub("", name.strip())
+    name = _LEGAL_FORM_RE.sub(" ", name)
+    return " ".join(_WORD_RE.findall(name.replace("_", " ")))
+
+
+def _hash64(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class MinHashSketch:
+    """Sketch MinHash "bottom-k": i k hash più piccoli degli shingle di parole del documento.
+
+    Le pagine si aggiungono una alla volta; gli shingle non attraversano il
+    confine tra le pagine. La memoria resta limitata a pochi multipli di k.
+    """
+
+    def __init__(self, size=SKETCH_SIZE):
+        self.size = size
+        self.shingles = 0
+        self._hashes = set()
+
+    def add(self, page):
+        words = _WORD_RE.findall(page.lower())
+        for i in range(max(len(words) - SHINGLE_WORDS + 1, 0)):
+            self._hashes.add(_hash64(" ".join(words[i:i + SHINGLE_WORDS])))
+            self.shingles += 1
+        if len(self._hashes) > 4 * self.size:
+            self._hashes = set(heapq.nsmallest(self.size, self._hashes))
+
+    @property
+    def hashes(self):
+        return sorted(self._hashes)[:self.size]
+
+    def similarity(self, other):
+        """Stima dell'indice di Jaccard tra i due insiemi di shingle (None se non confrontabili)."""
+        if self.shingles < MIN_SHINGLES or other.shingles < MIN_SHINGLES:
+            return None
+        mine = set(self.hashes)
+        theirs = set(other.hashes)
+        union = heapq.nsmallest(self.size, mine | theirs)
+        return sum(1 for h in union if h in mine and h in theirs) / len(union)
+
+    def containment(self, other):
+        """Stima della quota degli shingle di questo documento presenti anche nell'altro (None se non confrontabili).
+
+        A differenza di Jaccard non si abbassa se l'altro documento è molto più
+        lungo. Si usano solo gli hash di questo sketch sotto la soglia dell'altro,
+        per i quali la presenza nell'altro sketch è nota.
+        """
+        if self.shingles < MIN_SHINGLES or other.shingles < MIN_SHINGLES:
+            return None
+        theirs = other.hashes
+        # Sketch non pieno: contiene tutti gli hash del documento
+        threshold = theirs[-1] if len(theirs) >= other.size else None
+        sample = [h for h in self.hashes if threshold is None or h <= threshold]
+        if len(sample) < MIN_CONTAINMENT_SAMPLE:
+            return None
+        theirs = set(theirs)
+        return sum(1 for h in sample if h in theirs) / len(sample)
+
+
+def _different_filings(a, b):
+    if not (a['company_key'] and a['fiscal_year'] and b['company_key'] and b['fiscal_year']):
+        return False
+    return (a['company_key'], a['fiscal_year']) != (b['company_key'], b['fiscal_year'])
+
+
+def find_duplicates(fingerprints):
+    """Decide quali documenti saltare.
+
+    fingerprints: un dizionario per documento con index, name, sha256, sketch,
+    text_chars, company_key e fiscal_year (None se il file non è leggibile).
+    Restituisce {indice: decisione}, dove la decisione indica il criterio
+    ('file', 'text' o 'company_year'), l'indice e il nome del documento
+    elaborato al suo posto e la somiglianza stimata (per il testo) o la quota
+    di testo contenuta nel documento elaborato (per azienda e anno).
+    """
+    decisions = {}
+    kept = []
+    # Il documento più completo di ogni gruppo viene elaborato, a parità il primo caricato
+    for fp in sorted((fp for fp in fingerprints if fp), key=lambda fp: (-fp['text_chars'], fp['index'])):
+        for primary in kept:
+            decision = None
+            if fp['sha256'] == primary['sha256']:
+                decision = {'kind': 'file'}
+            elif _different_filings(fp, primary):
+                # Testo simile ma azienda o anno diversi (es. bilanci redatti con lo stesso modello)
+                continue
+            else:
+                similarity = fp['sketch'].similarity(primary['sketch'])
+                if similarity is not None and similarity >= NEAR_DUPLICATE_THRESHOLD:
+                    decision = {'kind': 'text', 'similarity': round(similarity, 3)}
+                elif fp['company_key'] and fp['fiscal_year'] and \
+                        (fp['company_key'], fp['fiscal_year']) == (primary['company_key'], primary['fiscal_year']):
+                    # fp non è più lungo di primary: conta quanto del suo testo compare nell'altro
+                    containment = fp['sketch'].containment(primary['sketch'])
+                    if containment is not None and containment >= COMPANY_YEAR_MIN_CONTAINMENT:
+                        decision = {'kind': 'company_year', 'company_name': fp['company_name'],
+                                    'fiscal_year': fp['fiscal_year'], 'containment': round(containment, 3)}
+            if decision:
+                decision.update({'of': primary['index'], 'of_name': primary['name']})
+                decisions[fp['index']] = decision
+                break
+        else:
+            kept.append(fp)
+    return decisions
+
+
+def describe_duplicate(decision):
+    """Motivo leggibile (in italiano) per cui un documento è stato saltato."""
+    if decision['kind'] == 'file':
+        return f"file identico a {decision['of_name']}"
+    if decision['kind'] == 'text':
+        return f"testo quasi identico a {decision['of_name']} (somiglianza {decision['similarity']:.0%})"
+    return (f"stessa azienda e anno di {decision['of_name']} "
+            f"({decision['company_name']}, {decision['fiscal_year']}, {decision['containment']:.0%} del testo "
+            f"presente in quel documento), elaborato perché più completo")
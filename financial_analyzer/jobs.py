@@ -0,0 +1,192 @@
+"""Analisi in background: i job continuano mentre lo script Streamlit viene rieseguito.
+
+Un JobRunner esegue i job in coda con un thread di lavoro proprio; l'interfaccia
+conserva il riferimento al job (es. in st.session_state) e ne legge lo stato
+con progress() a ogni esecuzione dello script.
+"""
+import queue
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from financial_analyzer.pipeline import compact_document
+from financial_analyzer.telemetry import peak_rss_mb
+
+# Stati di un job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+# Secondi di inattività dopo cui un thread di lavoro senza job termina
+WORKER_IDLE_SECONDS = 60.0
+FAILED = "failed"
+
+FINISHED_STATES = {DONE, CANCELLED, FAILED}
+
+
+class AnalysisJob:
+    """Un'analisi di più documenti con Analyzer.iter_analysis, eseguita fuori dal thread dello script.
+
+    I documenti completati restano come riepiloghi compatti (compact_document);
+    con keep_details=True si conservano anche i documenti completi, per il
+    pannello di debug. on_finish viene chiamata al termine in ogni caso (es.
+    per rimuovere i file temporanei).
+    """
+
+    def __init__(self, analyzer, pdf_sources, metrics, keep_details=False, on_finish=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.analyzer = analyzer
+        self.pdf_sources = list(pdf_sources)
+        self.metrics = list(metrics)
+        self.names = [pdf_source['name'] for pdf_source in self.pdf_sources]
+        self.keep_details = keep_details
+        self.on_finish = on_finish
+
+        self.state = QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        total = len(self.pdf_sources)
+        self.status_messages = [None] * total
+        self.partial_metrics = [{} for _ in range(total)]
+        self.documents = [None] * total
+        self.details = [None] * total
+
+        # Statistiche dell'esecuzione, calcolate al termine
+        self.cache_stats_before = None
+        self.cache_stats_after = None
+        self.request_stats = None
+        self.peak_rss_mb = None
+
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        return len(self.names)
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def cancel(self):
+        """Chiede l'interruzione: i documenti non avviati vengono annullati, quelli in corso terminano."""
+        self._cancel.set()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def progress(self):
+        """Copia coerente dello stato corrente, da leggere dal thread dello script."""
+        with self._lock:
+            return {
+                'state': self.state,
+                'error': self.error,
+                'completed': sum(1 for doc in self.documents if doc is not None),
+                'total': self.total,
+                'status_messages': list(self.status_messages),
+                'partial_metrics': [dict(metrics) for metrics in self.partial_metrics],
+                'documents': list(self.documents),
+                'details': list(self.details),
+            }
+
+    def run(self):
+        """Esegue l'analisi nel thread chiamante (di norma quello del JobRunner)."""
+        if self.cancel_requested:
+            self._finish(CANCELLED)
+            return
+        with self._lock:
+            self.state = RUNNING
+            self.started_at = time.time()
+        analyzer = self.analyzer
+        if analyzer.response_cache is not None:
+            self.cache_stats_before = analyzer.response_cache.stats()
+        try:
+            with closing(analyzer.iter_analysis(self.pdf_sources, self.metrics)) as events:
+                for event, index, payload in events:
+                    with self._lock:
+                        if event == "status":
+                            self.status_messages[index] = payload
+                        elif event == "metric":
+                            metric, value = payload
+                            self.partial_metrics[index][metric] = value
+                        else:
+                            self.documents[index] = compact_document(payload)
+                            if self.keep_details:
+                                self.details[index] = payload
+                    if self.cancel_requested:
+                        break
+        except Exception as e:
+            self.error = str(e)
+            self._finish(FAILED)
+            return
+        self._finish(CANCELLED if self.cancel_requested else DONE)
+
+    def _finish(self, state):
+        analyzer = self.analyzer
+        if analyzer.response_cache is not None and self.cache_stats_before is not None:
+            self.cache_stats_after = analyzer.response_cache.stats()
+        if self.started_at is not None:
+            self.request_stats = analyzer.client.request_stats(since=self.started_at)
+        self.peak_rss_mb = peak_rss_mb()
+        # I contenuti dei PDF non servono più
+        self.pdf_sources = None
+        try:
+            if self.on_finish is not None:
+                self.on_finish()
+        finally:
+            with self._lock:
+                self.finished_at = time.time()
+                self.state = state
+
+
+class JobRunner:
+    """Coda di job eseguiti da workers thread di lavoro (daemon), nell'ordine di invio.
+
+    I thread partono con il primo job e terminano dopo WORKER_IDLE_SECONDS
+    senza lavoro, così un runner per sessione non lascia thread inattivi.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        with self._lock:
+            self._queue.put(job)
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="fpa-job-runner", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return job
+
+    def pending(self):
+        """Job in attesa di un thread libero."""
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=WORKER_IDLE_SECONDS)
+            except queue.Empty:
+                # Il controllo sotto lock evita di uscire mentre submit accoda un job
+                with self._lock:
+                    if self._queue.empty():
+                        self._threads.remove(threading.current_thread())
+                        return
+                continue
+            try:
+                job.run()
+            except Exception:
+                # Errore in on_finish: il job è già terminato e il thread resta disponibile
+                pass
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,225 @@
+"""Lettura tollerante del JSON restituito dai modelli.
+
+Le risposte possono contenere testo attorno al JSON, virgole finali, numeri in
+formato italiano (1.234,56) o essere troncate a max_tokens. Invece di scartare
+l'intera risposta si prova, in ordine: a decodificare gli oggetti presenti nel
+testo, a correggere i difetti più comuni e a chiudere l'oggetto troncato
+all'ultima voce completa.
+"""
+import json
+import re
+
+from financial_analyzer.streaming import MetricStreamParser
+
+_DECODER = json.JSONDecoder()
+
+# Blocchi di codice markdown attorno al JSON (```json ... ```)
+_FENCE_RE = re.compile(r"```(?:json|JSON)?")
+# Virgola prima della chiusura di un oggetto o di una lista
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+# Letterali Python al posto di quelli JSON
+_PYTHON_LITERAL_RE = re.compile(r"(?<=[:\[,\s])(None|True|False)(?=\s*[,}\]])")
+_PYTHON_LITERALS = {"None": "null", "True": "true", "False": "false"}
+# Numeri non quotati in formato italiano dopo i due punti: 1.234.567,89 / 1.234.567 / 1234,5
+_LOCALE_NUMBER_RE = re.compile(
+    r"(:\s*)(-?(?:\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d{1,3}(?:\.\d{3}){2,}|\d+,\d+))(?=\s*[,}\]])"
+)
+# Numero in una stringa: cifre con separatori, segno o parentesi contabili
+_NUMBER_TEXT_RE = re.compile(r"^\(?-?[\d.,]+\)?$")
+# Virgolette tipografiche
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"'})
+
+
+def parse_locale_number(text):
+    """Converte un numero scritto come testo (1.234,56, 1,234.56, (1.234)) in float; None se non è un numero."""
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        return text
+    if not isinstance(text, str):
+        return None
+    cleaned = text.replace("€", "").replace(" ", "").replace(" ", "").replace("'", "")
+    if not cleaned or not _NUMBER_TEXT_RE.match(cleaned):
+        return None
+    negative = cleaned.startswith("(") and cleaned.endswith(")")
+    cleaned = cleaned.strip("()")
+    if "," in cleaned and "." in cleaned:
+        # Il separatore che compare per ultimo è quello dei decimali
+        if cleaned.rfind(",") > cleaned.rfind("."):
+            cleaned = cleaned.replace(".", "").replace(",", ".")
+        else:
+            cleaned = cleaned.replace(",", "")
+    elif "," in cleaned:
+        # 1,234,567 (migliaia) oppure 1234,5 / 1,234 (una sola virgola: decimali, come in italiano)
+        if cleaned.count(",") > 1:
+            cleaned = cleaned.replace(",", "")
+        else:
+            cleaned = cleaned.replace(",", ".")
+    elif cleaned.count(".") > 1:
+        cleaned = cleaned.replace(".", "")
+    try:
+        value = float(cleaned)
+    except ValueError:
+        return None
+    return -value if negative else value
+
+
+def _repair_text(text):
+    """Corregge i difetti di formattazione più comuni; restituisce (testo, correzioni applicate)."""
+    repairs = []
+    fixed = _FENCE_RE.sub("", text).translate(_SMART_QUOTES)
+    if fixed != text:
+        repairs.append("formatting")
+    for name, pattern, replacement in (
+        ("locale_numbers", _LOCALE_NUMBER_RE,
+         lambda m: m.group(1) + str(parse_locale_number(m.group(2)))),
+        ("python_literals", _PYTHON_LITERAL_RE, lambda m: _PYTHON_LITERALS[m.group(1)]),
+        ("trailing_commas", _TRAILING_COMMA_RE, r"\1"),
+    ):
+        repaired = pattern.sub(replacement, fixed)
+        if repaired != fixed:
+            repairs.append(name)
+        fixed = repaired
+    return fixed, repairs
+
+
+def _scan_object(text, start):
+    """Fine dell'oggetto che inizia in start (None se troncato) e punti in cui si può chiudere.
+
+    I punti di taglio sono (posizione, chiusure): dopo ogni valore annidato
+    completo e prima di ogni virgola al primo livello.
+    """
+    stack = []
+    cuts = []
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, cuts
+            cuts.append((i + 1, "".join(reversed(stack))))
+        elif char == "," and len(stack) == 1:
+            cuts.append((i, stack[0]))
+    return None, cuts
+
+
+def _decode_objects(text):
+    """Il più lungo oggetto JSON di primo livello decodificabile nel testo."""
+    best = None
+    best_length = 0
+    position = text.find("{")
+    while position != -1:
+        try:
+            value, end = _DECODER.raw_decode(text, position)
+        except ValueError:
+            # Oggetto non valido: gli oggetti annidati non vengono considerati da soli
+            end, _ = _scan_object(text, position)
+            if end is None:
+                break
+        else:
+            if isinstance(value, dict) and end - position > best_length:
+                best, best_length = value, end - position
+        position = text.find("{", end)
+    return best
+
+
+def _cut_object(text):
+    """Primo oggetto del testo chiuso all'ultima voce valida, anche se troncato.
+
+    Restituisce (dati, troncato); dati è None se nessuna voce è recuperabile.
+    """
+    position = text.find("{")
+    if position == -1:
+        return None, False
+    end, cuts = _scan_object(text, position)
+    # Dal taglio più recente al più vecchio, il primo che produce JSON valido
+    for cut, closers in reversed(cuts):
+        candidate = text[position:cut].rstrip().rstrip(",") + closers
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value, end is None
+    return None, end is None
+
+
+def parse_model_json(text):
+    """Oggetto JSON della risposta di un modello e correzioni applicate per ottenerlo.
+
+    Restituisce (dati, correzioni): le correzioni sono nomi come
+    'trailing_commas', 'locale_numbers', 'truncated' (risposta interrotta) o
+    'partial' (voci non valide scartate); dati è None se nessun oggetto è
+    recuperabile.
+    """
+    if not text:
+        return None, []
+    data = _decode_objects(text)
+    if data is not None:
+        return data, []
+    fixed, repairs = _repair_text(text)
+    data = _decode_objects(fixed)
+    if data is None:
+        data, truncated = _cut_object(fixed)
+        repairs.append("truncated" if truncated else "partial")
+    return data, (repairs if data is not None else [])
+
+
+def normalize_metric_values(financial_data):
+    """Converte in numero i valori delle metriche scritti come testo (es. "1.234,56")."""
+    converted = []
+    for metric, entry in (financial_data or {}).items():
+        if isinstance(entry, dict) and isinstance(entry.get("value"), str):
+            value = parse_locale_number(entry["value"])
+            entry["value"] = value
+            converted.append(metric)
+    return converted
+
+
+def salvage_metrics(text, metrics):
+    """Metriche complete leggibili una per una da una risposta non valida nel suo insieme."""
+    if not text:
+        return {}
+    fixed, _ = _repair_text(text)
+    parser = MetricStreamParser(metrics, stop_key="prior_years")
+    parser.feed(fixed)
+    return {
+        metric: entry for metric, entry in parser.found.items()
+        if isinstance(entry, dict) and entry.get("value") is not None
+    }
+
+
+def unreadable_metrics(text, metrics):
+    """Metriche con una voce completa nella risposta ("nome": {...}) che non è JSON valido.
+
+    Le voci interrotte dal troncamento non sono comprese: il loro valore non
+    è nella risposta e va cercato nel documento.
+    """
+    if not text:
+        return []
+    fixed, _ = _repair_text(text)
+    stop = fixed.find('"prior_years"')
+    if stop != -1:
+        fixed = fixed[:stop]
+    unreadable = []
+    for metric in metrics:
+        entry = re.search(re.escape(json.dumps(metric, ensure_ascii=False)) + r"\s*:\s*(\{[^{}]*\})", fixed)
+        if not entry:
+            continue
+        try:
+            json.loads(entry.group(1))
+        except ValueError:
+            unreadable.append(metric)
+    return unreadable
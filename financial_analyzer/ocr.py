@@ -0,0 +1,198 @@
+"""OCR selettivo delle pagine scansionate, con tesseract.
+
+Solo le pagine senza testo utilizzabile che contengono immagini vengono
+rasterizzate (pypdfium2) e passate a tesseract (pytesseract), in parallelo su
+più processi. Il testo riconosciuto viene messo in cache per impronta della
+pagina (contenuto e immagini), quindi una pagina già vista non viene
+rielaborata anche se compare in un altro file.
+
+Dipendenze opzionali: pytesseract, pypdfium2 e l'eseguibile tesseract.
+"""
+import hashlib
+import io
+import os
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from financial_analyzer.pdf_text import pdf_reader, get_process_pool, discard_process_pool, spill_to_temp
+
+OCR_LANGUAGES = "ita+eng"
+OCR_DPI = 300
+
+# Una pagina con meno caratteri, o con troppi caratteri illeggibili, non ha un livello di testo utilizzabile
+MIN_PAGE_CHARS = 25
+MIN_READABLE_RATIO = 0.6
+_READABLE_PUNCTUATION = set(".,;:%€$()-/'\"&+*")
+
+
+@lru_cache(maxsize=1)
+def ocr_unavailable_reason():
+    """None se l'OCR è utilizzabile, altrimenti il motivo (in italiano)."""
+    try:
+        import pypdfium2  # noqa: F401
+        import pytesseract
+    except ImportError as e:
+        return f"modulo mancante ({e.name}): installa pytesseract e pypdfium2"
+    try:
+        tesseract_version()
+    except Exception:
+        return "eseguibile tesseract non trovato"
+    return None
+
+
+@lru_cache(maxsize=1)
+def tesseract_version():
+    import pytesseract
+
+    return str(pytesseract.get_tesseract_version())
+
+
+def needs_ocr(text):
+    """True se il testo estratto da PyPDF2 è assente o illeggibile (es. font senza mappatura)."""
+    stripped = text.strip()
+    if len(stripped) < MIN_PAGE_CHARS or "(cid:" in stripped:
+        return True
+    readable = sum(1 for c in stripped if c.isalnum() or c.isspace() or c in _READABLE_PUNCTUATION)
+    return readable / len(stripped) < MIN_READABLE_RATIO
+
+
+def _page_images(page):
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    if not xobjects:
+        return []
+    images = []
+    for name in sorted(xobjects.get_object()):
+        xobject = xobjects.get_object()[name].get_object()
+        if xobject.get("/Subtype") == "/Image":
+            images.append(xobject)
+    return images
+
+
+def page_fingerprint(page):
+    """Impronta SHA-256 di una pagina: contenuto e immagini, senza decodificarle.
+
+    None se la pagina non contiene immagini (non c'è niente da riconoscere).
+    """
+    images = _page_images(page)
+    if not images:
+        return None
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    for image in images:
+        # Byte grezzi (ancora codificati) dello stream dell'immagine
+        digest.update(image._data)
+    return digest.hexdigest()
+
+
+def ocr_cache_key(fingerprint, languages=OCR_LANGUAGES, dpi=OCR_DPI):
+    # Una nuova versione di tesseract invalida il testo memorizzato
+    return f"ocr:{fingerprint}:tesseract-{tesseract_version()}:{languages}:{dpi}"
+
+
+def ocr_page(pdf_source, page_number, languages=OCR_LANGUAGES, dpi=OCR_DPI):
+    """Rasterizza una pagina (numero da 0) e ne restituisce il testo riconosciuto.
+
+    Eseguita anche nei processi di lavoro: pdf_source è bytes o il percorso del file.
+    """
+    import pypdfium2
+    import pytesseract
+
+    document = pypdfium2.PdfDocument(pdf_source)
+    try:
+        image = document[page_number].render(scale=dpi / 72).to_pil()
+    finally:
+        document.close()
+    return pytesseract.image_to_string(image, lang=languages)
+
+
+def fill_scanned_pages(pages, pdf_source, pdf_data, cache=None, workers=1,
+                       languages=OCR_LANGUAGES, dpi=OCR_DPI):
+    """Sostituisce con il testo OCR le pagine scansionate, mantenendo l'ordine delle pagine.
+
+    pages è un iterabile con il testo di PyPDF2 (anche un generatore). Produce
+    (testo, esito) con esito None per le pagine con testo proprio, "ocr",
+    "ocr_cached" oppure "ocr_failed" (resta il testo originale). Con
+    workers > 1 le pagine da riconoscere vengono elaborate in parallelo, con
+    al più workers * 4 pagine in attesa. Se pdf_source è bytes, per i processi
+    di lavoro viene scritto una sola volta su un file temporaneo, rimosso alla
+    fine, invece di copiarlo a ogni pagina.
+    """
+    reader = None
+    window = max(workers, 1) * 4
+    pending = deque()
+    pool_source = pdf_source if isinstance(pdf_source, (str, os.PathLike)) else None
+    spilled = None
+
+    def recognize(number, text, key):
+        try:
+            recognized = ocr_page(pdf_source, number, languages, dpi)
+        except Exception:
+            return text, "ocr_failed"
+        if cache is not None:
+            cache.set(key, recognized)
+        return recognized, "ocr"
+
+    def resolve(entry):
+        number, text, result, key = entry
+        if not isinstance(result, Future):
+            return result
+        try:
+            recognized = result.result()
+        except BrokenProcessPool:
+            # Un worker è terminato in modo anomalo: la pagina viene riconosciuta qui
+            discard_process_pool(workers)
+            return recognize(number, text, key)
+        except Exception:
+            return text, "ocr_failed"
+        if cache is not None:
+            cache.set(key, recognized)
+        return recognized, "ocr"
+
+    try:
+        for number, text in enumerate(pages):
+            result = (text, None)
+            key = None
+            fingerprint = None
+            if needs_ocr(text):
+                if reader is None:
+                    reader = pdf_reader(pdf_data)
+                try:
+                    fingerprint = page_fingerprint(reader.pages[number])
+                except Exception:
+                    # Struttura della pagina non leggibile: resta il testo estratto
+                    fingerprint = None
+            if fingerprint is not None:
+                key = ocr_cache_key(fingerprint, languages, dpi)
+                cached = cache.get(key) if cache is not None else None
+                if cached is not None:
+                    result = (cached, "ocr_cached")
+                elif workers > 1:
+                    if pool_source is None:
+                        spilled = pool_source = spill_to_temp(io.BytesIO(pdf_source))
+                    result = get_process_pool(workers).submit(ocr_page, pool_source, number, languages, dpi)
+                else:
+                    result = recognize(number, text, key)
+            pending.append((number, text, result, key))
+
+            # Le pagine escono nell'ordine originale appena pronte, o quando la finestra è piena
+            while pending and (len(pending) > window or not isinstance(pending[0][2], Future)
+                               or pending[0][2].done()):
+                yield resolve(pending.popleft())
+
+        while pending:
+            yield resolve(pending.popleft())
+    finally:
+        # Generatore chiuso in anticipo: le pagine non ancora avviate non servono più
+        for _, _, result, _ in pending:
+            if isinstance(result, Future):
+                result.cancel()
+        if spilled is not None:
+            try:
+                os.remove(spilled)
+            except OSError:
+                pass
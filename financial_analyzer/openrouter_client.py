@@ -0,0 +1,259 @@
+"""Client HTTP per OpenRouter: connessioni persistenti, limite di frequenza e ritentativi."""
+import json
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Stati HTTP per cui ha senso ritentare la richiesta
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class OpenRouterError(Exception):
+    """Richiesta fallita definitivamente (dopo gli eventuali ritentativi)."""
+
+    def __init__(self, message, status_code=None, timeout=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.timeout = timeout
+
+
+class TokenBucket:
+    """Limitatore di frequenza condiviso tra i thread.
+
+    Concede fino a rate_per_minute richieste al minuto con un piccolo burst;
+    block_for sospende tutte le richieste (es. dopo un Retry-After).
+    """
+
+    def __init__(self, rate_per_minute, burst=None):
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+        self.set_rate(rate_per_minute, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def set_rate(self, rate_per_minute, burst=None):
+        with self._lock:
+            self.rate = rate_per_minute / 60.0
+            self.capacity = float(burst or max(1.0, self.rate * 5))
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def block_for(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = now
+
+
+def parse_retry_after(value):
+    """Secondi indicati dall'header Retry-After (numero o data HTTP), None se assente."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenRouterClient:
+    """Client condiviso: una Session con pool keep-alive per tutti i thread di lavoro."""
+
+    def __init__(self, requests_per_minute=120, max_retries=4, timeout=(10, 60),
+                 backoff_base=1.0, backoff_max=30.0, pool_size=32, url=OPENROUTER_URL):
+        self.rate_limiter = TokenBucket(requests_per_minute)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.url = url
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Ultime richieste: latenza, esito e numero di tentativi
+        self.request_log = deque(maxlen=5000)
+        self._log_lock = threading.Lock()
+
+    def _backoff(self, attempt):
+        # Backoff esponenziale con "full jitter"
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _record(self, model, started, status, attempts):
+        with self._log_lock:
+            self.request_log.append({
+                "model": model,
+                "started_at": started,
+                "latency": time.time() - started,
+                "status": status,
+                "attempts": attempts
+            })
+
+    def chat_completion(self, api_key, payload, headers=None, meta=None, on_delta=None):
+        """Invia la richiesta e restituisce il JSON della risposta.
+
+        Se meta è un dizionario vi vengono annotati tentativi e dimensioni in
+        byte di richiesta e risposta, anche quando la richiesta fallisce.
+        Con on_delta la risposta arriva in streaming (SSE): on_delta riceve ogni
+        frammento di testo appena disponibile e il timeout di lettura vale come
+        timeout di inattività, non di durata complessiva. Il risultato ha
+        comunque la forma della risposta completa. Gli errori del flusso
+        (anche gli eventi di errore) vengono ritentati solo finché on_delta
+        non ha ricevuto testo: dopo, ripetere la richiesta duplicherebbe il
+        testo già consegnato.
+        """
+        if meta is None:
+            meta = {}
+        stream = on_delta is not None
+        delivered = []
+        if stream:
+            payload = {**payload, "stream": True}
+            consumer = on_delta
+
+            def on_delta(text):
+                delivered.append(len(text))
+                consumer(text)
+        body = json.dumps(payload).encode("utf-8")
+        meta.update({"attempts": 0, "request_bytes": len(body), "response_bytes": 0})
+        request_headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        request_headers.update(headers or {})
+        model = payload.get("model")
+        started = time.time()
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            last_attempt = attempt == self.max_retries
+            meta["attempts"] = attempt + 1
+            try:
+                response = self.session.post(
+                    self.url, headers=request_headers, data=body, timeout=self.timeout, stream=stream
+                )
+                if stream and response.status_code < 400:
+                    result = self._read_stream(response, on_delta, meta)
+                    self._record(model, started, response.status_code, attempt + 1)
+                    return result
+            except requests.exceptions.Timeout:
+                if last_attempt or delivered:
+                    self._record(model, started, "timeout", attempt + 1)
+                    raise OpenRouterError("Timeout della richiesta API", timeout=True)
+                time.sleep(self._backoff(attempt))
+                continue
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if last_attempt or delivered:
+                    self._record(model, started, "connection_error", attempt + 1)
+                    raise OpenRouterError(f"Errore di connessione: {str(e)}")
+                time.sleep(self._backoff(attempt))
+                continue
+            except OpenRouterError as e:
+                # Evento di errore nel flusso: stessi criteri degli stati HTTP
+                if e.status_code in RETRYABLE_STATUS and not last_attempt and not delivered:
+                    time.sleep(self._backoff(attempt))
+                    continue
+                self._record(model, started, "stream_error", attempt + 1)
+                raise
+
+            if response.status_code in RETRYABLE_STATUS and not last_attempt:
+                # La risposta non viene letta: la connessione torna subito al pool
+                response.close()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    # Il provider chiede di attendere: sospende tutte le richieste
+                    self.rate_limiter.block_for(retry_after)
+                else:
+                    time.sleep(self._backoff(attempt))
+                continue
+
+            meta["response_bytes"] = len(response.content)
+            self._record(model, started, response.status_code, attempt + 1)
+            if response.status_code >= 400:
+                raise OpenRouterError(
+                    f"Errore API HTTP {response.status_code}: {response.text[:200]}",
+                    status_code=response.status_code
+                )
+            return response.json()
+
+    def _read_stream(self, response, on_delta, meta):
+        # Eventi SSE: "data: {json}" per ogni frammento, "data: [DONE]" alla fine, ": ..." keep-alive
+        parts = []
+        usage = {}
+        received = 0
+        try:
+            for line in response.iter_lines():
+                received += len(line) + 1
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+                if event.get("error"):
+                    error = event["error"]
+                    raise OpenRouterError(
+                        f"Errore API durante lo streaming: {error.get('message', error)}",
+                        status_code=error.get("code") if isinstance(error.get("code"), int) else None
+                    )
+                usage = event.get("usage") or usage
+                for choice in event.get("choices") or []:
+                    text = (choice.get("delta") or {}).get("content")
+                    if text:
+                        parts.append(text)
+                        on_delta(text)
+        except requests.exceptions.ConnectionError as e:
+            # Nessun dato entro il timeout di lettura: inattività del provider
+            if "timed out" in str(e).lower():
+                raise requests.exceptions.ReadTimeout(str(e))
+            raise
+        finally:
+            meta["response_bytes"] = received
+            response.close()
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}}],
+            "usage": usage
+        }
+
+    def request_stats(self, since=0.0):
+        """Riepilogo delle richieste avviate dopo il timestamp since."""
+        with self._log_lock:
+            entries = [entry for entry in self.request_log if entry["started_at"] >= since]
+        latencies = sorted(entry["latency"] for entry in entries)
+        return {
+            "requests": len(entries),
+            "retries": sum(entry["attempts"] - 1 for entry in entries),
+            "failures": sum(1 for entry in entries if entry["status"] != 200),
+            "avg_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p95_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+        }
@@ -0,0 +1,278 @@
+"""Indice di rilevanza delle pagine: seleziona le pagine da inviare all'AI entro un budget di token."""
+import re
+import zlib
+
+from financial_analyzer.text_cleanup import BoilerplateDetector
+
+# Termini dei prospetti di bilancio (peso per occorrenza)
+STATEMENT_TERMS = {
+    "stato patrimoniale": 5,
+    "conto economico": 5,
+    "rendiconto finanziario": 3,
+    "balance sheet": 4,
+    "income statement": 4,
+    "statement of financial position": 4,
+    "cash flow statement": 3,
+}
+
+# Termini associati a ciascuna metrica (gli stessi citati nel prompt di estrazione)
+METRIC_TERMS = {
+    "Ricavi/Vendite": {
+        "ricavi delle vendite": 4, "totale valore della produzione": 4, "valore della produzione": 2,
+        "revenue": 2, "ricavi": 1,
+    },
+    "EBITDA": {
+        "ebitda": 4, "margine operativo lordo": 4, "amm.to": 3, "ammortament": 3,
+        "differenza tra valore e costi della produzione": 4, "totale costi della produzione": 3,
+    },
+    "EBIT": {
+        "ebit": 3, "risultato operativo": 4, "differenza tra valore e costi della produzione": 4,
+        "totale costi della produzione": 3, "totale valore della produzione": 3, "operating income": 3,
+    },
+    "Utile Netto": {
+        "utile (perdita) dell'esercizio": 4, "utile netto": 4, "risultato dell'esercizio": 3, "net income": 3,
+    },
+    "Totale Attività": {"totale attivo": 4, "total assets": 4},
+    "Totale Passività": {"totale passivo": 4, "total liabilities": 4, "totale debiti": 2},
+    "Patrimonio Netto": {"patrimonio netto": 4, "shareholders' equity": 4, "total equity": 3},
+    "Flusso di Cassa Operativo": {
+        "flusso finanziario dell'attività operativa": 4, "flusso finanziario dell'attivita' operativa": 4,
+        "operating activities": 3, "rendiconto finanziario": 2,
+    },
+    "Free Cash Flow": {"free cash flow": 4, "flusso di cassa": 2, "investimenti": 1, "operating activities": 2},
+    "Rapporto Debito/Patrimonio": {"patrimonio netto": 3, "totale debiti": 3, "debiti verso banche": 3},
+    "PFN (Posizione Finanziaria Netta)": {
+        "posizione finanziaria netta": 4, "debiti verso banche": 4, "disponibilità liquide": 4,
+        "disponibilita' liquide": 4, "depositi bancari": 3, "titoli": 1, "net financial position": 4,
+        "cash and cash equivalents": 3,
+    },
+}
+
+# Termini utili a identificare azienda, esercizio e valuta
+IDENTIFICATION_TERMS = {
+    "s.p.a.": 3, "s.r.l.": 3, "bilancio": 2, "esercizio": 2, "31 dicembre": 2,
+    "31/12": 2, "sede": 1, "capitale sociale": 2, "codice fiscale": 1, "partita iva": 1, "euro": 1,
+    "annual report": 2, "fiscal year": 2,
+}
+
+# Numeri con separatore delle migliaia: tipici delle tabelle di bilancio
+NUMBER_RE = re.compile(r"\d{1,3}(?:[.,]\d{3})+")
+
+
+def _term_pattern(term):
+    # Il termine deve iniziare una parola ("ebit" non conta dentro "debiti")
+    return re.compile(r"(?<![\w])" + re.escape(term))
+
+
+def estimate_tokens(text):
+    """Stima approssimativa dei token (circa 4 caratteri per token)."""
+    return len(text) // 4 + 1
+
+
+def financial_terms(metrics):
+    """Unisce i termini dei prospetti e quelli delle metriche richieste."""
+    terms = dict(STATEMENT_TERMS)
+    for metric in metrics:
+        for term, weight in METRIC_TERMS.get(metric, {}).items():
+            terms[term] = max(terms.get(term, 0), weight)
+    return terms
+
+
+def _known_term_patterns():
+    known_terms = set(STATEMENT_TERMS) | set(IDENTIFICATION_TERMS)
+    for terms in METRIC_TERMS.values():
+        known_terms |= set(terms)
+    return {term: _term_pattern(term) for term in known_terms}
+
+
+class PageIndex:
+    """Conteggio dei termini noti per ogni pagina del documento, calcolato una sola volta.
+
+    Le pagine possono essere aggiunte una alla volta con add (es. da un
+    generatore). Con compress=True il testo di ogni pagina viene conservato
+    compresso con zlib e decompresso solo quando entra in un prompt. Con
+    cleanup=True il testo dei prompt è ripulito da riempimenti e spazi e le
+    intestazioni e i piè di pagina ripetuti restano solo nella prima pagina
+    di ogni prompt (text_cleanup); i punteggi restano calcolati sul testo
+    originale.
+    """
+
+    def __init__(self, pages=(), compress=False, cleanup=False):
+        self.compress = compress
+        self.cleanup = BoilerplateDetector() if cleanup else None
+        self._repeated = None
+        # Testo ripulito delle pagine già entrate in un prompt (compresso come le pagine)
+        self._prompt_pages = {}
+        self._patterns = _known_term_patterns()
+        self._pages = []
+        self._term_counts = []
+        self._number_counts = []
+        self.text_chars = 0
+        for page in pages:
+            self.add(page)
+
+    def add(self, page):
+        lowered = page.lower()
+        counts = {}
+        for term, pattern in self._patterns.items():
+            if term in lowered:
+                count = len(pattern.findall(lowered))
+                if count:
+                    counts[term] = count
+        self._term_counts.append(counts)
+        self._number_counts.append(len(NUMBER_RE.findall(page)))
+        # Caratteri significativi, per verificare che il PDF contenga testo
+        self.text_chars += len(page.strip())
+        self._pages.append(zlib.compress(page.encode("utf-8")) if self.compress else page)
+        if self.cleanup is not None:
+            self.cleanup.add(page)
+            self._repeated = None
+            self._prompt_pages.clear()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def page(self, i):
+        """Testo della pagina i (da 0)."""
+        page = self._pages[i]
+        return zlib.decompress(page).decode("utf-8") if self.compress else page
+
+    def prompt_page(self, i, first=False):
+        """Testo della pagina i (da 0) come viene inviato nei prompt (first: prima pagina del prompt)."""
+        if self.cleanup is None:
+            return self.page(i).strip()
+        if first:
+            # Le righe ripetute (azienda, anno, titolo) restano nella prima pagina
+            return self.cleanup.clean(self.page(i), repeated=())
+        if self._repeated is None:
+            self._repeated = self.cleanup.repeated()
+        page = self._prompt_pages.get(i)
+        if page is None:
+            page = self.cleanup.clean(self.page(i), self._repeated)
+            self._prompt_pages[i] = zlib.compress(page.encode("utf-8")) if self.compress else page
+            return page
+        return zlib.decompress(page).decode("utf-8") if self.compress else page
+
+    def _first_block(self, n, char_budget):
+        # Blocco della prima pagina (numero da 1) di un prompt
+        return f"[Pagina {n}]\n{self.prompt_page(n - 1, first=True)}\n"[:char_budget]
+
+    def cleanup_stats(self, page_numbers=None):
+        """Caratteri e token stimati tolti dalla pulizia nelle pagine indicate (numeri da 1).
+
+        Senza page_numbers il conteggio è sull'intero documento: vale come misura
+        del testo rimosso, non dei token risparmiati, perché i prompt hanno un
+        budget fisso che viene comunque riempito con altre pagine.
+        """
+        if page_numbers is None:
+            page_numbers = range(1, len(self) + 1)
+        page_numbers = sorted(page_numbers)
+        chars_before = sum(len(self.page(n - 1).strip()) for n in page_numbers)
+        chars_after = sum(
+            len(self.prompt_page(n - 1, first=position == 0)) for position, n in enumerate(page_numbers)
+        )
+        return {
+            'chars_before': chars_before,
+            'chars_after': chars_after,
+            'chars_saved': chars_before - chars_after,
+            'tokens_saved': (chars_before - chars_after) // 4,
+            'repeated_lines': len(self._repeated or {}),
+        }
+
+    def score(self, page_number, terms, leading_pages_bonus=0):
+        counts = self._term_counts[page_number]
+        # Le occorrenze ripetute dello stesso termine contano al massimo 3 volte
+        score = sum(weight * min(counts.get(term, 0), 3) for term, weight in terms.items())
+        if score:
+            score += min(self._number_counts[page_number], 40) * 0.1
+        if leading_pages_bonus:
+            score += max(0, leading_pages_bonus - page_number)
+        return score
+
+    def select(self, terms, token_budget, leading_pages_bonus=0):
+        """Restituisce (numeri di pagina, testo) con le pagine più rilevanti entro il budget.
+
+        Le pagine scelte vengono riportate nell'ordine del documento. Se nessuna
+        pagina contiene i termini cercati si usano le prime pagine.
+        """
+        scores = [self.score(i, terms, leading_pages_bonus) for i in range(len(self))]
+        ranked = sorted((i for i in range(len(self)) if scores[i] > 0), key=lambda i: -scores[i])
+        if not ranked:
+            ranked = list(range(len(self)))
+
+        char_budget = token_budget * 4
+        selected = {}
+        for i in ranked:
+            page = self.prompt_page(i)
+            if not page:
+                continue
+            block = f"[Pagina {i + 1}]\n{page}\n"
+            if len(block) > char_budget:
+                # Pagina troppo lunga: se nulla è ancora stato scelto la si tronca
+                if not selected:
+                    selected[i] = block[:char_budget]
+                continue
+            selected[i] = block
+            char_budget -= len(block)
+            if char_budget <= 0:
+                break
+
+        page_numbers = sorted(selected)
+        if self.cleanup is not None and page_numbers:
+            selected[page_numbers[0]] = self._first_block(page_numbers[0] + 1, token_budget * 4)
+        return [i + 1 for i in page_numbers], "".join(selected[i] for i in page_numbers)
+
+    def text(self, page_numbers, token_budget):
+        """Testo delle pagine indicate (numeri da 1), ognuna limitata a token_budget."""
+        char_budget = token_budget * 4
+        return "".join(
+            f"[Pagina {n}]\n{self.prompt_page(n - 1, first=j == 0)}\n"[:char_budget]
+            for j, n in enumerate(sorted(page_numbers))
+        )
+
+    def chunks(self, terms, token_budget, max_chunks):
+        """Divide le pagine rilevanti in blocchi di pagine consecutive, ognuno entro token_budget.
+
+        Restituisce una lista di (numeri di pagina, testo) nell'ordine del documento.
+        Se le pagine rilevanti non stanno in max_chunks blocchi si tengono le più
+        rilevanti; se nessuna pagina è rilevante si ricade su select.
+        """
+        scores = [self.score(i, terms) for i in range(len(self))]
+        char_budget = token_budget * 4
+        blocks = {}
+        for i in range(len(self)):
+            page = self.prompt_page(i) if scores[i] > 0 else ""
+            if page:
+                blocks[i] = f"[Pagina {i + 1}]\n{page}\n"[:char_budget]
+        if not blocks:
+            return [self.select(terms, token_budget)]
+
+        # Pagine più rilevanti fino a riempire (circa) max_chunks blocchi
+        remaining = max_chunks * char_budget
+        kept = []
+        for i in sorted(blocks, key=lambda i: -scores[i]):
+            if len(blocks[i]) <= remaining:
+                kept.append(i)
+                remaining -= len(blocks[i])
+
+        chunks = []
+        current = []
+        used = 0
+        for i in sorted(kept):
+            if current and used + len(blocks[i]) > char_budget:
+                chunks.append(current)
+                current = []
+                used = 0
+            current.append(i)
+            used += len(blocks[i])
+        if current:
+            chunks.append(current)
+
+        # La suddivisione può produrre qualche blocco in più: restano i più rilevanti
+        if len(chunks) > max_chunks:
+            chunks = sorted(chunks, key=lambda chunk: -sum(scores[i] for i in chunk))[:max_chunks]
+            chunks.sort()
+        if self.cleanup is not None:
+            for chunk in chunks:
+                blocks[chunk[0]] = self._first_block(chunk[0] + 1, char_budget)
+        return [([i + 1 for i in chunk], "".join(blocks[i] for i in chunk)) for chunk in chunks]
@@ -0,0 +1,195 @@
+"""Estrazione del testo dai PDF, pagina per pagina, con cache per hash del file."""
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+
+# Incluso nella chiave di cache: un aggiornamento di PyPDF2 invalida il testo memorizzato
+EXTRACTOR_VERSION = f"pypdf2-{PyPDF2.__version__}"
+
+# Sotto questa soglia di pagine l'avvio dei processi costa più dell'estrazione stessa
+PARALLEL_MIN_PAGES = 40
+
+# Modalità a memoria ridotta: pagine per processo e blocchi della copia su disco
+STREAM_RANGE_PAGES = 20
+SPILL_CHUNK_BYTES = 1024 * 1024
+
+# Pool di processi condivisi, uno per numero di worker
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def read_pdf_bytes(pdf_file):
+    """Restituisce il contenuto di un PDF da UploadedFile, file aperto, bytes o percorso."""
+    if isinstance(pdf_file, (bytes, bytearray)):
+        return bytes(pdf_file)
+    if hasattr(pdf_file, "getvalue"):
+        return pdf_file.getvalue()
+    if hasattr(pdf_file, "read"):
+        pdf_file.seek(0)
+        return pdf_file.read()
+    with open(pdf_file, "rb") as f:
+        return f.read()
+
+
+def pdf_sha256(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def spill_to_temp(pdf_file, directory=None):
+    """Copia un upload (o file aperto) su un file temporaneo, a blocchi, e ne restituisce il percorso."""
+    if hasattr(pdf_file, "seek"):
+        pdf_file.seek(0)
+    fd, path = tempfile.mkstemp(suffix=".pdf", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(pdf_file, f, SPILL_CHUNK_BYTES)
+    return path
+
+
+@contextmanager
+def open_pdf(pdf_file):
+    """Contenuto del PDF come buffer di sola lettura.
+
+    I percorsi vengono mappati in memoria (mmap): le pagine del file sono lette
+    dal sistema operativo solo quando servono e non occupano heap. Gli altri
+    sorgenti passano per read_pdf_bytes.
+    """
+    if not isinstance(pdf_file, (str, os.PathLike)):
+        yield read_pdf_bytes(pdf_file)
+        return
+    with open(pdf_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap non accetta file vuoti
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def pdf_reader(pdf_data):
+    # Un mmap è già un flusso con read/seek: PyPDF2 lo legge senza copiarlo
+    if isinstance(pdf_data, mmap.mmap):
+        pdf_data.seek(0)
+        return PyPDF2.PdfReader(pdf_data)
+    return PyPDF2.PdfReader(io.BytesIO(pdf_data))
+
+
+def get_process_pool(workers):
+    with _process_pools_lock:
+        pool = _process_pools.get(workers)
+        if pool is None:
+            # "spawn" evita di duplicare con fork un processo con thread attivi (Streamlit)
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _process_pools[workers] = pool
+        return pool
+
+
+def discard_process_pool(workers):
+    with _process_pools_lock:
+        pool = _process_pools.pop(workers, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_page_range(pdf_source, start, stop):
+    # Eseguita in un processo separato: ogni worker apre il proprio lettore (bytes o percorso del file)
+    with open_pdf(pdf_source) as pdf_data:
+        reader = pdf_reader(pdf_data)
+        return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def extract_pages(pdf_bytes, workers=1, min_pages=PARALLEL_MIN_PAGES):
+    """Estrae il testo di ogni pagina con PyPDF2.
+
+    Con workers > 1 e almeno min_pages pagine, l'intervallo di pagine viene
+    diviso tra più processi e il testo riassemblato nell'ordine originale.
+    I file piccoli usano il percorso seriale.
+    """
+    reader = pdf_reader(pdf_bytes)
+    page_count = len(reader.pages)
+    if workers <= 1 or page_count < min_pages:
+        return [page.extract_text() or "" for page in reader.pages]
+
+    chunk_size = -(-page_count // workers)
+    ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    try:
+        pool = get_process_pool(workers)
+        futures = [pool.submit(_extract_page_range, pdf_bytes, start, stop) for start, stop in ranges]
+        pages = []
+        for future in futures:
+            pages.extend(future.result())
+        return pages
+    except BrokenProcessPool:
+        # Un worker è terminato in modo anomalo: ricrea il pool alla prossima chiamata
+        discard_process_pool(workers)
+        return [page.extract_text() or "" for page in reader.pages]
+
+
+def join_pages(pages):
+    """Unisce le pagine in un unico testo (tempo lineare, una riga vuota tra le pagine)."""
+    return "".join(page + "\n" for page in pages)
+
+
+def extract_pages_cached(pdf_bytes, cache=None, workers=1):
+    """Come extract_pages, ma riusa il testo già estratto per lo stesso file."""
+    if cache is None:
+        return extract_pages(pdf_bytes, workers)
+
+    cache_key = f"{pdf_sha256(pdf_bytes)}:{EXTRACTOR_VERSION}"
+    pages = cache.get(cache_key)
+    if pages is None:
+        pages = extract_pages(pdf_bytes, workers)
+        cache.set(cache_key, pages)
+    return pages
+
+
+def iter_pages(pdf_source, pdf_data, cache=None, workers=1):
+    """Testo delle pagine una alla volta, senza tenere in memoria l'intero documento.
+
+    pdf_data è il contenuto aperto con open_pdf; pdf_source (percorso o bytes)
+    viene passato ai processi di lavoro, che aprono il file per conto proprio.
+    Con workers > 1 le pagine sono divise in intervalli di STREAM_RANGE_PAGES,
+    con al più due intervalli in corso per worker. Il testo già in cache viene
+    riusato, ma non viene scritto: servirebbe l'elenco completo delle pagine.
+    """
+    if cache is not None:
+        pages = cache.get(f"{pdf_sha256(pdf_data)}:{EXTRACTOR_VERSION}")
+        if pages is not None:
+            yield from pages
+            return
+
+    reader = pdf_reader(pdf_data)
+    page_count = len(reader.pages)
+    if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+        for i in range(page_count):
+            yield reader.pages[i].extract_text() or ""
+        return
+
+    ranges = deque((start, min(start + STREAM_RANGE_PAGES, page_count))
+                   for start in range(0, page_count, STREAM_RANGE_PAGES))
+    pool = get_process_pool(workers)
+    pending = deque()
+    while ranges or pending:
+        while ranges and len(pending) < workers * 2:
+            start, stop = ranges.popleft()
+            pending.append((start, pool.submit(_extract_page_range, pdf_source, start, stop)))
+        start, future = pending.popleft()
+        try:
+            pages = future.result()
+        except BrokenProcessPool:
+            # Worker terminato in modo anomalo: il resto del documento in modo seriale
+            discard_process_pool(workers)
+            for i in range(start, page_count):
+                yield reader.pages[i].extract_text() or ""
+            return
+        yield from pages
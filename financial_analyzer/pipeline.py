@@ -0,0 +1,1469 @@
+"""Pipeline di analisi dei documenti, utilizzabile dall'app Streamlit e dalla riga di comando.
+
+Nessuna dipendenza da Streamlit: gli errori vengono raccolti nel dizionario del
+documento e gli aggiornamenti di stato prodotti come eventi da iter_analysis.
+"""
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, ExitStack
+
+from financial_analyzer.cache import response_cache_key
+from financial_analyzer.cee_extractor import (
+    extract_local_metrics, extract_local_prior_metrics, identify_company_locally, detect_unit, PageScanner,
+    IDENTIFICATION_HEAD_CHARS
+)
+from financial_analyzer.dedup import MinHashSketch, find_duplicates, normalize_company_name
+from financial_analyzer.json_repair import (
+    parse_model_json, normalize_metric_values, salvage_metrics, unreadable_metrics
+)
+from financial_analyzer.openrouter_client import OpenRouterClient, OpenRouterError
+from financial_analyzer.ocr import fill_scanned_pages, ocr_unavailable_reason
+from financial_analyzer.page_index import PageIndex, IDENTIFICATION_TERMS, financial_terms, estimate_tokens
+from financial_analyzer.pdf_text import read_pdf_bytes, pdf_sha256, extract_pages_cached, join_pages, open_pdf, iter_pages
+from financial_analyzer.streaming import MetricStreamParser
+from financial_analyzer.telemetry import new_call_telemetry
+from financial_analyzer.validation import validate_company_info, validate_metrics
+
+# Modelli disponibili tramite OpenRouter
+MODEL_OPTIONS = [
+    "anthropic/claude-sonnet-4",
+    "anthropic/claude-opus-4",
+    "google/gemini-2.5-flash-preview-05-20",
+    "google/gemini-2.5-pro-preview",
+    "openai/gpt-4.1"
+]
+
+# Metriche finanziarie estraibili
+AVAILABLE_METRICS = [
+    "Ricavi/Vendite",
+    "EBITDA",
+    "EBIT",
+    "Utile Netto",
+    "Totale Attività",
+    "Totale Passività",
+    "Patrimonio Netto",
+    "Flusso di Cassa Operativo",
+    "Free Cash Flow",
+    "Rapporto Debito/Patrimonio",
+    "PFN (Posizione Finanziaria Netta)"
+]
+
+DEFAULT_METRICS = ["EBITDA", "EBIT", "PFN (Posizione Finanziaria Netta)"]
+
+# Modello veloce proposto per il primo passaggio della cascata
+DEFAULT_CASCADE_MODEL = "google/gemini-2.5-flash-preview-05-20"
+
+# Modelli (prefissi OpenRouter) che supportano response_format con JSON schema
+STRUCTURED_OUTPUT_PREFIXES = ("openai/", "google/")
+
+# Modelli la cui cache dei prompt richiede breakpoint cache_control espliciti
+# (OpenAI e altri provider riusano da soli i prefissi ripetuti)
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/")
+
+# Campi di identificazione restituiti dal prompt unico
+COMPANY_FIELDS = ["company_name", "fiscal_year", "currency", "document_type"]
+
+# Budget di token per il testo del documento inviato in ciascun prompt
+IDENTIFICATION_TOKEN_BUDGET = 750
+EXTRACTION_TOKEN_BUDGET = 5000
+
+# Estrazione a blocchi: numero massimo di blocchi (e di chiamate parallele) per documento
+MAX_EXTRACTION_CHUNKS = 8
+
+
+class DocumentProcessingError(Exception):
+    """Errore durante l'elaborazione di un documento (il messaggio è mostrato all'utente)."""
+
+
+# Funzione per estrarre JSON da risposta AI
+def extract_json_from_response(response_text):
+    """Estrae JSON da una risposta che potrebbe contenere testo aggiuntivo, difetti di formato o essere troncata"""
+    data, _ = parse_model_json(response_text)
+    return data
+
+
+# Regole di estrazione delle metriche, parte delle istruzioni fisse del prefisso
+FINANCIAL_RULES = '''    - Converti tutti i valori nella stessa unità (preferibilmente milioni)
+    - Se una metrica non viene trovata direttamente, CALCOLALA dai dati disponibili:
+      * EBITDA = EBIT + Ammortamenti (ammort. immateriali + ammort. materiali)
+      * EBIT = Risultato operativo (A-B nel conto economico italiano)
+      * PFN = Debiti verso banche - Disponibilità liquide - Titoli facilmente liquidabili
+      * Se PFN è negativo = posizione di liquidità netta (bene per l'azienda)
+    - Per i rapporti, usa il formato decimale (es. 0.25 per 25%)
+    - Cerca in tutto il documento, non solo all'inizio
+    - Identifica voci come "Ricavi delle vendite", "TOTALE VALORE DELLA PRODUZIONE", "TOTALE COSTI DELLA PRODUZIONE"
+    - Per ammortamenti cerca "AMM.TO" o "ammortamenti"
+    - Per debiti bancari cerca "Debiti verso banche"
+    - Per liquidità cerca "Disponibilità liquide" o "Depositi bancari"'''
+
+
+# Più esercizi per documento: formato e regola aggiunti ai prompt di estrazione
+PRIOR_YEARS_FORMAT = ''',
+        "prior_years": [
+            {"fiscal_year": "2022", "metrics": {"EBITDA": {"value": 21000000, "unit": "milioni"}}}
+        ]'''
+PRIOR_YEARS_RULES = '''
+    - In "prior_years" riporta le stesse metriche per ogni esercizio precedente presente nel documento (colonna dell'esercizio precedente nei prospetti, tabelle pluriennali), nella stessa unità; ometti gli esercizi senza dati e lascia la lista vuota se non ce ne sono'''
+
+# Anno fiscale di quattro cifre (es. "2023"; non "2022/2023")
+_YEAR_RE = re.compile(r"\d{4}")
+
+
+# I prompt sono coppie (prefisso, richiesta): il prefisso (istruzioni fisse e testo del
+# documento) è identico per tutte le chiamate sullo stesso testo, quindi i provider
+# possono riusarlo dalla propria cache; la richiesta, breve, contiene le parti variabili.
+def document_prefix(document_text):
+    return f"""
+    Sei un analista finanziario. Ricevi il testo di un documento finanziario, seguito da una richiesta.
+    
+    IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo o spiegazioni.
+    
+    Regole per le metriche finanziarie:
+{FINANCIAL_RULES}
+    
+    Testo del documento (pagine più rilevanti):
+    {document_text}
+    """
+
+
+def prompt_text(prompt):
+    """Testo completo di un prompt (coppia prefisso/richiesta o stringa)."""
+    return prompt if isinstance(prompt, str) else "".join(prompt)
+
+
+def prompt_messages(prompt, cache_control=False):
+    """Messaggi della richiesta; con cache_control il prefisso diventa un breakpoint della cache del provider."""
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
+    prefix, request = prompt
+    prefix_part = {"type": "text", "text": prefix}
+    if cache_control:
+        prefix_part["cache_control"] = {"type": "ephemeral"}
+    return [{"role": "user", "content": [prefix_part, {"type": "text", "text": request}]}]
+
+
+# Prompt per identificare azienda e anno
+def identification_prompt(document_text, shared_prefix=False):
+    # Con shared_prefix il testo è il prefisso comune riletto poi dalla chiamata finanziaria
+    if not shared_prefix:
+        return f"""
+    Analizza questo documento finanziario e identifica le informazioni richieste.
+    
+    IMPORTANTE: Restituisci SOLO il JSON richiesto, senza altro testo.
+    
+    Formato richiesto:
+    {{
+        "company_name": "Nome Azienda S.p.A.",
+        "fiscal_year": "2023", 
+        "currency": "EUR",
+        "document_type": "Relazione Annuale"
+    }}
+    
+    Cerca nel documento:
+    1. Nome dell'azienda (nome legale completo)
+    2. Anno fiscale o periodo coperto
+    3. Valuta utilizzata nei bilanci
+    4. Tipo di documento (relazione annuale, bilancio, ecc.)
+    
+    Testo del documento (pagine più rilevanti):
+    {document_text}
+    """
+    return document_prefix(document_text), """
+    Richiesta: identifica l'azienda e il periodo del documento.
+    
+    Formato richiesto:
+    {
+        "company_name": "Nome Azienda S.p.A.",
+        "fiscal_year": "2023", 
+        "currency": "EUR",
+        "document_type": "Relazione Annuale"
+    }
+    
+    Cerca nel documento:
+    1. Nome dell'azienda (nome legale completo)
+    2. Anno fiscale o periodo coperto
+    3. Valuta utilizzata nei bilanci
+    4. Tipo di documento (relazione annuale, bilancio, ecc.)
+    """
+
+
+# Prompt per estrarre dati finanziari
+def financial_prompt(document_text, company_info, metrics, chunk=None, prior_years=False):
+    metrics_str = ", ".join(metrics)
+
+    # Estrazione a blocchi: chunk = (numero del blocco, numero di blocchi)
+    chunk_rules = ""
+    if chunk:
+        chunk_rules = f"""
+    - Questo testo è il blocco {chunk[0]} di {chunk[1]} del documento: includi solo le metriche presenti o calcolabili da questo blocco
+    - Aggiungi a ogni metrica "derived": false se il valore è riportato esplicitamente nel documento, "derived": true se lo hai calcolato"""
+
+    return document_prefix(document_text), f"""
+    Richiesta: estrai le metriche finanziarie richieste dal documento.
+    
+    Azienda: {company_info.get('company_name', 'azienda')}
+    Anno fiscale: {company_info.get('fiscal_year', 'sconosciuto')}
+    Metriche da estrarre: {metrics_str}
+    
+    Formato richiesto:
+    {{
+        "Ricavi/Vendite": {{"value": 123456789, "unit": "milioni"}},
+        "EBITDA": {{"value": 23456789, "unit": "milioni"}},
+        "EBIT": {{"value": 20000000, "unit": "milioni"}},
+        "PFN (Posizione Finanziaria Netta)": {{"value": 15000000, "unit": "milioni"}}{PRIOR_YEARS_FORMAT if prior_years else ""}
+    }}
+    
+    Regole specifiche:
+    - Applica le regole per le metriche finanziarie indicate sopra{chunk_rules}{PRIOR_YEARS_RULES if prior_years else ""}
+    """
+
+
+# Prompt unico: azienda, anno, valuta e metriche in una sola chiamata
+def combined_prompt(document_text, metrics, prior_years=False):
+    metrics_str = ", ".join(metrics)
+
+    return document_prefix(document_text), f"""
+    Richiesta: identifica l'azienda ed estrai le metriche finanziarie richieste dal documento.
+    
+    Metriche da estrarre: {metrics_str}
+    
+    Formato richiesto:
+    {{
+        "company_name": "Nome Azienda S.p.A.",
+        "fiscal_year": "2023",
+        "currency": "EUR",
+        "document_type": "Relazione Annuale",
+        "metrics": {{
+            "EBITDA": {{"value": 23456789, "unit": "milioni"}},
+            "EBIT": {{"value": 20000000, "unit": "milioni"}}
+        }}{PRIOR_YEARS_FORMAT if prior_years else ""}
+    }}
+    
+    Regole specifiche:
+    - company_name è il nome legale completo dell'azienda, fiscal_year l'anno fiscale o periodo coperto
+    - Se una metrica non è presente né calcolabile usa "value": null
+    - Applica le regole per le metriche finanziarie indicate sopra{PRIOR_YEARS_RULES if prior_years else ""}
+    """
+
+
+# Prompt di correzione: solo la risposta illeggibile, senza il testo del documento
+def repair_prompt(response_text, metrics):
+    metrics_str = ", ".join(metrics)
+
+    return f"""
+    La risposta seguente doveva contenere in JSON le metriche finanziarie indicate, ma non è leggibile.
+    
+    IMPORTANTE: Restituisci SOLO il JSON corretto, senza altro testo o spiegazioni.
+    
+    Metriche da estrarre: {metrics_str}
+    
+    Formato richiesto:
+    {{
+        "EBITDA": {{"value": 23456789, "unit": "milioni"}}
+    }}
+    
+    Regole specifiche:
+    - Riporta solo i valori presenti nella risposta, senza ricalcolarli
+    - Scrivi i numeri con il punto come separatore dei decimali e senza separatori delle migliaia
+    - Se il valore di una metrica è incompleto o assente usa "value": null
+    
+    Risposta da correggere:
+    {response_text}
+    """
+
+
+def supports_cache_control(model):
+    return model.startswith(CACHE_CONTROL_PREFIXES)
+
+
+def supports_structured_output(model):
+    return model.startswith(STRUCTURED_OUTPUT_PREFIXES)
+
+
+def combined_response_format(metrics, prior_years=False):
+    """response_format OpenRouter (JSON schema rigoroso) per la risposta del prompt unico."""
+    metric_schema = {
+        "type": "object",
+        "properties": {
+            "value": {"type": ["number", "null"]},
+            "unit": {"type": "string"}
+        },
+        "required": ["value", "unit"],
+        "additionalProperties": False
+    }
+    metrics_schema = {
+        "type": "object",
+        "properties": {metric: metric_schema for metric in metrics},
+        "required": list(metrics),
+        "additionalProperties": False
+    }
+    properties = {
+        **{field: {"type": "string"} for field in COMPANY_FIELDS},
+        "metrics": metrics_schema
+    }
+    if prior_years:
+        properties["prior_years"] = {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"fiscal_year": {"type": "string"}, "metrics": metrics_schema},
+                "required": ["fiscal_year", "metrics"],
+                "additionalProperties": False
+            }
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "financial_extraction",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def split_combined_response(data, metrics):
+    """Separa la risposta del prompt unico in (company_info, metriche trovate)."""
+    if not data:
+        return None, None
+    company_info = {field: data[field] for field in COMPANY_FIELDS if data.get(field)}
+    # Senza JSON schema alcuni modelli riportano le metriche al primo livello
+    metrics_data = data.get('metrics') if isinstance(data.get('metrics'), dict) else data
+    found = {
+        metric: metrics_data[metric] for metric in metrics
+        if isinstance(metrics_data.get(metric), dict) and metrics_data[metric].get('value') is not None
+    }
+    return company_info or None, found
+
+
+def previous_year(fiscal_year):
+    """Anno della colonna comparativa ("2023" -> "2022"), None se l'anno non è di quattro cifre."""
+    fiscal_year = str(fiscal_year or "").strip()
+    return str(int(fiscal_year) - 1) if _YEAR_RE.fullmatch(fiscal_year) else None
+
+
+def prior_year_metrics(prior_years, metrics, fiscal_year):
+    """Metriche degli esercizi precedenti da una risposta: {anno: {metrica: dati}}.
+
+    prior_years è la lista [{"fiscal_year", "metrics"}] richiesta nel prompt;
+    è accettato anche un dizionario {anno: metriche}. Restano solo gli anni di
+    quattro cifre precedenti all'anno fiscale del documento e le metriche con
+    un valore.
+    """
+    if isinstance(prior_years, dict):
+        prior_years = [{'fiscal_year': year, 'metrics': data} for year, data in prior_years.items()]
+    if not isinstance(prior_years, list):
+        return {}
+    current = str(fiscal_year or "").strip()
+    result = {}
+    for entry in prior_years:
+        if not isinstance(entry, dict) or not isinstance(entry.get('metrics'), dict):
+            continue
+        year = str(entry.get('fiscal_year') or "").strip()
+        if not _YEAR_RE.fullmatch(year) or year == current:
+            continue
+        if _YEAR_RE.fullmatch(current) and int(year) > int(current):
+            continue
+        normalize_metric_values(entry['metrics'])
+        found = {
+            metric: entry['metrics'][metric] for metric in metrics
+            if isinstance(entry['metrics'].get(metric), dict) and entry['metrics'][metric].get('value') is not None
+        }
+        if found:
+            result.setdefault(year, {}).update(found)
+    return result
+
+
+def tag_model(financial_data, model):
+    """Annota in ogni metrica dell'AI il modello che l'ha prodotta (campo "model"), se manca."""
+    for entry in (financial_data or {}).values():
+        if isinstance(entry, dict) and entry.get('source') != 'local':
+            entry.setdefault('model', model)
+    return financial_data
+
+
+def reduce_chunk_metrics(chunk_results, metrics):
+    """Unisce le metriche estratte dai singoli blocchi di un documento.
+
+    Per ogni metrica i valori riportati esplicitamente prevalgono su quelli
+    calcolati ("derived": true); a parità si sceglie il valore trovato in più
+    blocchi e poi quello del primo blocco nell'ordine del documento.
+    """
+    merged = {}
+    for metric in metrics:
+        candidates = [
+            data[metric] for data in chunk_results
+            if data and isinstance(data.get(metric), dict) and data[metric].get('value') is not None
+        ]
+        if not candidates:
+            continue
+        explicit = [candidate for candidate in candidates if not candidate.get('derived')]
+        candidates = explicit or candidates
+        votes = {}
+        for candidate in candidates:
+            key = (candidate.get('value'), candidate.get('unit'))
+            votes[key] = votes.get(key, 0) + 1
+        merged[metric] = max(candidates, key=lambda c: votes[(c.get('value'), c.get('unit'))])
+    return merged
+
+
+def reduce_chunk_prior_years(chunk_results, metrics, fiscal_year):
+    """Come reduce_chunk_metrics, anno per anno, per gli esercizi precedenti dei blocchi."""
+    per_year = {}
+    for data in chunk_results:
+        if not isinstance(data, dict):
+            continue
+        for year, found in prior_year_metrics(data.get('prior_years'), metrics, fiscal_year).items():
+            per_year.setdefault(year, []).append(found)
+    return {year: reduce_chunk_metrics(results, metrics) for year, results in per_year.items()}
+
+
+class Analyzer:
+    """Configurazione e stato condiviso di un'analisi (client HTTP, cache, opzioni)."""
+
+    def __init__(self, api_key, model=MODEL_OPTIONS[0], client=None, response_cache=None, text_cache=None,
+                 results_store=None, use_response_cache=True, use_local_extraction=True,
+                 max_concurrent_requests=4, pdf_extraction_workers=1, chunked_extraction=False,
+                 max_chunks=MAX_EXTRACTION_CHUNKS, combined_extraction=False, cascade_model=None,
+                 stream_responses=False, low_memory=False, ocr=False, deduplicate=False, multi_year=False,
+                 prompt_caching=False, text_cleanup=False):
+        self.api_key = (api_key or "").strip()
+        self.model = model
+        self.client = client or OpenRouterClient()
+        self.response_cache = response_cache
+        self.text_cache = text_cache
+        self.results_store = results_store
+        self.use_response_cache = use_response_cache
+        self.use_local_extraction = use_local_extraction
+        self.max_concurrent_requests = max_concurrent_requests
+        # Richieste API in corso, per tutti i documenti e i blocchi: mai più di max_concurrent_requests
+        self._request_slots = threading.BoundedSemaphore(max(1, max_concurrent_requests))
+        self.pdf_extraction_workers = pdf_extraction_workers
+        self.chunked_extraction = chunked_extraction
+        self.max_chunks = max_chunks
+        self.combined_extraction = combined_extraction
+        # Cascata: primo passaggio con cascade_model, poi self.model solo per ciò che non supera i controlli
+        self.cascade_model = cascade_model if cascade_model and cascade_model != model else None
+        # Streaming SSE: metriche mostrate appena complete, timeout solo per inattività
+        self.stream_responses = stream_responses
+        # Memoria ridotta: PDF mappati da disco, pagine lette una alla volta e conservate compresse
+        self.low_memory = low_memory
+        # OCR delle sole pagine scansionate (richiede tesseract; ignorato se non disponibile)
+        self.ocr = ocr
+        # Controllo preliminare dei duplicati: file ripetuti, testi quasi identici, stessa azienda e anno
+        self.deduplicate = deduplicate
+        # Più esercizi per documento: anche gli anni precedenti riportati nelle colonne comparative
+        self.multi_year = multi_year
+        # Cache dei prompt del provider: se il documento avrà identificazione ed estrazione dall'AI
+        # (senza blocchi) le chiamate condividono il prefisso, marcato con cache_control dove serve
+        self.prompt_caching = prompt_caching
+        # Pulizia del testo dei prompt: intestazioni e piè di pagina ripetuti, riempimenti e spazi
+        self.text_cleanup = text_cleanup
+        # Le chiamate dei blocchi di uno stesso documento aggiornano doc da più thread
+        self._doc_lock = threading.Lock()
+
+    # Funzione per estrarre il testo di ogni pagina da PDF
+    def extract_pdf_pages(self, pdf_bytes):
+        try:
+            # Il testo per pagina viene riusato se lo stesso file è già stato elaborato
+            return extract_pages_cached(pdf_bytes, self.text_cache, workers=self.pdf_extraction_workers)
+        except Exception as e:
+            raise DocumentProcessingError(f"Errore nell'estrazione del testo dal PDF: {str(e)}")
+
+    @property
+    def ocr_enabled(self):
+        return self.ocr and ocr_unavailable_reason() is None
+
+    def _ocr_pages(self, doc, pages, pdf_source, pdf_data):
+        """Testo delle pagine con il riconoscimento OCR al posto delle pagine scansionate.
+
+        Gli esiti vengono annotati in doc['ocr'] (numeri di pagina da 1).
+        """
+        doc['ocr'] = {'pages': [], 'cached': [], 'failed': []}
+        results = fill_scanned_pages(
+            pages, pdf_source, pdf_data, self.text_cache, workers=self.pdf_extraction_workers
+        )
+        for number, (text, outcome) in enumerate(results, start=1):
+            if outcome in ('ocr', 'ocr_cached'):
+                doc['ocr']['pages'].append(number)
+            if outcome == 'ocr_cached':
+                doc['ocr']['cached'].append(number)
+            elif outcome == 'ocr_failed':
+                doc['ocr']['failed'].append(number)
+            yield text
+
+    # Funzione per chiamare API OpenRouter (implementazione sicura)
+    def call_openrouter_api(self, prompt, model=None, telemetry=None, response_format=None, on_content=None,
+                            cache_prefix=False):
+        # telemetry (opzionale): dizionario in cui annotare token, tentativi e byte della chiamata
+        # on_content (opzionale): riceve il testo della risposta man mano che arriva
+        # cache_prefix: il prefisso sarà riletto da un'altra chiamata, va marcato per la cache del provider
+        if telemetry is None:
+            telemetry = {}
+
+        # Validazione chiave API
+        if len(self.api_key) < 10:
+            raise DocumentProcessingError("❌ Inserisci una chiave API OpenRouter valida.")
+
+        # Usa il modello selezionato
+        if not model:
+            model = self.model
+        telemetry['model'] = model
+
+        max_tokens = 4000
+        temperature = 0.1
+
+        # Risposta già in cache per lo stesso modello, prompt e parametri
+        cache_key = response_cache_key(model, prompt_text(prompt), temperature, max_tokens, response_format)
+        if self.response_cache is not None and self.use_response_cache:
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                telemetry['cached'] = True
+                if on_content is not None:
+                    on_content(cached_response)
+                return cached_response
+
+        headers = {
+            "HTTP-Referer": "https://analizzatore-pdf-finanziari.streamlit.app",
+            "X-Title": "Analizzatore PDF Finanziari"
+        }
+
+        data = {
+            "model": model,
+            "messages": prompt_messages(prompt, cache_prefix and supports_cache_control(model)),
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+        if self.prompt_caching:
+            # Dettaglio dei token letti dalla cache del provider (prompt_tokens_details)
+            data["usage"] = {"include": True}
+        if response_format is not None:
+            data["response_format"] = response_format
+            # Solo provider che rispettano lo schema richiesto
+            data["provider"] = {"require_parameters": True}
+
+        try:
+            # Il client ritenta 429/5xx/timeout con backoff esponenziale e rispetta Retry-After
+            on_delta = None
+            if self.stream_responses:
+                on_delta = on_content or (lambda text: None)
+            with self._request_slots:
+                result = self.client.chat_completion(
+                    self.api_key, data, headers=headers, meta=telemetry, on_delta=on_delta
+                )
+
+            usage = result.get('usage') or {}
+            telemetry['prompt_tokens'] = usage.get('prompt_tokens') or 0
+            telemetry['completion_tokens'] = usage.get('completion_tokens') or 0
+            telemetry['cached_tokens'] = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+
+            if 'choices' in result and len(result['choices']) > 0:
+                content = result['choices'][0]['message']['content']
+                if self.response_cache is not None:
+                    self.response_cache.set(cache_key, content)
+                return content
+            else:
+                raise DocumentProcessingError("❌ Risposta API non valida")
+
+        except DocumentProcessingError:
+            raise
+        except OpenRouterError as e:
+            if e.timeout:
+                raise DocumentProcessingError("❌ Timeout della richiesta API. Riprova.")
+            elif e.status_code == 401:
+                raise DocumentProcessingError("❌ Chiave API non valida. Controlla le tue credenziali OpenRouter.")
+            elif e.status_code == 402:
+                raise DocumentProcessingError("❌ Credito API insufficiente. Ricarica il tuo account OpenRouter.")
+            elif e.status_code == 429:
+                raise DocumentProcessingError("❌ Troppe richieste anche dopo vari tentativi. Attendi un momento e riprova.")
+            else:
+                raise DocumentProcessingError(f"❌ {str(e)}")
+        except Exception as e:
+            raise DocumentProcessingError(f"❌ Errore nella chiamata API OpenRouter: {str(e)}")
+
+    @contextmanager
+    def _stage(self, doc, stage):
+        # Tempo trascorso in una fase, sommato in doc['timings'] (secondi)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._doc_lock:
+                doc['timings'][stage] = doc['timings'].get(stage, 0.0) + elapsed
+
+    @property
+    def first_pass_model(self):
+        return self.cascade_model or self.model
+
+    @property
+    def stored_models(self):
+        """Modelli i cui risultati salvati valgono per questa configurazione (il principale per primo)."""
+        return [self.model, self.cascade_model] if self.cascade_model else [self.model]
+
+    def _record_cleanup(self, doc, page_index, pages):
+        """Somma i caratteri tolti dalla pulizia nelle pagine di un prompt effettivamente costruito."""
+        if not doc['text_cleanup'] or not pages:
+            return
+        stats = page_index.cleanup_stats(pages)
+        with self._doc_lock:
+            cleanup = doc['text_cleanup']
+            cleanup['prompts'] += 1
+            cleanup['prompt_chars_before'] += stats['chars_before']
+            cleanup['prompt_chars_saved'] += stats['chars_saved']
+            cleanup['prompt_tokens_saved'] += stats['tokens_saved']
+
+    def _request(self, doc, prompt, call, response_format=None, model=None, on_content=None, cache_prefix=False):
+        # Una voce in doc['api_calls'] per chiamata: durata, token di usage, tentativi e byte
+        telemetry = new_call_telemetry(call)
+        with self._doc_lock:
+            doc['tokens_sent'] += estimate_tokens(prompt_text(prompt))
+            doc['api_calls'].append(telemetry)
+        started = time.perf_counter()
+        try:
+            with self._stage(doc, 'api'):
+                return self.call_openrouter_api(
+                    prompt, model=model or self.first_pass_model, telemetry=telemetry,
+                    response_format=response_format, on_content=on_content, cache_prefix=cache_prefix
+                )
+        finally:
+            telemetry['seconds'] = time.perf_counter() - started
+
+    def _metric_listener(self, doc, metrics, status_queue):
+        """Callback on_content che pubblica ogni metrica appena completata nella risposta."""
+        parser = MetricStreamParser(metrics, stop_key='prior_years')
+
+        def on_content(text):
+            for metric, value in parser.feed(text):
+                status_queue.put(("metric", doc['index'], (metric, value)))
+        return on_content
+
+    def _parse_json(self, doc, response_text):
+        with self._stage(doc, 'json_parse'):
+            data, repairs = parse_model_json(response_text)
+        if repairs:
+            with self._doc_lock:
+                doc['json_repairs'].extend(repair for repair in repairs if repair not in doc['json_repairs'])
+        return data
+
+    def _complete_metrics(self, doc, response_text, found, metrics, status_queue, model=None):
+        """Recupera le metriche assenti da una risposta non valida invece di perdere la chiamata.
+
+        Le voci complete vengono lette una per una dal testo; le metriche
+        citate ma illeggibili sono richieste di nuovo con repair_prompt, che
+        contiene solo la risposta e non il documento. Le metriche con
+        "value": null restano tali: il modello le ha cercate senza trovarle.
+        """
+        found = dict(found) if isinstance(found, dict) else {}
+        with self._stage(doc, 'json_parse'):
+            normalize_metric_values(found)
+            missing = [metric for metric in metrics if not isinstance(found.get(metric), dict)]
+            salvaged = salvage_metrics(response_text, missing)
+            normalize_metric_values(salvaged)
+            unreadable = [metric for metric in unreadable_metrics(response_text, missing) if metric not in salvaged]
+        if salvaged:
+            found.update(salvaged)
+            with self._doc_lock:
+                if 'salvaged' not in doc['json_repairs']:
+                    doc['json_repairs'].append('salvaged')
+        if not unreadable:
+            return tag_model(found, model or self.first_pass_model)
+
+        try:
+            response = self._request(doc, repair_prompt(response_text, unreadable), 'json_repair', model=model)
+        except DocumentProcessingError as e:
+            doc['errors'].append(str(e))
+            return tag_model(found, model or self.first_pass_model)
+        repaired = self._parse_json(doc, response) or {}
+        normalize_metric_values(repaired)
+        for metric in unreadable:
+            entry = repaired.get(metric)
+            if isinstance(entry, dict) and entry.get('value') is not None:
+                found[metric] = entry
+                status_queue.put(("metric", doc['index'], (metric, entry)))
+        return tag_model(found, model or self.first_pass_model)
+
+    # Funzione per elaborare un singolo documento (eseguita in un thread di lavoro)
+    def process_document(self, index, pdf_source, metrics, status_queue):
+        """Esegue estrazione testo, identificazione azienda ed estrazione dati per un documento.
+
+        Gli aggiornamenti di stato passano per status_queue e l'esito viene
+        restituito come dizionario.
+        """
+        doc = self._new_document(index, pdf_source, metrics)
+        with self._stage(doc, 'total'):
+            self._run_document(doc, metrics, status_queue)
+        return doc
+
+    def _new_document(self, index, pdf_source, metrics):
+        return {
+            'index': index,
+            'source': pdf_source,
+            'doc_hash': None,
+            'pdf_text': None,
+            'identification_pages': [],
+            'identification_text': None,
+            'financial_pages': [],
+            'financial_text': None,
+            'financial_chunks': [],
+            'prompt_context': None,
+            'shared_prefix': False,
+            'text_cleanup': None,
+            'json_repairs': [],
+            'stored_metrics': [],
+            'local_items': None,
+            'local_unit': None,
+            'local_metrics': [],
+            'ai_metrics': list(metrics),
+            'company_source': 'ai',
+            'ocr': None,
+            'combined': False,
+            'cascade': None,
+            'company_response': None,
+            'company_info': None,
+            'company_name': None,
+            'financial_response': None,
+            'financial_data': None,
+            'prior_years': {},
+            'timings': {},
+            'tokens_sent': 0,
+            'api_calls': [],
+            'pdf_bytes': 0,
+            'page_count': 0,
+            'text_chars': 0,
+            'duplicate': None,
+            'errors': []
+        }
+
+    def _run_document(self, doc, metrics, status_queue):
+        index = doc['index']
+        name = doc['source']['name']
+
+        with ExitStack() as stack:
+            try:
+                if self.low_memory:
+                    # Il file resta su disco: il PDF viene mappato in memoria, non copiato
+                    pdf_bytes = stack.enter_context(open_pdf(doc['source']['content']))
+                else:
+                    pdf_bytes = read_pdf_bytes(doc['source']['content'])
+            except Exception as e:
+                doc['errors'].append(f"Errore nella lettura del PDF: {str(e)}")
+                doc['errors'].append(f"❌ Impossibile estrarre testo significativo da {name}")
+                return
+            doc['pdf_bytes'] = len(pdf_bytes)
+
+            # Risultati già salvati per questo file: si estraggono solo le metriche mancanti
+            doc['doc_hash'] = pdf_sha256(pdf_bytes)
+            stored_info = None
+            stored_data = {}
+            if self.results_store is not None:
+                stored_info = self.results_store.get_company_info(
+                    doc['doc_hash'], include_local=self.use_local_extraction
+                )
+                if stored_info:
+                    # Senza estrazione locale non si riusano nemmeno i valori locali salvati
+                    stored_data = self.results_store.get_metrics(
+                        doc['doc_hash'], self.stored_models, metrics, include_local=self.use_local_extraction
+                    )
+                if stored_info and self.multi_year:
+                    # Una metrica di cui non sono ancora stati cercati gli anni precedenti viene estratta di nuovo
+                    doc['prior_years'] = self.results_store.get_prior_years(
+                        doc['doc_hash'], self.stored_models, metrics, include_local=self.use_local_extraction
+                    )
+                    checked = self.results_store.get_prior_years_checked(
+                        doc['doc_hash'], self.stored_models, metrics, include_local=self.use_local_extraction
+                    )
+                    stored_data = {
+                        metric: data for metric, data in stored_data.items()
+                        if metric in checked or any(metric in year_data for year_data in doc['prior_years'].values())
+                    }
+            doc['stored_metrics'] = list(stored_data)
+            missing_metrics = [metric for metric in metrics if metric not in stored_data]
+            doc['ai_metrics'] = list(missing_metrics)
+
+            if stored_info and not missing_metrics:
+                doc['company_source'] = 'store'
+                doc['company_info'] = stored_info
+                doc['company_name'] = stored_info.get('company_name', f'Azienda Sconosciuta {index+1}')
+                doc['financial_data'] = stored_data
+                return
+
+            # Estrai testo dal PDF
+            status_queue.put(("status", index, f"📄 Estraendo testo: {name}"))
+            pages = []
+            page_index = None
+            scanner = None
+            # I processi di lavoro ricevono il percorso del file o i bytes, non l'oggetto caricato
+            content = doc['source']['content']
+            pdf_source = content if isinstance(content, (str, os.PathLike)) else pdf_bytes
+            try:
+                if self.low_memory:
+                    page_index, scanner = self._scan_pages(doc, pdf_source, pdf_bytes)
+                else:
+                    with self._stage(doc, 'pdf_extraction'):
+                        pages = self.extract_pdf_pages(pdf_bytes)
+                    if self.ocr_enabled:
+                        with self._stage(doc, 'ocr'):
+                            pages = list(self._ocr_pages(doc, pages, pdf_source, pdf_bytes))
+                    with self._stage(doc, 'pdf_extraction'):
+                        doc['pdf_text'] = join_pages(pages)
+                        doc['page_count'] = len(pages)
+                        doc['text_chars'] = len(doc['pdf_text'].strip())
+            except DocumentProcessingError as e:
+                doc['errors'].append(str(e))
+
+        pdf_text = doc['pdf_text']
+        if doc['text_chars'] <= 100:  # Assicurati che ci sia testo significativo
+            doc['errors'].append(f"❌ Impossibile estrarre testo significativo da {name}")
+            if self.ocr and not self.ocr_enabled:
+                doc['errors'].append(f"⚠️ OCR non disponibile: {ocr_unavailable_reason()}")
+            return
+
+        # Estrazione locale delle voci di bilancio in schema CEE (nessuna chiamata API)
+        local_data = {}
+        local_prior_data = {}
+        local_company_info = None
+        if self.use_local_extraction:
+            with self._stage(doc, 'local_extraction'):
+                if scanner is not None:
+                    local_data, doc['local_items'] = scanner.local_metrics(missing_metrics)
+                    doc['local_unit'] = scanner.unit
+                    if self.multi_year:
+                        local_prior_data, _ = scanner.prior_metrics(missing_metrics)
+                    if not stored_info:
+                        local_company_info = scanner.identify_company()
+                else:
+                    local_data, doc['local_items'] = extract_local_metrics(pdf_text, missing_metrics)
+                    doc['local_unit'] = detect_unit(pdf_text)
+                    if self.multi_year:
+                        local_prior_data, _ = extract_local_prior_metrics(pdf_text, missing_metrics)
+                    if not stored_info:
+                        local_company_info = identify_company_locally(pdf_text)
+            doc['local_metrics'] = list(local_data)
+            for metric, value in local_data.items():
+                status_queue.put(("metric", index, (metric, value)))
+            # Con più esercizi all'AI vanno anche le metriche senza colonna comparativa trovata localmente
+            doc['ai_metrics'] = [
+                metric for metric in missing_metrics
+                if metric not in local_data or (self.multi_year and metric not in local_prior_data)
+            ]
+
+        # Indice di rilevanza delle pagine, usato per riempire entrambi i prompt
+        if page_index is None:
+            with self._stage(doc, 'prompt_build'):
+                page_index = PageIndex(pages, cleanup=self.text_cleanup)
+        if self.text_cleanup:
+            with self._stage(doc, 'prompt_build'):
+                document = page_index.cleanup_stats()
+                # Il risparmio nei prompt si somma a ogni prompt costruito (_record_cleanup)
+                doc['text_cleanup'] = {
+                    'document_chars': document['chars_before'],
+                    'document_chars_removed': document['chars_saved'],
+                    'repeated_lines': document['repeated_lines'],
+                    'prompts': 0,
+                    'prompt_chars_before': 0,
+                    'prompt_chars_saved': 0,
+                    'prompt_tokens_saved': 0,
+                }
+
+        # Passo 1: Identifica azienda e anno
+        if stored_info:
+            doc['company_source'] = 'store'
+            company_info = stored_info
+        elif local_company_info:
+            doc['company_source'] = 'local'
+            company_info = local_company_info
+        elif self.combined_extraction and doc['ai_metrics']:
+            # Azienda, anno e metriche in un'unica chiamata
+            status_queue.put(("status", index, f"🔍 Identificando azienda ed estraendo dati per {name}..."))
+            doc['combined'] = True
+            company_info, combined_data = self._extract_combined(doc, page_index, status_queue)
+            if self.cascade_model:
+                cascade = self._cascade(doc)
+                cascade['identification_checked'] = True
+                cascade['identification_problems'] = validate_company_info(company_info)
+                if cascade['identification_problems']:
+                    # Chiamata unica ripetuta con il modello principale (metriche comprese)
+                    cascade['identification_escalated'] = True
+                    company_info, combined_data = self._extract_combined(doc, page_index, status_queue, model=self.model)
+            if not doc['company_response']:
+                doc['errors'].append(f"❌ Nessuna risposta dall'AI per l'identificazione azienda di {name}")
+                return
+        else:
+            status_queue.put(("status", index, f"🔍 Identificando azienda per {name}..."))
+            # Prefisso comune solo se una seconda chiamata sullo stesso testo è certa: la chiamata
+            # finanziaria senza blocchi (altrimenti la scrittura in cache si paga senza riletture)
+            doc['shared_prefix'] = self.prompt_caching and not self.chunked_extraction and bool(doc['ai_metrics'])
+            with self._stage(doc, 'prompt_build'):
+                if doc['shared_prefix']:
+                    doc['identification_pages'], doc['identification_text'] = self._document_context(doc, page_index)
+                else:
+                    doc['identification_pages'], doc['identification_text'] = page_index.select(
+                        IDENTIFICATION_TERMS, IDENTIFICATION_TOKEN_BUDGET, leading_pages_bonus=3
+                    )
+                self._record_cleanup(doc, page_index, doc['identification_pages'])
+                prompt = identification_prompt(doc['identification_text'], shared_prefix=doc['shared_prefix'])
+            try:
+                doc['company_response'] = self._request(
+                    doc, prompt, 'identification', cache_prefix=doc['shared_prefix']
+                )
+            except DocumentProcessingError as e:
+                doc['errors'].append(str(e))
+
+            company_info = self._parse_json(doc, doc['company_response']) if doc['company_response'] else None
+            if self.cascade_model:
+                company_info = self._escalate_identification(doc, company_info, prompt)
+
+            if not doc['company_response']:
+                doc['errors'].append(f"❌ Nessuna risposta dall'AI per l'identificazione azienda di {name}")
+                return
+
+        doc['company_info'] = company_info
+        if not company_info:
+            doc['errors'].append(f"❌ Impossibile identificare l'azienda per {name}")
+            return
+
+        company_name = company_info.get('company_name', f'Azienda Sconosciuta {index+1}')
+        doc['company_name'] = company_name
+        if self.results_store is not None and not stored_info:
+            # Come per le metriche, l'origine locale viene annotata per chi disattiva l'estrazione locale
+            source = 'local' if doc['company_source'] == 'local' else None
+            self.results_store.save_company_info(doc['doc_hash'], name, company_info, source=source)
+
+        # Colonna comparativa trovata localmente: è l'esercizio precedente a quello del documento
+        local_prior_years = {}
+        prior_year = previous_year(company_info.get('fiscal_year'))
+        if local_prior_data and prior_year:
+            local_prior_years[prior_year] = local_prior_data
+
+        # Passo 2: Estrai dati finanziari (solo le metriche non salvate né risolte localmente)
+        if not doc['ai_metrics']:
+            self._store_metrics(doc, local_data)
+            doc['financial_data'] = {**stored_data, **local_data}
+            self._store_prior_years(doc, {}, local_prior_years)
+            return
+
+        if doc['combined']:
+            ai_data = combined_data
+        else:
+            ai_data = self._extract_financial(doc, page_index, company_info, status_queue)
+        ai_prior_years = {}
+        prior_years_checked = None
+        if self.multi_year and isinstance(ai_data, dict):
+            ai_prior_years = prior_year_metrics(
+                ai_data.pop('prior_years', None), doc['ai_metrics'], company_info.get('fiscal_year')
+            )
+            # Stessa risposta delle metriche: modello veloce, salvo chiamata unica ripetuta col principale
+            escalated = doc['combined'] and doc['cascade'] and doc['cascade']['identification_escalated']
+            prior_model = self.model if escalated else self.first_pass_model
+            for year_data in ai_prior_years.values():
+                tag_model(year_data, prior_model)
+            # Anni precedenti cercati dal modello anche se non ne ha trovati (es. documento di un solo esercizio)
+            prior_years_checked = (prior_model, doc['ai_metrics'])
+
+        if self.cascade_model and not (doc['combined'] and doc['cascade']['identification_escalated']):
+            ai_data = self._escalate_metrics(doc, page_index, company_info, ai_data, local_data, status_queue)
+
+        if not doc['financial_response']:
+            doc['errors'].append(f"❌ Nessuna risposta dall'AI per l'estrazione finanziaria di {name}")
+        elif ai_data:
+            # Solo le metriche richieste vengono salvate e restituite
+            ai_data = {metric: ai_data[metric] for metric in doc['ai_metrics'] if metric in ai_data}
+            local_data = {**ai_data, **local_data}
+        else:
+            doc['errors'].append(f"❌ Impossibile estrarre dati finanziari validi per {name}")
+
+        # I valori trovati localmente restano validi anche se la chiamata AI fallisce
+        self._store_metrics(doc, local_data)
+        doc['financial_data'] = {**stored_data, **local_data} or None
+        self._store_prior_years(doc, ai_prior_years, local_prior_years, checked=prior_years_checked)
+
+    def _scan_pages(self, doc, pdf_source, pdf_data):
+        """Una sola passata sulle pagine, lette una alla volta: indice compresso ed estrazione locale.
+
+        Il testo completo non viene mai unito in memoria (doc['pdf_text'] resta None).
+        Il tempo dell'OCR rientra qui nella fase pdf_extraction.
+        """
+        page_index = PageIndex(compress=True, cleanup=self.text_cleanup)
+        scanner = PageScanner() if self.use_local_extraction else None
+        pages = iter_pages(pdf_source, pdf_data, self.text_cache, workers=self.pdf_extraction_workers)
+        if self.ocr_enabled:
+            pages = self._ocr_pages(doc, pages, pdf_source, pdf_data)
+        while True:
+            with self._stage(doc, 'pdf_extraction'):
+                try:
+                    page = next(pages, None)
+                except Exception as e:
+                    raise DocumentProcessingError(f"Errore nell'estrazione del testo dal PDF: {str(e)}")
+            if page is None:
+                break
+            if scanner is not None:
+                with self._stage(doc, 'local_extraction'):
+                    scanner.add(page)
+            with self._stage(doc, 'prompt_build'):
+                page_index.add(page)
+            doc['page_count'] = len(page_index)
+        doc['text_chars'] = page_index.text_chars
+        return page_index, scanner
+
+    def _extract_financial(self, doc, page_index, company_info, status_queue):
+        """Chiamata di estrazione delle metriche (una per blocco se l'estrazione a blocchi è attiva)."""
+        index = doc['index']
+        terms = financial_terms(doc['ai_metrics'])
+        with self._stage(doc, 'prompt_build'):
+            if self.chunked_extraction:
+                chunks = page_index.chunks(terms, EXTRACTION_TOKEN_BUDGET, self.max_chunks)
+            elif doc['shared_prefix']:
+                chunks = [self._document_context(doc, page_index)]
+            else:
+                chunks = [page_index.select(terms, EXTRACTION_TOKEN_BUDGET)]
+            for pages, _ in chunks:
+                self._record_cleanup(doc, page_index, pages)
+
+        if len(chunks) > 1:
+            status_queue.put(("status", index, f"💰 Estraendo dati finanziari per {doc['company_name']} ({len(chunks)} blocchi in parallelo)..."))
+            return self._extract_chunks(doc, company_info, chunks, status_queue)
+
+        status_queue.put(("status", index, f"💰 Estraendo dati finanziari per {doc['company_name']}..."))
+        with self._stage(doc, 'prompt_build'):
+            doc['financial_pages'], doc['financial_text'] = chunks[0]
+            prompt = financial_prompt(
+                doc['financial_text'], company_info, doc['ai_metrics'], prior_years=self.multi_year
+            )
+        try:
+            doc['financial_response'] = self._request(
+                doc, prompt, 'financial', on_content=self._metric_listener(doc, doc['ai_metrics'], status_queue),
+                cache_prefix=doc['shared_prefix']
+            )
+        except DocumentProcessingError as e:
+            doc['errors'].append(str(e))
+            return None
+        data = self._parse_json(doc, doc['financial_response'])
+        return self._complete_metrics(doc, doc['financial_response'], data, doc['ai_metrics'], status_queue)
+
+    def _cascade(self, doc):
+        if doc['cascade'] is None:
+            doc['cascade'] = {
+                'model': self.cascade_model,
+                'identification_checked': False,
+                'identification_escalated': False,
+                'identification_problems': [],
+                'checked_metrics': [],
+                'escalated_metrics': {},
+                # Valori del modello veloce non validi e non corretti dal modello principale: scartati
+                'discarded_metrics': []
+            }
+        return doc['cascade']
+
+    def _escalate_identification(self, doc, company_info, prompt):
+        """Ripete l'identificazione con il modello principale se la risposta veloce non è valida."""
+        cascade = self._cascade(doc)
+        cascade['identification_checked'] = True
+        cascade['identification_problems'] = validate_company_info(company_info)
+        if not cascade['identification_problems']:
+            return company_info
+        cascade['identification_escalated'] = True
+        try:
+            # Chiamata isolata su un altro modello: il prefisso non verrebbe riletto, niente scrittura in cache
+            response = self._request(doc, prompt, 'identification_escalation', model=self.model)
+        except DocumentProcessingError as e:
+            doc['errors'].append(str(e))
+            return company_info
+        doc['company_response'] = response
+        return self._parse_json(doc, response) or company_info
+
+    def _escalate_metrics(self, doc, page_index, company_info, ai_data, local_data, status_queue):
+        """Controlli contabili sulle metriche del modello veloce; quelle non valide passano al modello principale.
+
+        I valori non validi che il modello principale non sostituisce vengono
+        scartati, così non finiscono tra i risultati salvati.
+        """
+        cascade = self._cascade(doc)
+        metrics = doc['ai_metrics']
+        ai_data = {metric: ai_data[metric] for metric in metrics if ai_data and metric in ai_data}
+        tag_model(ai_data, self.first_pass_model)
+        # I controlli incrociati (es. EBITDA >= EBIT) usano anche le metriche trovate localmente
+        failures = validate_metrics({**ai_data, **local_data}, metrics, doc['local_items'], doc['local_unit'])
+        cascade['checked_metrics'] = list(metrics)
+        cascade['escalated_metrics'] = {metric: failures[metric] for metric in metrics if metric in failures}
+        retry_metrics = list(cascade['escalated_metrics'])
+        if not retry_metrics:
+            return ai_data
+
+        with self._stage(doc, 'prompt_build'):
+            if doc['shared_prefix']:
+                pages, text = self._document_context(doc, page_index)
+            else:
+                pages, text = page_index.select(financial_terms(retry_metrics), EXTRACTION_TOKEN_BUDGET)
+            self._record_cleanup(doc, page_index, pages)
+            prompt = financial_prompt(text, company_info, retry_metrics)
+        try:
+            response = self._request(
+                doc, prompt, 'financial_escalation', model=self.model,
+                on_content=self._metric_listener(doc, retry_metrics, status_queue)
+            )
+        except DocumentProcessingError as e:
+            doc['errors'].append(str(e))
+            response = None
+        escalated = {}
+        if response:
+            if not doc['financial_response']:
+                doc['financial_response'] = response
+            escalated = self._complete_metrics(
+                doc, response, self._parse_json(doc, response), retry_metrics, status_queue, model=self.model
+            ) or {}
+        for metric in retry_metrics:
+            entry = escalated.get(metric)
+            if isinstance(entry, dict) and entry.get('value') is not None:
+                ai_data[metric] = entry
+            elif ai_data.pop(metric, None) is not None:
+                cascade['discarded_metrics'].append(metric)
+        return ai_data
+
+    def _document_context(self, doc, page_index):
+        """Pagine per identificazione e metriche richieste, calcolate una volta per documento.
+
+        È il testo del prompt unico e, con il prefisso comune (doc['shared_prefix']),
+        di identificazione, estrazione e ripetizioni della cascata, così il
+        prefisso resta identico tra le chiamate. Solo identificazione ed
+        estrazione lo marcano per la cache: le ripetizioni della cascata vanno
+        a un altro modello e non verrebbero rilette.
+        """
+        if doc['prompt_context'] is None:
+            identification_pages, _ = page_index.select(
+                IDENTIFICATION_TERMS, IDENTIFICATION_TOKEN_BUDGET, leading_pages_bonus=3
+            )
+            financial_pages, _ = page_index.select(financial_terms(doc['ai_metrics']), EXTRACTION_TOKEN_BUDGET)
+            pages = sorted(set(identification_pages) | set(financial_pages))
+            doc['prompt_context'] = (pages, page_index.text(pages, EXTRACTION_TOKEN_BUDGET))
+        return doc['prompt_context']
+
+    def _extract_combined(self, doc, page_index, status_queue, model=None):
+        """Una sola chiamata (con JSON schema se il modello lo supporta) per azienda e metriche."""
+        metrics = doc['ai_metrics']
+        with self._stage(doc, 'prompt_build'):
+            pages, text = self._document_context(doc, page_index)
+            doc['identification_pages'], doc['identification_text'] = pages, text
+            doc['financial_pages'], doc['financial_text'] = pages, text
+            self._record_cleanup(doc, page_index, pages)
+            prompt = combined_prompt(text, metrics, prior_years=self.multi_year)
+            model = model or self.first_pass_model
+            response_format = (
+                combined_response_format(metrics, prior_years=self.multi_year)
+                if supports_structured_output(model) else None
+            )
+        try:
+            response = self._request(
+                doc, prompt, 'combined' if model == self.first_pass_model else 'combined_escalation',
+                response_format=response_format, model=model,
+                on_content=self._metric_listener(doc, metrics, status_queue)
+            )
+        except DocumentProcessingError as e:
+            doc['errors'].append(str(e))
+            return None, None
+        doc['company_response'] = doc['financial_response'] = response
+        data = self._parse_json(doc, response)
+        if data is not None:
+            if isinstance(data.get('metrics'), dict):
+                data['metrics'] = self._complete_metrics(doc, response, data['metrics'], metrics, status_queue, model)
+            else:
+                data.update(self._complete_metrics(doc, response, data, metrics, status_queue, model))
+        company_info, found = split_combined_response(data, metrics)
+        if self.multi_year and found is not None:
+            # Separati da _run_document una volta noto l'anno fiscale
+            found['prior_years'] = data.get('prior_years')
+        return company_info, found
+
+    def _extract_chunks(self, doc, company_info, chunks, status_queue):
+        """Fase map-reduce: una chiamata per blocco, in parallelo, poi reduce_chunk_metrics."""
+        metrics = doc['ai_metrics']
+        doc['financial_chunks'] = [{'pages': pages, 'response': None, 'data': None} for pages, _ in chunks]
+        doc['financial_pages'] = [page for pages, _ in chunks for page in pages]
+        doc['financial_text'] = "".join(text for _, text in chunks)
+
+        def extract(position):
+            pages, text = chunks[position]
+            chunk = doc['financial_chunks'][position]
+            with self._stage(doc, 'prompt_build'):
+                prompt = financial_prompt(
+                    text, company_info, metrics, chunk=(position + 1, len(chunks)), prior_years=self.multi_year
+                )
+            try:
+                chunk['response'] = self._request(
+                    doc, prompt, 'financial_chunk', on_content=self._metric_listener(doc, metrics, status_queue)
+                )
+            except DocumentProcessingError as e:
+                return str(e)
+            chunk['data'] = self._complete_metrics(
+                doc, chunk['response'], self._parse_json(doc, chunk['response']), metrics, status_queue
+            )
+            return None
+
+        # La latenza è quella del blocco più lento; le richieste in corso restano entro
+        # max_concurrent_requests per l'intero lotto (semaforo in call_openrouter_api)
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            chunk_errors = list(executor.map(extract, range(len(chunks))))
+
+        for error in dict.fromkeys(error for error in chunk_errors if error):
+            doc['errors'].append(error)
+        responses = [chunk['response'] for chunk in doc['financial_chunks'] if chunk['response']]
+        doc['financial_response'] = "\n\n".join(responses) or None
+        chunk_results = [chunk['data'] for chunk in doc['financial_chunks']]
+        merged = reduce_chunk_metrics(chunk_results, metrics)
+        if self.multi_year:
+            merged['prior_years'] = reduce_chunk_prior_years(chunk_results, metrics, company_info.get('fiscal_year'))
+        return merged
+
+    def _store_metrics(self, doc, financial_data):
+        # Ogni metrica è salvata con il modello che l'ha prodotta (campo "model"), self.model in mancanza
+        if self.results_store is not None and financial_data:
+            self.results_store.save_metrics(doc['doc_hash'], doc['company_info'], self.model, financial_data)
+
+    def _store_prior_years(self, doc, ai_prior_years, local_prior_years, checked=None):
+        """Unisce gli esercizi precedenti salvati, dell'AI e locali (questi ultimi prevalgono) e li salva.
+
+        checked = (modello, metriche) segna come già cercati gli esercizi
+        precedenti di quelle metriche, così non vengono richiesti di nuovo.
+        """
+        if not self.multi_year:
+            return
+        if self.results_store is not None and checked:
+            self.results_store.save_prior_years_checked(doc['doc_hash'], *checked)
+        found = {}
+        for source in (ai_prior_years, local_prior_years):
+            for year, data in source.items():
+                found.setdefault(year, {}).update(data)
+        prior_years = {year: dict(data) for year, data in doc['prior_years'].items()}
+        for year, data in found.items():
+            prior_years.setdefault(year, {}).update(data)
+        doc['prior_years'] = prior_years
+        if self.results_store is not None and found:
+            self.results_store.save_prior_years(doc['doc_hash'], doc['company_info'], self.model, found)
+
+    def fingerprint_document(self, index, pdf_source):
+        """Impronta di un documento per il controllo dei duplicati, senza chiamate API.
+
+        Hash dei byte, sketch MinHash del testo e azienda/anno riconosciuti
+        localmente; None se il file non è leggibile (l'errore emergerà
+        nell'elaborazione). Il testo estratto qui finisce nella cache del
+        testo e viene riusato dall'elaborazione del documento.
+        """
+        started = time.perf_counter()
+        content = pdf_source['content']
+        sketch = MinHashSketch()
+        head = ""
+        page_count = 0
+        text_chars = 0
+        try:
+            with ExitStack() as stack:
+                if self.low_memory:
+                    pdf_bytes = stack.enter_context(open_pdf(content))
+                    source = content if isinstance(content, (str, os.PathLike)) else pdf_bytes
+                    pages = iter_pages(source, pdf_bytes, self.text_cache, workers=self.pdf_extraction_workers)
+                else:
+                    pdf_bytes = read_pdf_bytes(content)
+                    pages = self.extract_pdf_pages(pdf_bytes)
+                doc_hash = pdf_sha256(pdf_bytes)
+                pdf_size = len(pdf_bytes)
+                for page in pages:
+                    sketch.add(page)
+                    page_count += 1
+                    text_chars += len(page)
+                    if len(head) < IDENTIFICATION_HEAD_CHARS:
+                        head = (head + page + "\n")[:IDENTIFICATION_HEAD_CHARS]
+        except Exception:
+            return None
+        company_info = identify_company_locally(head)
+        return {
+            'index': index,
+            'name': pdf_source['name'],
+            'sha256': doc_hash,
+            'pdf_bytes': pdf_size,
+            'page_count': page_count,
+            'text_chars': text_chars,
+            'sketch': sketch,
+            'company_info': company_info,
+            'company_name': company_info['company_name'] if company_info else None,
+            'company_key': normalize_company_name(company_info['company_name']) if company_info else None,
+            'fiscal_year': company_info['fiscal_year'] if company_info else None,
+            'seconds': time.perf_counter() - started,
+        }
+
+    def _duplicate_document(self, pdf_source, fingerprint, decision, metrics):
+        """Documento saltato perché ridondante: nessuna chiamata API, solo la decisione."""
+        doc = self._new_document(fingerprint['index'], pdf_source, metrics)
+        doc.update({
+            'doc_hash': fingerprint['sha256'],
+            'pdf_bytes': fingerprint['pdf_bytes'],
+            'page_count': fingerprint['page_count'],
+            'text_chars': fingerprint['text_chars'],
+            'ai_metrics': [],
+            'company_source': 'local' if fingerprint['company_info'] else None,
+            'company_info': fingerprint['company_info'],
+            'company_name': fingerprint['company_name'],
+            'duplicate': decision,
+        })
+        doc['timings']['total'] = fingerprint['seconds']
+        return doc
+
+    def iter_analysis(self, pdf_sources, metrics, poll_interval=0.25):
+        """Elabora i documenti in parallelo e produce eventi nel thread chiamante.
+
+        Eventi: ("status", indice, messaggio) durante l'elaborazione,
+        ("metric", indice, (metrica, valore)) appena una metrica è disponibile
+        (valore provvisorio, quello finale è in doc) e ("done", indice, doc)
+        quando un documento è completato. Con deduplicate i documenti
+        ridondanti vengono completati subito, con doc['duplicate'] impostato.
+        """
+        pdf_sources = list(pdf_sources)
+        status_queue = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrent_requests)
+        try:
+            duplicates = {}
+            if self.deduplicate and len(pdf_sources) > 1:
+                # Controllo preliminare: tutte le impronte prima di qualsiasi chiamata API
+                fingerprints = [None] * len(pdf_sources)
+                pending = {}
+                for i, pdf_source in enumerate(pdf_sources):
+                    yield "status", i, f"🧬 Controllo duplicati: {pdf_source['name']}"
+                    pending[executor.submit(self.fingerprint_document, i, pdf_source)] = i
+                while pending:
+                    done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = pending.pop(future)
+                        fingerprints[i] = future.result()
+                        yield "status", i, f"🧬 Impronta calcolata: {pdf_sources[i]['name']}"
+
+                duplicates = find_duplicates(fingerprints)
+                for i, decision in sorted(duplicates.items()):
+                    yield "done", i, self._duplicate_document(pdf_sources[i], fingerprints[i], decision, metrics)
+
+            pending = {
+                executor.submit(self.process_document, i, pdf_source, metrics, status_queue)
+                for i, pdf_source in enumerate(pdf_sources) if i not in duplicates
+            }
+
+            while pending:
+                done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+
+                # Aggiornamenti di stato dei documenti in corso
+                while True:
+                    try:
+                        event = status_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    yield event
+
+                for future in done:
+                    doc = future.result()
+                    yield "done", doc['index'], doc
+        finally:
+            # Interruzione anticipata: i documenti non ancora avviati vengono annullati
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _filing_year(fiscal_year):
+    # Anno di riferimento per ordinare i documenti dal più recente (-1 se non riconoscibile)
+    match = _YEAR_RE.search(str(fiscal_year or ""))
+    return int(match.group()) if match else -1
+
+
+def collect_results(documents):
+    """Raggruppa i documenti completati per azienda e anno fiscale, nell'ordine dato.
+
+    Le aziende sono confrontate per nome normalizzato (viene mostrato il primo
+    nome incontrato). Gli esercizi precedenti estratti dalle colonne
+    comparative (doc['prior_years']) entrano nella stessa mappa. Più fonti per
+    la stessa azienda e anno vengono unite: prevalgono i valori del documento
+    più recente (es. i dati 2022 riesposti nel bilancio 2023), a parità il
+    primo nell'ordine dato; le altre aggiungono solo le metriche mancanti e
+    compaiono in 'merged_sources'.
+    """
+    results = {}
+    display_names = {}
+    contributions = []
+    for order, doc in enumerate(documents):
+        if not doc or not (doc['financial_data'] or doc.get('prior_years')):
+            continue
+        company_name = doc['company_name']
+        company_key = normalize_company_name(company_name) or company_name
+        company_name = display_names.setdefault(company_key, company_name)
+        years = results.setdefault(company_name, {})
+
+        fiscal_year = doc['company_info'].get('fiscal_year', 'Sconosciuto')
+        filing_year = _filing_year(fiscal_year)
+        if doc['financial_data']:
+            years.setdefault(fiscal_year, None)
+            contributions.append((filing_year, order, company_name, fiscal_year, False, doc, doc['financial_data']))
+        for year, data in (doc.get('prior_years') or {}).items():
+            years.setdefault(year, None)
+            contributions.append((filing_year, order, company_name, year, True, doc, data))
+
+    # Dal documento più recente; a parità nell'ordine dato
+    contributions.sort(key=lambda contribution: (-contribution[0], contribution[1]))
+    for _, _, company_name, year, comparative, doc, data in contributions:
+        entry = results[company_name][year]
+        if entry is None:
+            company_info = {**doc['company_info'], 'fiscal_year': year} if comparative else doc['company_info']
+            results[company_name][year] = {
+                'company_info': company_info,
+                'financial_data': dict(data),
+                'source': doc['source'],
+                'comparative': comparative,
+                'merged_sources': []
+            }
+        else:
+            for metric, value in data.items():
+                entry['financial_data'].setdefault(metric, value)
+            entry['merged_sources'].append(doc['source'])
+    return results
+
+
+def document_record(doc, metrics):
+    """Riepilogo serializzabile di un documento elaborato (una riga di output batch)."""
+    company_info = doc['company_info'] or {}
+    financial_data = doc['financial_data'] or {}
+    return {
+        'file': doc['source']['name'],
+        'company_name': doc['company_name'],
+        'fiscal_year': company_info.get('fiscal_year'),
+        'currency': company_info.get('currency'),
+        'metrics': {
+            metric: financial_data[metric] for metric in metrics if metric in financial_data
+        },
+        'prior_years': {
+            year: {metric: data[metric] for metric in metrics if metric in data}
+            for year, data in sorted((doc.get('prior_years') or {}).items(), reverse=True)
+        },
+        'duplicate_of': doc['duplicate']['of_name'] if doc.get('duplicate') else None,
+        'errors': doc['errors']
+    }
+
+
+# Campi conservati da compact_document (testi, prompt e risposte vengono scartati)
+COMPACT_FIELDS = [
+    'index', 'doc_hash', 'stored_metrics', 'local_items', 'local_unit', 'local_metrics', 'ai_metrics',
+    'company_source', 'ocr', 'combined', 'cascade', 'company_info', 'company_name', 'financial_data',
+    'prior_years', 'timings', 'tokens_sent', 'api_calls', 'pdf_bytes', 'page_count', 'text_chars', 'duplicate',
+    'json_repairs', 'text_cleanup', 'errors'
+]
+
+
+def compact_document(doc):
+    """Riepilogo leggero di un documento elaborato, da tenere in memoria per tutto il lotto.
+
+    Basta per collect_results, document_record e la telemetria; il sorgente
+    perde il contenuto del PDF e restano solo nome e tipo.
+    """
+    compact = {field: doc[field] for field in COMPACT_FIELDS}
+    compact['source'] = {'name': doc['source']['name'], 'source': doc['source'].get('source')}
+    return compact
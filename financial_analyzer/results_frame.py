@@ -0,0 +1,161 @@
+"""Risultati in formato lungo: una riga per azienda, anno fiscale e metrica.
+
+Il frame viene costruito una volta per esecuzione dai risultati di
+collect_results; tabelle, grafici ed esportazioni ne sono viste. Gli importi
+vengono riportati in unità di valuta secondo la scala dichiarata ("milioni",
+"migliaia", "euro"...), così i valori di fonti diverse sono confrontabili.
+pandas viene importato solo quando servono i risultati.
+"""
+import io
+
+# Moltiplicatore di ogni scala (unità già senza il nome della valuta, in minuscolo)
+UNIT_SCALES = {
+    "": 1.0, "unità": 1.0, "unita": 1.0, "units": 1.0,
+    "migliaia": 1e3, "migliaia di": 1e3, "k": 1e3, "000": 1e3, "thousands": 1e3, "thousand": 1e3,
+    "milioni": 1e6, "milioni di": 1e6, "mln": 1e6, "mio": 1e6, "m": 1e6, "millions": 1e6, "million": 1e6,
+    "miliardi": 1e9, "miliardi di": 1e9, "mld": 1e9, "bn": 1e9, "billions": 1e9, "billion": 1e9,
+}
+# Nome della valuta nell'unità ("milioni di euro", "€/000", "EUR m")
+_CURRENCY_RE = r"(?:euro|eur|usd|gbp|chf|dollari|dollars|€|\$|£|/)"
+
+# Metriche adimensionali: nessuna scala (un'unità "%" indica un valore percentuale)
+RATIO_METRICS = {"Rapporto Debito/Patrimonio"}
+
+# Scala di tabelle, grafici e riepiloghi
+DISPLAY_SCALE = 1e6
+DISPLAY_UNIT = "milioni"
+
+COLUMNS = [
+    'company', 'fiscal_year', 'metric', 'value', 'unit', 'currency', 'source', 'comparative', 'merged_sources'
+]
+
+# Intestazioni in italiano per le esportazioni leggibili (Excel)
+EXPORT_HEADERS = {
+    'company': 'Azienda', 'fiscal_year': 'Anno', 'year': 'Anno (numero)', 'metric': 'Metrica', 'value': 'Valore',
+    'unit': 'Unità', 'scale': 'Scala', 'amount': 'Importo', 'display': f'Importo ({DISPLAY_UNIT})',
+    'currency': 'Valuta', 'source': 'Documento', 'comparative': 'Colonna comparativa', 'merged_sources': 'Unito con',
+}
+
+
+def results_frame(results, metrics):
+    """Frame lungo dei risultati ({azienda: {anno: dati}}) per le metriche richieste.
+
+    Oltre ai campi originali contiene year (anno numerico), scale
+    (moltiplicatore dell'unità, NaN se non riconosciuta), amount (importo in
+    unità di valuta) e display (importo in milioni; i rapporti restano tali).
+    """
+    import pandas as pd
+
+    records = []
+    for company, years in results.items():
+        for fiscal_year, data in years.items():
+            currency = data['company_info'].get('currency') or 'Sconosciuta'
+            merged = ", ".join(source['name'] for source in data['merged_sources'])
+            for metric in metrics:
+                entry = data['financial_data'].get(metric)
+                if isinstance(entry, dict):
+                    records.append((
+                        company, str(fiscal_year), metric, entry.get('value'), entry.get('unit') or "",
+                        currency, data['source']['name'], data['comparative'], merged
+                    ))
+
+    frame = pd.DataFrame.from_records(records, columns=COLUMNS)
+    frame['value'] = pd.to_numeric(frame['value'], errors='coerce')
+    frame = frame.dropna(subset=['value']).reset_index(drop=True)
+    frame['unit'] = frame['unit'].astype(str)
+    frame['year'] = pd.to_numeric(
+        frame['fiscal_year'].str.extract(r"(\d{4})", expand=False), errors='coerce'
+    ).astype('Int64')
+
+    # Scala dall'unità: minuscole, senza valuta né spazi superflui
+    unit = (frame['unit'].str.lower()
+            .str.replace(_CURRENCY_RE, " ", regex=True)
+            .str.replace(r"\s+", " ", regex=True)
+            .str.strip())
+    ratio = frame['metric'].isin(RATIO_METRICS)
+    frame['scale'] = unit.map(UNIT_SCALES).astype(float).where(~ratio, unit.eq("%").map({True: 0.01, False: 1.0}))
+    frame['amount'] = frame['value'] * frame['scale']
+    frame['display'] = frame['amount'].where(ratio, frame['amount'] / DISPLAY_SCALE)
+
+    frame['metric'] = pd.Categorical(frame['metric'], categories=list(metrics))
+    frame['company'] = frame['company'].astype('category')
+    return frame.sort_values(['company', 'year', 'fiscal_year', 'metric'], kind='stable').reset_index(drop=True)
+
+
+def unrecognized_units(frame):
+    """Unità non riconosciute (importi esclusi da tabelle e grafici)."""
+    return sorted(frame.loc[frame['scale'].isna(), 'unit'].unique())
+
+
+def company_table(frame, company, metrics):
+    """Tabella di un'azienda: una riga per anno, una colonna per metrica (importi in milioni)."""
+    rows = frame[frame['company'] == company]
+    table = rows.pivot(index='fiscal_year', columns='metric', values='display')
+    order = rows.drop_duplicates('fiscal_year').set_index('fiscal_year')['year']
+    table = table.reindex(index=order.sort_values(kind='stable').index, columns=list(metrics))
+    table.columns = list(table.columns)
+    table.index.name = 'Anno'
+    return table
+
+
+def company_chart_data(frame, company):
+    """Importi di un'azienda per anno numerico e metrica, per i grafici (solo valori confrontabili)."""
+    rows = frame[(frame['company'] == company) & frame['year'].notna() & frame['display'].notna()]
+    chart = rows.pivot(index='year', columns='metric', values='display').sort_index()
+    return chart.dropna(axis=1, how='all')
+
+
+def summary_frame(frame, metrics):
+    """Riepilogo di tutte le aziende: una riga per azienda e anno, importi in milioni."""
+    wide = frame.pivot_table(
+        index=['company', 'fiscal_year', 'currency'], columns='metric', values='display',
+        aggfunc='first', observed=True, sort=False
+    )
+    wide = wide.reindex(columns=list(metrics))
+    wide.columns = list(wide.columns)
+    wide = wide.reset_index().rename(columns={'company': 'Azienda', 'fiscal_year': 'Anno', 'currency': 'Valuta'})
+    wide['Azienda'] = wide['Azienda'].astype(str)
+    return wide
+
+
+def sources_frame(frame):
+    """Documento di provenienza di ogni azienda e anno."""
+    sources = frame.drop_duplicates(['company', 'fiscal_year'])[
+        ['company', 'fiscal_year', 'source', 'comparative', 'merged_sources']
+    ]
+    return sources.rename(columns=EXPORT_HEADERS).astype({'Azienda': str})
+
+
+def export_csv(frame, metrics):
+    return summary_frame(frame, metrics).to_csv(index=False)
+
+
+def parquet_unavailable_reason():
+    """Motivo per cui l'esportazione Parquet non è disponibile (None se lo è)."""
+    for engine in ("pyarrow", "fastparquet"):
+        try:
+            __import__(engine)
+            return None
+        except ImportError:
+            continue
+    return "installa pyarrow (pip install pyarrow) per l'esportazione Parquet"
+
+
+def export_parquet(frame):
+    """Frame lungo in formato Parquet (colonne originali, tipi conservati)."""
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def export_excel(frame, metrics):
+    """Cartella Excel con riepilogo (milioni), dati in formato lungo e fonti, un foglio ciascuno."""
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        summary_frame(frame, metrics).to_excel(writer, sheet_name='Riepilogo', index=False)
+        data = frame.astype({'company': str, 'metric': str}).rename(columns=EXPORT_HEADERS)
+        data.to_excel(writer, sheet_name='Dati', index=False)
+        sources_frame(frame).to_excel(writer, sheet_name='Fonti', index=False)
+    return buffer.getvalue()
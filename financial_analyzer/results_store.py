@@ -0,0 +1,231 @@
+"""Archivio SQLite dei risultati per (hash documento, azienda, anno fiscale, metrica, modello)."""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Modello associato alle metriche trovate dall'estrattore locale (valide per ogni modello)
+LOCAL_MODEL = "local"
+
+
+def _model_rank(models, include_local=True):
+    # Priorità dei modelli accettati: l'estrattore locale prima di tutti, poi l'ordine indicato
+    if isinstance(models, str):
+        models = [models]
+    rank = {LOCAL_MODEL: 0} if include_local else {}
+    for model in models:
+        rank.setdefault(model, len(rank))
+    return rank
+
+
+class ResultsStore:
+    """Risultati persistenti: un documento già analizzato non viene rielaborato.
+
+    Le metriche sono salvate singolarmente, così aggiungere una metrica richiede
+    solo l'estrazione di quella metrica.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " doc_hash TEXT PRIMARY KEY,"
+            " file_name TEXT,"
+            " company_info TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " source TEXT)"
+        )
+        # Archivi creati prima della colonna source (origine dell'identificazione)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(documents)")]
+        if "source" not in columns:
+            self._conn.execute("ALTER TABLE documents ADD COLUMN source TEXT")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metrics ("
+            " doc_hash TEXT NOT NULL,"
+            " company_name TEXT,"
+            " fiscal_year TEXT,"
+            " metric TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (doc_hash, metric, model))"
+        )
+        # Esercizi precedenti riportati nello stesso documento (colonne comparative)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS prior_year_metrics ("
+            " doc_hash TEXT NOT NULL,"
+            " company_name TEXT,"
+            " fiscal_year TEXT NOT NULL,"
+            " metric TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (doc_hash, fiscal_year, metric, model))"
+        )
+        # Metriche per cui gli esercizi precedenti sono già stati cercati (anche senza trovarne)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS prior_years_checked ("
+            " doc_hash TEXT NOT NULL,"
+            " metric TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " PRIMARY KEY (doc_hash, metric, model))"
+        )
+        self._conn.commit()
+
+    def get_company_info(self, doc_hash, include_local=True):
+        """Azienda e anno salvati per il documento; con include_local=False si ignora l'identificazione locale."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT company_info, source FROM documents WHERE doc_hash = ?", (doc_hash,)
+            ).fetchone()
+        if not row or (not include_local and row[1] == "local"):
+            return None
+        return json.loads(row[0])
+
+    def save_company_info(self, doc_hash, file_name, company_info, source=None):
+        """Salva azienda e anno del documento; source="local" se vengono dall'identificazione locale."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_hash, file_name, company_info, updated_at, source)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (doc_hash, file_name, json.dumps(company_info, ensure_ascii=False), time.time(), source)
+            )
+            self._conn.commit()
+
+    def get_metrics(self, doc_hash, models, metrics, include_local=True):
+        """Metriche già estratte per il documento con i modelli dati (o dall'estrattore locale).
+
+        models è un modello o una lista di modelli in ordine di preferenza; con
+        include_local=False i valori dell'estrattore locale sono ignorati.
+        """
+        if not metrics:
+            return {}
+        rank = _model_rank(models, include_local)
+        placeholders = ", ".join("?" for _ in metrics)
+        model_placeholders = ", ".join("?" for _ in rank)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT metric, model, data FROM metrics"
+                f" WHERE doc_hash = ? AND model IN ({model_placeholders}) AND metric IN ({placeholders})",
+                (doc_hash, *rank, *metrics)
+            ).fetchall()
+        found = {}
+        for metric, row_model, data in sorted(rows, key=lambda row: -rank[row[1]]):
+            # A parità di metrica prevale il valore dell'estrattore locale, poi il primo modello
+            found[metric] = json.loads(data)
+        return found
+
+    def save_metrics(self, doc_hash, company_info, model, financial_data):
+        """Salva le metriche con un valore; quelle con fonte "local" valgono per ogni modello.
+
+        Le altre sono salvate con il modello che le ha prodotte (campo "model"),
+        o con model se il campo manca.
+        """
+        now = time.time()
+        rows = []
+        for metric, data in financial_data.items():
+            if not isinstance(data, dict) or data.get("value") is None:
+                continue
+            row_model = LOCAL_MODEL if data.get("source") == "local" else data.get("model") or model
+            rows.append((
+                doc_hash, company_info.get("company_name"), str(company_info.get("fiscal_year")),
+                metric, row_model, json.dumps(data, ensure_ascii=False), now
+            ))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO metrics"
+                " (doc_hash, company_name, fiscal_year, metric, model, data, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def get_prior_years(self, doc_hash, models, metrics, include_local=True):
+        """Metriche degli esercizi precedenti già estratte dal documento: {anno: {metrica: dati}}."""
+        if not metrics:
+            return {}
+        rank = _model_rank(models, include_local)
+        placeholders = ", ".join("?" for _ in metrics)
+        model_placeholders = ", ".join("?" for _ in rank)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT fiscal_year, metric, model, data FROM prior_year_metrics"
+                f" WHERE doc_hash = ? AND model IN ({model_placeholders}) AND metric IN ({placeholders})"
+                f" ORDER BY fiscal_year DESC",
+                (doc_hash, *rank, *metrics)
+            ).fetchall()
+        found = {}
+        for fiscal_year, metric, row_model, data in sorted(rows, key=lambda row: -rank[row[2]]):
+            found.setdefault(fiscal_year, {})[metric] = json.loads(data)
+        return found
+
+    def save_prior_years(self, doc_hash, company_info, model, prior_years):
+        """Come save_metrics, per {anno: {metrica: dati}} degli esercizi precedenti."""
+        now = time.time()
+        rows = []
+        for fiscal_year, financial_data in prior_years.items():
+            for metric, data in financial_data.items():
+                if not isinstance(data, dict) or data.get("value") is None:
+                    continue
+                row_model = LOCAL_MODEL if data.get("source") == "local" else data.get("model") or model
+                rows.append((
+                    doc_hash, company_info.get("company_name"), str(fiscal_year),
+                    metric, row_model, json.dumps(data, ensure_ascii=False), now
+                ))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO prior_year_metrics"
+                " (doc_hash, company_name, fiscal_year, metric, model, data, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def get_prior_years_checked(self, doc_hash, models, metrics, include_local=True):
+        """Metriche del documento di cui i modelli dati hanno già cercato gli esercizi precedenti."""
+        if not metrics:
+            return set()
+        rank = _model_rank(models, include_local)
+        placeholders = ", ".join("?" for _ in metrics)
+        model_placeholders = ", ".join("?" for _ in rank)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT metric FROM prior_years_checked"
+                f" WHERE doc_hash = ? AND model IN ({model_placeholders}) AND metric IN ({placeholders})",
+                (doc_hash, *rank, *metrics)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def save_prior_years_checked(self, doc_hash, model, metrics):
+        """Segna le metriche di cui model ha cercato gli esercizi precedenti, trovati o no."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO prior_years_checked (doc_hash, metric, model, updated_at)"
+                " VALUES (?, ?, ?, ?)",
+                [(doc_hash, metric, model, now) for metric in metrics]
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM prior_years_checked")
+            self._conn.execute("DELETE FROM prior_year_metrics")
+            self._conn.execute("DELETE FROM metrics")
+            self._conn.execute("DELETE FROM documents")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            documents = self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            metrics = self._conn.execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+        return {"documents": documents, "metrics": metrics}
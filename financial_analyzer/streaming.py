@@ -0,0 +1,44 @@
+"""Lettura incrementale delle risposte JSON ricevute in streaming."""
+import json
+import re
+
+# Coppia "chiave": {oggetto senza annidamenti}, la forma di ogni metrica nella risposta
+_ENTRY_RE = re.compile(r'"((?:[^"\\]|\\.)+)"\s*:\s*(\{[^{}]*\})')
+
+
+class MetricStreamParser:
+    """Riconosce le metriche completate mentre il testo della risposta arriva.
+
+    Ogni metrica ha la forma "nome": {"value": ..., "unit": ...}: appena il suo
+    oggetto è chiuso viene restituita, anche se il JSON complessivo non lo è ancora.
+    Il testo dopo la chiave stop_key (es. gli anni precedenti, con metriche
+    omonime) viene ignorato.
+    """
+
+    def __init__(self, metrics, stop_key=None):
+        self.metrics = set(metrics)
+        self.stop_key = stop_key
+        self.text = ""
+        self.found = {}
+        self._scan_from = 0
+
+    def feed(self, delta):
+        """Aggiunge un frammento di testo e restituisce [(metrica, valore)] appena completate."""
+        self.text += delta
+        completed = []
+        end = len(self.text)
+        if self.stop_key is not None:
+            stop = self.text.find(f'"{self.stop_key}"')
+            if stop != -1:
+                end = stop
+        for match in _ENTRY_RE.finditer(self.text, self._scan_from, end):
+            self._scan_from = match.end()
+            try:
+                name = json.loads(f'"{match.group(1)}"')
+                value = json.loads(match.group(2))
+            except ValueError:
+                continue
+            if name in self.metrics and name not in self.found:
+                self.found[name] = value
+                completed.append((name, value))
+        return completed
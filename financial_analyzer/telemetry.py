@@ -0,0 +1,223 @@
+"""Telemetria per documento: tempi per fase, token, ritentativi e dimensioni dei payload.
+
+I dati sono raccolti dalla pipeline in doc['timings'] e doc['api_calls'];
+questo modulo li riassume in righe tabellari e li esporta in JSON o nel
+formato testuale di Prometheus (es. per il textfile collector di node_exporter).
+"""
+import json
+import sys
+
+# Fasi misurate da Analyzer._stage ('total' è il tempo complessivo del documento)
+STAGES = ["pdf_extraction", "ocr", "local_extraction", "prompt_build", "api", "json_parse", "total"]
+
+# Limiti superiori (secondi) dell'istogramma della durata per documento
+DURATION_BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def new_call_telemetry(call):
+    """Voce di telemetria di una chiamata al modello (riempita da call_openrouter_api)."""
+    return {
+        'call': call,
+        'model': None,
+        'cached': False,
+        'attempts': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cached_tokens': 0,
+        'request_bytes': 0,
+        'response_bytes': 0,
+        'seconds': 0.0
+    }
+
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo e dei processi figli (MB), None se non disponibile."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return round(max(own, children), 1)
+
+
+def document_status(doc):
+    if doc.get('duplicate'):
+        return 'duplicate'
+    if not doc['financial_data']:
+        return 'failed'
+    return 'partial' if doc['errors'] else 'ok'
+
+
+def document_telemetry(doc):
+    """Riga di riepilogo di un documento: una colonna per fase e i totali delle chiamate API."""
+    calls = doc.get('api_calls', [])
+    row = {
+        'file': doc['source']['name'],
+        'status': document_status(doc),
+        'pages': doc.get('page_count', 0),
+        'pdf_bytes': doc.get('pdf_bytes', 0),
+        'ocr_pages': len(doc['ocr']['pages']) if doc.get('ocr') else 0,
+    }
+    for stage in STAGES:
+        row[f'{stage}_s'] = round(doc['timings'].get(stage, 0.0), 4)
+    row.update({
+        'api_calls': len(calls),
+        'cached_calls': sum(1 for call in calls if call['cached']),
+        'retries': sum(max(call['attempts'] - 1, 0) for call in calls),
+        'tokens_estimated': doc.get('tokens_sent', 0),
+        'prompt_tokens': sum(call['prompt_tokens'] for call in calls),
+        'completion_tokens': sum(call['completion_tokens'] for call in calls),
+        'cached_prompt_tokens': sum(call.get('cached_tokens', 0) for call in calls),
+        'request_bytes': sum(call['request_bytes'] for call in calls),
+        'response_bytes': sum(call['response_bytes'] for call in calls),
+    })
+    cascade = doc.get('cascade')
+    row['escalated_identification'] = bool(cascade and cascade['identification_escalated'])
+    row['escalated_metrics'] = len(cascade['escalated_metrics']) if cascade else 0
+    row['json_repairs'] = ",".join(doc.get('json_repairs', []))
+    row['cleanup_tokens_saved'] = (doc.get('text_cleanup') or {}).get('prompt_tokens_saved', 0)
+    return row
+
+
+def escalation_stats(documents):
+    """Quanti controlli della cascata di modelli sono falliti (identificazioni e metriche)."""
+    cascades = [doc['cascade'] for doc in documents if doc.get('cascade')]
+    stats = {
+        'documents': len(cascades),
+        'escalated_documents': sum(
+            1 for cascade in cascades if cascade['identification_escalated'] or cascade['escalated_metrics']
+        ),
+        'identifications': sum(1 for cascade in cascades if cascade['identification_checked']),
+        'escalated_identifications': sum(1 for cascade in cascades if cascade['identification_escalated']),
+        'metrics': sum(len(cascade['checked_metrics']) for cascade in cascades),
+        'escalated_metrics': sum(len(cascade['escalated_metrics']) for cascade in cascades),
+    }
+    for kind in ('documents', 'identifications', 'metrics'):
+        total = stats[kind]
+        stats[f'{kind}_rate'] = stats[f'escalated_{kind}'] / total if total else 0.0
+    return stats
+
+
+def telemetry_json(documents, indent=2):
+    """Esportazione JSON: riepilogo per documento più il dettaglio di ogni chiamata API."""
+    payload = []
+    for doc in documents:
+        row = document_telemetry(doc)
+        row['calls'] = [
+            {**call, 'seconds': round(call['seconds'], 4)} for call in doc.get('api_calls', [])
+        ]
+        payload.append(row)
+    return json.dumps(payload, ensure_ascii=False, indent=indent)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _metric(lines, name, kind, help_text, samples, suffix=""):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{suffix}{_labels(labels)} {value}")
+
+
+def prometheus_text(documents):
+    """Metriche aggregate sui documenti nel formato di esposizione testuale di Prometheus."""
+    rows = [document_telemetry(doc) for doc in documents]
+    calls = [call for doc in documents for call in doc.get('api_calls', [])]
+    lines = []
+
+    statuses = {}
+    for row in rows:
+        statuses[row['status']] = statuses.get(row['status'], 0) + 1
+    _metric(lines, "fpa_documents_total", "counter", "Documenti elaborati per esito.",
+            [({'status': status}, count) for status, count in sorted(statuses.items())])
+
+    _metric(lines, "fpa_stage_seconds_total", "counter", "Tempo cumulativo per fase della pipeline.",
+            [({'stage': stage}, float(round(sum(row[f'{stage}_s'] for row in rows), 4))) for stage in STAGES])
+
+    durations = [row['total_s'] for row in rows]
+    histogram = [({'le': f'{bucket:g}'}, sum(1 for d in durations if d <= bucket)) for bucket in DURATION_BUCKETS]
+    histogram.append(({'le': '+Inf'}, len(durations)))
+    _metric(lines, "fpa_document_duration_seconds", "histogram",
+            "Durata complessiva dell'elaborazione di un documento.", histogram, suffix="_bucket")
+    lines.append(f"fpa_document_duration_seconds_sum {round(sum(durations), 4)}")
+    lines.append(f"fpa_document_duration_seconds_count {len(durations)}")
+
+    by_call = {}
+    for call in calls:
+        key = (call['call'], call['model'] or '', 'true' if call['cached'] else 'false')
+        entry = by_call.setdefault(key, {'count': 0, 'seconds': 0.0, 'retries': 0, 'prompt': 0,
+                                         'completion': 0, 'cached_prompt': 0, 'request': 0, 'response': 0})
+        entry['count'] += 1
+        entry['seconds'] += call['seconds']
+        entry['retries'] += max(call['attempts'] - 1, 0)
+        entry['prompt'] += call['prompt_tokens']
+        entry['completion'] += call['completion_tokens']
+        entry['cached_prompt'] += call.get('cached_tokens', 0)
+        entry['request'] += call['request_bytes']
+        entry['response'] += call['response_bytes']
+
+    def samples(field, as_float=False):
+        result = []
+        for (call, model, cached), entry in sorted(by_call.items()):
+            value = float(round(entry[field], 4)) if as_float else entry[field]
+            result.append(({'call': call, 'model': model, 'cached': cached}, value))
+        return result
+
+    _metric(lines, "fpa_api_calls_total", "counter", "Chiamate al modello (incluse quelle servite dalla cache).",
+            samples('count'))
+    _metric(lines, "fpa_api_seconds_total", "counter", "Tempo cumulativo delle chiamate al modello.",
+            samples('seconds', as_float=True))
+    _metric(lines, "fpa_api_retries_total", "counter", "Tentativi ripetuti (429, 5xx, timeout).",
+            samples('retries'))
+    _metric(lines, "fpa_prompt_tokens_total", "counter", "Token di prompt riportati dal provider (usage).",
+            samples('prompt'))
+    _metric(lines, "fpa_completion_tokens_total", "counter", "Token di completamento riportati dal provider (usage).",
+            samples('completion'))
+    _metric(lines, "fpa_cached_prompt_tokens_total", "counter",
+            "Token di prompt letti dalla cache del provider (usage.prompt_tokens_details).",
+            samples('cached_prompt'))
+    _metric(lines, "fpa_request_bytes_total", "counter", "Byte inviati nei corpi delle richieste.",
+            samples('request'))
+    _metric(lines, "fpa_response_bytes_total", "counter", "Byte ricevuti nei corpi delle risposte.",
+            samples('response'))
+
+    escalations = escalation_stats(documents)
+    _metric(lines, "fpa_cascade_checks_total", "counter", "Risposte del modello veloce sottoposte ai controlli.",
+            [({'kind': 'identification'}, escalations['identifications']),
+             ({'kind': 'metric'}, escalations['metrics'])])
+    _metric(lines, "fpa_cascade_escalations_total", "counter", "Risposte ripetute con il modello principale.",
+            [({'kind': 'identification'}, escalations['escalated_identifications']),
+             ({'kind': 'metric'}, escalations['escalated_metrics'])])
+
+    repairs = {}
+    for doc in documents:
+        for repair in doc.get('json_repairs', []):
+            repairs[repair] = repairs.get(repair, 0) + 1
+    _metric(lines, "fpa_json_repairs_total", "counter",
+            "Documenti con risposte JSON corrette o recuperate localmente, per tipo di correzione.",
+            [({'kind': kind}, count) for kind, count in sorted(repairs.items())])
+
+    _metric(lines, "fpa_cleanup_tokens_saved_total", "counter",
+            "Token stimati tolti dalla pulizia dalle pagine inviate nei prompt (spazio riusato entro lo stesso budget).",
+            [({}, sum(row['cleanup_tokens_saved'] for row in rows))])
+
+    _metric(lines, "fpa_pdf_bytes_total", "counter", "Byte dei PDF elaborati.",
+            [({}, sum(row['pdf_bytes'] for row in rows))])
+    _metric(lines, "fpa_pdf_pages_total", "counter", "Pagine estratte dai PDF.",
+            [({}, sum(row['pages'] for row in rows))])
+    ocr = [doc['ocr'] for doc in documents if doc.get('ocr')]
+    _metric(lines, "fpa_ocr_pages_total", "counter", "Pagine scansionate lette con l'OCR.",
+            [({'cached': 'false'}, sum(len(o['pages']) - len(o['cached']) for o in ocr)),
+             ({'cached': 'true'}, sum(len(o['cached']) for o in ocr))])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,99 @@
+"""Pulizia del testo delle pagine prima dei prompt, per ridurre i token inviati.
+
+Il testo estratto dai PDF ripete su ogni pagina intestazioni e piè di pagina
+(nome della società, titolo del documento, numeri di pagina) e contiene
+puntini di riempimento e spazi superflui. Le righe ripetute vengono
+riconosciute dalla loro frequenza ai margini delle pagine e restano solo
+nella prima pagina di ogni prompt (vi compaiono di solito azienda e anno);
+il testo usato dall'estrazione locale e dal controllo duplicati non viene
+modificato.
+"""
+import re
+
+# Righe iniziali e finali (non vuote) di ogni pagina in cui cercare intestazioni e piè di pagina
+EDGE_LINES = 3
+# Una riga di margine è ripetuta se compare in almeno tante pagine e in questa quota del documento
+REPEATED_LINE_MIN_PAGES = 3
+REPEATED_LINE_MIN_SHARE = 0.3
+
+_DIGITS_RE = re.compile(r"\d+")
+# Importi con separatore delle migliaia: le righe che li contengono sono dati, mai intestazioni
+_AMOUNT_RE = re.compile(r"\d{1,3}(?:[.,]\d{3})+")
+_SPACES_RE = re.compile(r"[ \t\f\v]+")
+# Puntini e trattini di riempimento tra voce e importo ("Debiti verso banche ........ 1.234")
+# (il primo carattere viene confrontato da solo: la ricerca resta veloce su pagine lunghe)
+_LEADERS_RE = re.compile(r"[.…_-](?:(?<=\.)(?:[ \t]?\.){2,}|(?<=…)…*|(?<=_)_{2,}|(?<=-)-{3,})")
+# Spazi all'inizio e alla fine delle righe e righe vuote
+_BLANK_LINES_RE = re.compile(r"\n[ \n]+| \n[ \n]*")
+# Migliaia separate da spazi non divisibili (1 234 567): il separatore diventa il punto
+_SPACED_THOUSANDS_RE = re.compile(r"(?<=\d)[   ](?=\d{3}(?!\d))")
+# Segno meno tipografico davanti a un numero
+_MINUS_RE = re.compile(r"[−–](?=\s?\d)")
+# Parentesi contabili con spazi interni: "( 1.234 )" -> "(1.234)"
+_PARENTHESIS_RE = re.compile(r"\(\s+([\d.,]+)\s*\)|\(([\d.,]+)\s+\)")
+
+
+def line_key(line):
+    """Chiave di confronto di una riga: minuscole, cifre mascherate, spazi compattati ("" per le righe con importi)."""
+    if _AMOUNT_RE.search(line):
+        return ""
+    return _SPACES_RE.sub(" ", _DIGITS_RE.sub("#", line.lower())).strip()
+
+
+def _edge_positions(lines):
+    # Posizioni delle prime e ultime EDGE_LINES righe non vuote
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    if len(filled) <= 2 * EDGE_LINES:
+        return set(filled)
+    return set(filled[:EDGE_LINES] + filled[-EDGE_LINES:])
+
+
+def normalize_numbers(text):
+    """Uniforma la scrittura dei numeri senza cambiarne il valore."""
+    text = _SPACED_THOUSANDS_RE.sub(".", text)
+    text = _MINUS_RE.sub("-", text)
+    return _PARENTHESIS_RE.sub(lambda m: f"({m.group(1) or m.group(2)})", text)
+
+
+def compact_whitespace(text):
+    """Sostituisce i puntini di riempimento con uno spazio, compatta gli spazi e toglie le righe vuote."""
+    text = _SPACES_RE.sub(" ", _LEADERS_RE.sub(" ", text.replace("\r", "\n")))
+    return _BLANK_LINES_RE.sub("\n", text).strip()
+
+
+class BoilerplateDetector:
+    """Conta in quante pagine compare ogni riga di margine (intestazioni, piè di pagina, numeri di pagina).
+
+    Le pagine si aggiungono una alla volta (es. da un generatore).
+    """
+
+    def __init__(self):
+        self.pages = 0
+        self._counts = {}
+
+    def add(self, page):
+        lines = page.splitlines()
+        for key in {line_key(lines[i]) for i in _edge_positions(lines)}:
+            if key:
+                self._counts[key] = self._counts.get(key, 0) + 1
+        self.pages += 1
+
+    def repeated(self):
+        """Chiavi delle righe di margine ripetute nel documento."""
+        threshold = max(REPEATED_LINE_MIN_PAGES, self.pages * REPEATED_LINE_MIN_SHARE)
+        return {key for key, count in self._counts.items() if count >= threshold}
+
+    def clean(self, page, repeated=None):
+        """Testo della pagina senza le righe ripetute indicate, spazi superflui e riempimenti.
+
+        Con repeated vuoto restano tutte le righe e si compattano solo spazi e numeri.
+        """
+        if repeated is None:
+            repeated = self.repeated()
+        if repeated:
+            lines = page.splitlines()
+            edges = _edge_positions(lines)
+            page = "\n".join(
+                line for i, line in enumerate(lines) if i not in edges or line_key(line) not in repeated
+            )
+        return compact_whitespace(normalize_numbers(page))
@@ -0,0 +1,105 @@
+"""Controlli di coerenza sulle risposte del modello, usati dalla cascata di modelli.
+
+Ogni controllo restituisce motivi leggibili (in italiano): una risposta senza
+motivi è considerata valida, le altre vengono ripetute con il modello principale.
+"""
+import re
+
+RATIO_METRICS = {"Rapporto Debito/Patrimonio"}
+
+# Nessuna azienda riporta importi oltre questa soglia (in euro)
+MAX_AMOUNT_EUR = 1e12
+MAX_RATIO = 50
+# Tolleranza relativa per i confronti tra importi arrotondati
+TOLERANCE = 0.01
+
+YEAR_RE = re.compile(r"\b(?:19|20)\d\d\b")
+
+_UNIT_SCALES = [
+    (re.compile(r"miliard|\bbn\b|\bmld"), 1e9),
+    (re.compile(r"milion|\bmln\b|\bmio\b|^m€$|^€m$|^m$|\bmillion"), 1e6),
+    (re.compile(r"miglia|^k€$|^€k$|^k$|\bthousand"), 1e3),
+    (re.compile(r"euro|\beur\b|^€$|^$"), 1.0),
+]
+
+
+def unit_scale(unit):
+    """Fattore per convertire in euro un valore espresso in unit, None se l'unità non è riconosciuta."""
+    unit = (unit or "").strip().lower()
+    for pattern, scale in _UNIT_SCALES:
+        if pattern.search(unit):
+            return scale
+    return None
+
+
+def _amount_eur(entry):
+    scale = unit_scale(entry.get("unit"))
+    return entry["value"] * scale if scale is not None else None
+
+
+def _close_or_greater(a, b):
+    # a >= b a meno degli arrotondamenti
+    return a >= b - TOLERANCE * max(abs(a), abs(b))
+
+
+def validate_company_info(company_info):
+    """Motivi per cui l'identificazione non è affidabile (lista vuota se valida)."""
+    if not company_info:
+        return ["risposta di identificazione non valida"]
+    problems = []
+    if not str(company_info.get("company_name") or "").strip():
+        problems.append("nome azienda mancante")
+    if not YEAR_RE.search(str(company_info.get("fiscal_year") or "")):
+        problems.append("anno fiscale non riconosciuto")
+    return problems
+
+
+def validate_metrics(data, metrics, local_items=None, local_unit=None):
+    """Controlla completezza e coerenza contabile delle metriche estratte.
+
+    Restituisce {metrica: motivo} per le metriche da ripetere. local_items sono le
+    voci di bilancio trovate dall'estrazione locale (nell'unità local_unit).
+    """
+    data = data or {}
+    failures = {}
+    amounts = {}
+
+    for metric in metrics:
+        entry = data.get(metric)
+        if not isinstance(entry, dict) or not isinstance(entry.get("value"), (int, float)) \
+                or isinstance(entry.get("value"), bool):
+            failures[metric] = "valore mancante o non numerico"
+            continue
+        if metric in RATIO_METRICS:
+            if abs(entry["value"]) > MAX_RATIO:
+                failures[metric] = f"rapporto fuori scala ({entry['value']})"
+            continue
+        amount = _amount_eur(entry)
+        if amount is not None and abs(amount) > MAX_AMOUNT_EUR:
+            failures[metric] = f"importo non plausibile per l'unità \"{entry.get('unit')}\""
+        elif amount is not None:
+            amounts[metric] = amount
+
+    # EBITDA = EBIT + ammortamenti, quindi non può essere inferiore all'EBIT
+    if "EBITDA" in amounts and "EBIT" in amounts and not _close_or_greater(amounts["EBITDA"], amounts["EBIT"]):
+        failures.setdefault("EBITDA", "EBITDA inferiore all'EBIT")
+        failures.setdefault("EBIT", "EBIT superiore all'EBITDA")
+
+    if "Totale Attività" in amounts and "Patrimonio Netto" in amounts and amounts["Patrimonio Netto"] > 0 \
+            and not _close_or_greater(amounts["Totale Attività"], amounts["Patrimonio Netto"]):
+        failures.setdefault("Totale Attività", "totale attività inferiore al patrimonio netto")
+
+    # PFN = debiti verso banche - liquidità - titoli: limiti dalle voci trovate localmente
+    pfn = "PFN (Posizione Finanziaria Netta)"
+    local_scale = unit_scale(local_unit) if local_items else None
+    if pfn in amounts and local_scale is not None:
+        banks = local_items.get("debiti_banche")
+        cash = local_items.get("disponibilita_liquide")
+        if banks is not None and not _close_or_greater(banks * local_scale, amounts[pfn]):
+            failures.setdefault(pfn, "PFN superiore ai debiti verso banche")
+        if cash is not None:
+            floor = -(abs(cash) + abs(local_items.get("titoli", 0))) * local_scale
+            if not _close_or_greater(amounts[pfn], floor):
+                failures.setdefault(pfn, "PFN inferiore a -(liquidità + titoli)")
+
+    return failures
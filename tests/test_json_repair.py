@@ -0,0 +1,30 @@
+import pytest
+
+from financial_analyzer.json_repair import parse_locale_number, parse_model_json
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("0,125", 0.125),
+    ("1,234", 1.234),
+    ("12,500", 12.5),
+    ("12.345,6", 12345.6),
+    ("1,234.5", 1234.5),
+    ("1.234.567", 1234567.0),
+    ("1,234,567", 1234567.0),
+    ("(1.234,5)", -1234.5),
+    ("n.d.", None),
+])
+def test_parse_locale_number(text, expected):
+    assert parse_locale_number(text) == expected
+
+
+def test_parse_model_json_reads_lone_comma_as_decimal():
+    data, repairs = parse_model_json('{"Rapporto Debito/Patrimonio": {"value": 1,234, "unit": "x"}}')
+    assert data["Rapporto Debito/Patrimonio"]["value"] == 1.234
+    assert "locale_numbers" in repairs
+
+
+def test_parse_model_json_reports_only_applied_repairs():
+    data, repairs = parse_model_json('{"Ricavi": {"value": 1.234.567,}}')
+    assert data["Ricavi"]["value"] == 1234567.0
+    assert repairs == ["locale_numbers", "trailing_commas"]